@@ -0,0 +1,67 @@
+"""
+Time per item of calling a small per-record function in a Python loop, compared with its batched version,
+at 1k, 100k and 1M items.
+
+    python benchmarks/bench_batched.py
+"""
+import array
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from monki.enhancers import batched  # noqa: E402
+
+
+_SIZES = (1000, 100000, 1000000)
+_ROUNDS = 5
+
+
+@batched
+def to_celsius(fahrenheit):
+    if fahrenheit is None:
+        return None
+    return (fahrenheit - 32) * 5 / 9
+
+
+@batched(typecode='d')
+def price_with_tax(price, tax_rate):
+    if tax_rate < 0:
+        return price
+    return price * (1 + tax_rate)
+
+
+def per_item(func, *columns):
+    return [func(*items) for items in zip(*columns)] if len(columns) > 1 else [func(item) for item in columns[0]]
+
+
+def _best_times(calls):
+    """ The variants are timed in turns, so a noisy machine affects all of them alike. """
+    best = [float('inf')] * len(calls)
+    for _ in range(_ROUNDS):
+        for index, call in enumerate(calls):
+            started = time.perf_counter()
+            call()
+            best[index] = min(best[index], time.perf_counter() - started)
+    return best
+
+
+def main():
+    print('{:>16} {:>9} {:>14} {:>14} {:>9}'.format('function', 'items', 'ns per item', 'batched', 'speedup'))
+    for size in _SIZES:
+        readings = array.array('d', (item % 120 for item in range(size)))
+        prices = array.array('d', (item % 1000 / 10 for item in range(size)))
+        rates = array.array('d', [0.17]) * size
+        cases = [
+            ('to_celsius', lambda: per_item(to_celsius, readings), lambda: to_celsius.batch(readings)),
+            ('price_with_tax', lambda: per_item(price_with_tax, prices, rates),
+             lambda: price_with_tax.batch(prices, rates)),
+        ]
+        for name, loop, batch in cases:
+            looped, batched_time = _best_times([loop, batch])
+            print('{:>16} {:>9} {:>14.1f} {:>14.1f} {:>8.2f}x'.format(
+                name, size, looped / size * 1e9, batched_time / size * 1e9, looped / batched_time))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+"""
+Startup cost of a worker patching N functions of a module: `monki.patch_module`, which reads, modifies and compiles
+their source, versus `monki.apply_bundle` of a bundle compiled beforehand by `monki.compile_manifest`.
+
+    python benchmarks/bench_bundle.py
+"""
+import importlib
+import json
+import linecache
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import monki  # noqa: E402
+
+
+_FUNCTION_TEMPLATE = '''
+def func_{index}(values):
+    total = 0
+    for value in values:
+        total += value * {index}
+    return total
+'''
+
+_FUNCTION_COUNTS = [10, 100, 500]
+_REPEATS = 5
+_SPEC = {'start': 'values = list(values)', 'insert_lines': {1: 'total = 1'}}
+
+
+def _write_module(directory, name, function_count):
+    with open(os.path.join(directory, name + '.py'), 'w') as f:
+        f.write(''.join(_FUNCTION_TEMPLATE.format(index=index) for index in range(function_count)))
+    specs = {'func_{}'.format(index): _SPEC for index in range(function_count)}
+    manifest_path = os.path.join(directory, name + '.json')
+    with open(manifest_path, 'w') as f:
+        json.dump({name: specs}, f)
+    return specs, manifest_path
+
+
+def _fresh_module(name):
+    """ Imports the module again, and forgets its source, like a new worker would. """
+    sys.modules.pop(name, None)
+    linecache.clearcache()
+    return importlib.import_module(name)
+
+
+def _best_time(name, patcher):
+    best = float('inf')
+    for _ in range(_REPEATS):
+        module = _fresh_module(name)
+        started = time.perf_counter()
+        patcher(module)
+        best = min(best, time.perf_counter() - started)
+    return best
+
+
+def main():
+    monki.disable_cache()
+    print('{:>10} {:>20} {:>20} {:>10}'.format('functions', 'patch_module() ms', 'apply_bundle() ms', 'speedup'))
+    with tempfile.TemporaryDirectory() as directory:
+        sys.path.insert(0, directory)
+        for function_count in _FUNCTION_COUNTS:
+            name = 'bench_bundle_module_{}'.format(function_count)
+            specs, manifest_path = _write_module(directory, name, function_count)
+            _fresh_module(name)
+            bundle_path = monki.compile_manifest(manifest_path)
+
+            from_source = _best_time(name, lambda module: monki.patch_module(module, specs))
+            from_bundle = _best_time(name, lambda module: monki.apply_bundle(bundle_path))
+            print('{:>10} {:>20.2f} {:>20.2f} {:>9.1f}x'.format(
+                function_count, from_source * 1000, from_bundle * 1000, from_source / from_bundle))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+"""
+Throughput of calling a hot function from several threads while other threads keep patching and unpatching it,
+and throughput of patching the same function from several threads at once.
+Calls never take a lock, so they only share the interpreter with the patching threads.
+
+    python benchmarks/bench_concurrent_patching.py
+"""
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import monki  # noqa: E402
+
+
+_DURATION = 1.0
+_CALLER_COUNTS = (1, 4)
+_PATCHER_COUNTS = (0, 1, 4)
+
+
+def hot(value):
+    return value + 1
+
+
+def _call(stop, counts, index):
+    calls = 0
+    while not stop.is_set():
+        for _ in range(100):
+            hot(calls)
+        calls += 100
+    counts[index] = calls
+
+
+def _patch(stop, counts, index):
+    patches = 0
+    while not stop.is_set():
+        monki.patch(hot, start='value *= 1')
+        monki.unpatch(hot)
+        patches += 1
+    counts[index] = patches
+
+
+def _run(caller_count, patcher_count):
+    stop = threading.Event()
+    calls = [0] * caller_count
+    patches = [0] * patcher_count
+    threads = [threading.Thread(target=_call, args=(stop, calls, index)) for index in range(caller_count)]
+    threads += [threading.Thread(target=_patch, args=(stop, patches, index)) for index in range(patcher_count)]
+    for thread in threads:
+        thread.start()
+    time.sleep(_DURATION)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    monki.unpatch(hot)
+    return sum(calls) / _DURATION, sum(patches) / _DURATION
+
+
+def main():
+    print('{:>8} {:>9} {:>16} {:>18}'.format('callers', 'patchers', 'calls per second', 'patches per second'))
+    for caller_count in _CALLER_COUNTS:
+        for patcher_count in _PATCHER_COUNTS:
+            calls, patches = _run(caller_count, patcher_count)
+            print('{:>8} {:>9} {:>16,.0f} {:>18,.0f}'.format(caller_count, patcher_count, calls, patches))
+    print('{:>8} {:>9} {:>16} {:>18,.0f}'.format(0, 4, '-', _run(0, 4)[1]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+"""
+Event-loop overhead of a coroutine with a timing probe injected by monki, versus the same probe written by hand.
+
+    python benchmarks/bench_coroutines.py
+"""
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import monki  # noqa: E402
+
+
+_CALLS = 20000
+_REPEATS = 5
+
+durations = []
+
+
+async def plain(value):
+    await asyncio.sleep(0)
+    return value * 2
+
+
+async def hand_written(value):
+    started = time.perf_counter()
+    try:
+        await asyncio.sleep(0)
+        return value * 2
+    finally:
+        durations.append(time.perf_counter() - started)
+
+
+async def patched(value):
+    await asyncio.sleep(0)
+    return value * 2
+
+
+monki.patch(patched, start='started = time.perf_counter()',
+            on_exit='durations.append(time.perf_counter() - started)')
+
+
+async def _run(coroutine_function):
+    for value in range(_CALLS):
+        await coroutine_function(value)
+
+
+def _best_time(coroutine_function):
+    best = float('inf')
+    for _ in range(_REPEATS):
+        started = time.perf_counter()
+        asyncio.run(_run(coroutine_function))
+        best = min(best, time.perf_counter() - started)
+        durations.clear()
+    return best
+
+
+def main():
+    print('{:>14} {:>12}'.format('coroutine', 'us per call'))
+    for coroutine_function in (plain, hand_written, patched):
+        elapsed = _best_time(coroutine_function)
+        print('{:>14} {:>12.2f}'.format(coroutine_function.__name__, elapsed / _CALLS * 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+"""
+Speedup of inlining small helpers into loop-heavy functions, compared with calling them.
+
+    python benchmarks/bench_inline.py
+"""
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from monki.enhancers import inline  # noqa: E402
+
+
+_NUMBER = 100
+_ROUNDS = 20
+_ITEMS = list(range(1000))
+_PAIRS = [(item, -item) for item in _ITEMS]
+
+LIMIT = 500
+
+
+def clamp(value, low=0):
+    return low if value < low else LIMIT if value > LIMIT else value
+
+
+def key_of(pair):
+    return pair[0] * 31 + pair[1]
+
+
+is_valid = lambda value: value is not None and value >= 0  # noqa: E731
+
+
+def clamp_loop(items):
+    total = 0
+    for item in items:
+        total += clamp(item)
+    return total
+
+
+def key_loop(pairs):
+    return [key_of(pair) for pair in pairs]
+
+
+def filter_loop(items):
+    return [item for item in items if is_valid(item - 100)]
+
+
+_CASES = [
+    ('clamp loop', clamp_loop, clamp, _ITEMS),
+    ('key loop', key_loop, key_of, _PAIRS),
+    ('filter loop', filter_loop, is_valid, _ITEMS),
+]
+
+
+def _copy_function(func):
+    return type(func)(func.__code__, func.__globals__, func.__name__, func.__defaults__, func.__closure__)
+
+
+def _best_times(funcs, argument):
+    """ The variants are timed in turns, so a noisy machine affects all of them alike. """
+    best = [float('inf')] * len(funcs)
+    for _ in range(_ROUNDS):
+        for index, func in enumerate(funcs):
+            best[index] = min(best[index], timeit.timeit(lambda: func(argument), number=_NUMBER) / _NUMBER)
+    return best
+
+
+def main():
+    print('{:>14} {:>10} {:>10} {:>9}'.format('us per call', 'calls', 'inlined', 'speedup'))
+    for name, func, helper, argument in _CASES:
+        inlined = inline(helper)(_copy_function(func))
+        assert inlined(argument) == func(argument)
+        called, inlined = _best_times([func, inlined], argument)
+        print('{:>14} {:>10.1f} {:>10.1f} {:>8.2f}x'.format(name, called * 1e6, inlined * 1e6, called / inlined))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+"""
+Per-call cost of memoize against functools.lru_cache, for cheap pure functions whose results are all cached.
+
+    python benchmarks/bench_memoize.py
+"""
+import functools
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from monki.enhancers import memoize  # noqa: E402
+
+
+_NUMBER = 200000
+_REPEATS = 5
+
+
+def one_argument(a):
+    return a * 2
+
+
+def two_arguments(a, b):
+    return a + b
+
+
+def keyword_arguments(a, b=1, **kwargs):
+    return a + b + len(kwargs)
+
+
+_CASES = [
+    ('1 argument', one_argument, lambda func: func(1)),
+    ('2 arguments', two_arguments, lambda func: func(1, 2)),
+    ('keywords', keyword_arguments, lambda func: func(1, b=2, c=3)),
+]
+
+
+def _copy_function(func):
+    copy = type(func)(func.__code__, func.__globals__, func.__name__, func.__defaults__, func.__closure__)
+    copy.__kwdefaults__ = func.__kwdefaults__
+    return copy
+
+
+def _best_call_time(func, call):
+    return min(timeit.repeat(lambda: call(func), number=_NUMBER, repeat=_REPEATS)) / _NUMBER
+
+
+def main():
+    print('{:>12} {:>10} {:>10} {:>10} {:>10} {:>10} {:>10}'.format(
+        'ns per call', 'uncached', 'lru', 'memoize', 'lru None', 'memo None', 'memo lock'))
+    for name, func, call in _CASES:
+        times = [
+            _best_call_time(func, call),
+            _best_call_time(functools.lru_cache(maxsize=128)(func), call),
+            _best_call_time(memoize(_copy_function(func)), call),
+            _best_call_time(functools.lru_cache(maxsize=None)(func), call),
+            _best_call_time(memoize(_copy_function(func), maxsize=None), call),
+            _best_call_time(memoize(_copy_function(func), thread_safe=True), call),
+        ]
+        print('{:>12} {:>10.1f} {:>10.1f} {:>10.1f} {:>10.1f} {:>10.1f} {:>10.1f}'.format(
+            name, *(time * 1e9 for time in times)))
+
+if __name__ == '__main__':
+    main()
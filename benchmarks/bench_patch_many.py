@@ -0,0 +1,75 @@
+"""
+Startup cost of patching N functions from a single file: a loop of `monki.patch` versus one `monki.patch_many`.
+
+    python benchmarks/bench_patch_many.py
+"""
+import importlib.util
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import monki  # noqa: E402
+
+
+_FUNCTION_TEMPLATE = '''
+def func_{index}(values):
+    total = 0
+    for value in values:
+        total += value * {index}
+    return total
+'''
+
+_FUNCTION_COUNTS = [1, 10, 50, 200, 500]
+_REPEATS = 5
+_SPEC = {'start': 'values = list(values)', 'end': 'pass'}
+
+
+def _write_module(directory, function_count):
+    path = os.path.join(directory, 'bench_module_{}.py'.format(function_count))
+    with open(path, 'w') as f:
+        f.write(''.join(_FUNCTION_TEMPLATE.format(index=index) for index in range(function_count)))
+    return path
+
+
+def _fresh_functions(path, function_count):
+    """ Executes the module again, so every repetition patches unpatched functions. """
+    spec = importlib.util.spec_from_file_location('bench_module', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return [getattr(module, 'func_{}'.format(index)) for index in range(function_count)]
+
+
+def _patch_one_by_one(funcs):
+    for func in funcs:
+        monki.patch(func, **_SPEC)
+
+
+def _patch_many(funcs):
+    monki.patch_many({func: _SPEC for func in funcs})
+
+
+def _best_time(path, function_count, patcher):
+    best = float('inf')
+    for _ in range(_REPEATS):
+        funcs = _fresh_functions(path, function_count)
+        started = time.perf_counter()
+        patcher(funcs)
+        best = min(best, time.perf_counter() - started)
+    return best
+
+
+def main():
+    print('{:>10} {:>16} {:>16} {:>10}'.format('functions', 'patch() ms', 'patch_many() ms', 'speedup'))
+    with tempfile.TemporaryDirectory() as directory:
+        for function_count in _FUNCTION_COUNTS:
+            path = _write_module(directory, function_count)
+            one_by_one = _best_time(path, function_count, _patch_one_by_one)
+            many = _best_time(path, function_count, _patch_many)
+            print('{:>10} {:>16.2f} {:>16.2f} {:>9.1f}x'.format(
+                function_count, one_by_one * 1000, many * 1000, one_by_one / many))
+
+
+if __name__ == '__main__':
+    main()
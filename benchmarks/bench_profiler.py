@@ -0,0 +1,82 @@
+"""
+Overhead of profile_lines, compared with cProfile and with a minimal sys.settrace line profiler.
+
+    python benchmarks/bench_profiler.py
+"""
+import cProfile
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import monki  # noqa: E402
+
+
+_CALLS = 20000
+_REPEATS = 5
+
+
+def work(items):
+    total = 0
+    for item in items:
+        total += item * item
+    squares = [item * item for item in items]
+    if total != sum(squares):
+        raise AssertionError()
+    return total
+
+
+def _run(func):
+    items = list(range(20))
+    started = time.perf_counter()
+    for _ in range(_CALLS):
+        func(items)
+    return time.perf_counter() - started
+
+
+def _best_time(func, enable=None, disable=None):
+    best = float('inf')
+    for _ in range(_REPEATS):
+        if enable is not None:
+            enable()
+        try:
+            best = min(best, _run(func))
+        finally:
+            if disable is not None:
+                disable()
+    return best
+
+
+def _line_tracer():
+    hits = {}
+
+    def trace_lines(frame, event, arg):
+        if event == 'line':
+            key = (frame.f_code, frame.f_lineno)
+            hits[key] = hits.get(key, 0) + 1
+        return trace_lines
+
+    def trace_calls(frame, event, arg):
+        return trace_lines
+
+    return trace_calls
+
+
+def main():
+    baseline = _best_time(work)
+    profiler = cProfile.Profile()
+    results = [
+        ('cProfile', _best_time(work, profiler.enable, profiler.disable)),
+        ('settrace', _best_time(work, lambda: sys.settrace(_line_tracer()), lambda: sys.settrace(None))),
+    ]
+    monki.profile_lines(work)
+    results.append(('profile_lines', _best_time(work)))
+
+    print('{:>14} {:>12} {:>10}'.format('', 'us per call', 'slowdown'))
+    print('{:>14} {:>12.2f} {:>10}'.format('unprofiled', baseline / _CALLS * 1e6, '1.00x'))
+    for name, duration in results:
+        print('{:>14} {:>12.2f} {:>9.2f}x'.format(name, duration / _CALLS * 1e6, duration / baseline))
+
+
+if __name__ == '__main__':
+    main()
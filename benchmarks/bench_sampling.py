@@ -0,0 +1,62 @@
+"""
+Overhead of `monki.autoinstrument` on the sampled program: the time of a CPU bound workload on its own, while the
+sampler runs at different intervals, and with the hottest function timed afterwards.
+
+    python benchmarks/bench_sampling.py
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import monki  # noqa: E402
+
+
+_ROUNDS = 15
+_INTERVALS = [0.01, 0.001]
+
+
+def hot(n):
+    total = 0
+    for i in range(n):
+        total += i * i
+    return total
+
+
+def workload():
+    for _ in range(200):
+        hot(2000)
+
+
+def _best_time(rounds=_ROUNDS):
+    best = float('inf')
+    for _ in range(rounds):
+        started = time.perf_counter()
+        workload()
+        best = min(best, time.perf_counter() - started)
+    return best
+
+
+def main():
+    _best_time()  # warm up, so the interpreter's specialization doesn't favor the later runs
+    baseline = _best_time()
+    print('{:>28} {:>10.2f} ms'.format('unsampled', baseline * 1000))
+    for interval in _INTERVALS:
+        monki.autoinstrument(__name__, duration=3600, interval=interval, wait=False)
+        sampled = _best_time()
+        monki.remove_autoinstrumentation()
+        print('{:>28} {:>10.2f} ms {:>+7.1%}'.format(
+            'sampling every {}ms'.format(interval * 1000), sampled * 1000, sampled / baseline - 1))
+
+    monki.autoinstrument(__name__, duration=0.2, top=1, wait=False)
+    while monki.autoinstrument_report().sampling:
+        workload()
+    probed = _best_time()
+    print('{:>28} {:>10.2f} ms {:>+7.1%}   ({})'.format(
+        'hottest function timed', probed * 1000, probed / baseline - 1,
+        ', '.join(monki.autoinstrument_report().probed)))
+    monki.remove_autoinstrumentation()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,46 @@
+"""
+Time to split a function's source into signature and body, with the regex and the ast engines,
+for signatures with 1 to 200 annotated parameters with defaults.
+
+    python benchmarks/bench_source_engines.py
+"""
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from monki import core  # noqa: E402
+
+
+_PARAMETER_COUNTS = [1, 10, 50, 100, 200]
+_NUMBER = 20
+
+
+def _make_source(parameter_count):
+    parameters = ',\n'.join('            p{0}: Dict[str, int] = {{"k{0}": {0}}}'.format(index)
+                            for index in range(parameter_count))
+    return ('    @decorator\n'
+            '    def func(\n{}\n    ):\n'
+            '        total = 0\n'
+            '        for value in (p0,):\n'
+            '            total += len(value)\n'
+            '        return total\n').format(parameters)
+
+
+def _time_engine(func_source, engine):
+    timer = timeit.Timer(lambda: core._parse_function_source(func_source, engine))
+    return min(timer.repeat(repeat=5, number=_NUMBER)) / _NUMBER
+
+
+def main():
+    print('{:>10} {:>12} {:>14} {:>10}'.format('params', 'regex us', 'ast us', 'ratio'))
+    for parameter_count in _PARAMETER_COUNTS:
+        func_source = _make_source(parameter_count)
+        regex = _time_engine(func_source, 'regex')
+        ast_time = _time_engine(func_source, 'ast')
+        print('{:>10} {:>12.1f} {:>14.1f} {:>9.2f}x'.format(
+            parameter_count, regex * 1e6, ast_time * 1e6, regex / ast_time))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+"""
+Speedup of specialize on a polymorphic function whose type checks decide most of its work,
+for calls with a single type and for calls which alternate between two types.
+
+    python benchmarks/bench_specialize.py
+"""
+import decimal
+import fractions
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from monki.enhancers import specialize, specialization_stats  # noqa: E402
+
+
+_NUMBER = 20
+_ROUNDS = 20
+_INTS = list(range(1000))
+_MIXED = [item if item % 2 else str(item) for item in range(1000)]
+
+
+def normalize(value, scale=1):
+    if isinstance(value, bool):
+        raise TypeError('Booleans aren\'t numbers.')
+    if isinstance(value, str):
+        value = float(value) if '.' in value else int(value)
+    elif isinstance(value, bytes):
+        value = int(value)
+    elif isinstance(value, (decimal.Decimal, fractions.Fraction)):
+        value = float(value)
+    if type(scale) is not int:
+        raise TypeError('The scale must be an int.')
+    return value * scale
+
+
+def loop(func, values):
+    for value in values:
+        func(value)
+
+
+_CASES = [('one type', _INTS), ('two types', _MIXED)]
+
+
+def _copy_function(func):
+    return type(func)(func.__code__, func.__globals__, func.__name__, func.__defaults__, func.__closure__)
+
+
+def _best_times(funcs, argument):
+    """ The variants are timed in turns, so a noisy machine affects all of them alike. """
+    best = [float('inf')] * len(funcs)
+    for _ in range(_ROUNDS):
+        for index, func in enumerate(funcs):
+            best[index] = min(best[index], timeit.timeit(lambda: loop(func, argument), number=_NUMBER) / _NUMBER)
+    return best
+
+
+def main():
+    print('{:>14} {:>10} {:>12} {:>9} {:>9}'.format('us per 1000', 'generic', 'specialized', 'speedup', 'hit rate'))
+    for name, values in _CASES:
+        specialized = specialize(_copy_function(normalize), warmup=100)
+        loop(specialized, values)
+        generic, special = _best_times([normalize, specialized], values)
+        print('{:>14} {:>10.1f} {:>12.1f} {:>8.2f}x {:>9.3f}'.format(
+            name, generic * 1e6, special * 1e6, generic / special, specialization_stats(specialized).hit_rate))
+
+
+if __name__ == '__main__':
+    main()
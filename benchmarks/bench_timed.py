@@ -0,0 +1,59 @@
+"""
+Per-call overhead of the timed enhancer, with and without sampling, compared with a timing wrapper.
+
+    python benchmarks/bench_timed.py
+"""
+import bisect
+import functools
+import os
+import sys
+import time
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from monki.enhancers import timed  # noqa: E402
+
+
+_NUMBER = 200000
+_REPEATS = 5
+
+
+def handler(a, b):
+    return a + b
+
+
+def _copy_function(func):
+    return type(func)(func.__code__, func.__globals__, func.__name__, func.__defaults__, func.__closure__)
+
+
+def _timing_wrapper(func):
+    bounds = [2 ** exponent for exponent in range(10, 37)]
+    counts = [0] * (len(bounds) + 1)
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        started = time.perf_counter_ns()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            counts[bisect.bisect_left(bounds, time.perf_counter_ns() - started)] += 1
+    return wrapper
+
+
+def _best_call_time(func):
+    return min(timeit.repeat(lambda: func(1, 2), number=_NUMBER, repeat=_REPEATS)) / _NUMBER
+
+
+def main():
+    cases = [
+        ('untimed', handler),
+        ('wrapper', _timing_wrapper(handler)),
+        ('timed', timed(_copy_function(handler))),
+        ('timed 1/100', timed(_copy_function(handler), sample=100)),
+    ]
+    for name, func in cases:
+        print('{:>12} {:>8.1f} ns'.format(name, _best_call_time(func) * 1e9))
+
+
+if __name__ == '__main__':
+    main()
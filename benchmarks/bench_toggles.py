@@ -0,0 +1,66 @@
+"""
+Cost of switching a toggle group of N functions on and off, and the per-call cost of a disabled patch.
+
+    python benchmarks/bench_toggles.py
+"""
+import importlib.util
+import os
+import sys
+import tempfile
+import time
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import monki  # noqa: E402
+
+
+_FUNCTION_TEMPLATE = '''
+def func_{index}(value):
+    return value * {index}
+'''
+
+_FUNCTION_COUNTS = [1, 100, 1000]
+_REPEATS = 20
+_SPEC = {'start': 'value = int(value)'}
+
+
+def _load_functions(directory, function_count):
+    path = os.path.join(directory, 'bench_toggle_module_{}.py'.format(function_count))
+    with open(path, 'w') as f:
+        f.write(''.join(_FUNCTION_TEMPLATE.format(index=index) for index in range(function_count)))
+    spec = importlib.util.spec_from_file_location('bench_toggle_module_{}'.format(function_count), path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return [getattr(module, 'func_{}'.format(index)) for index in range(function_count)]
+
+
+def _best_switch_time(toggle):
+    best = float('inf')
+    for _ in range(_REPEATS):
+        started = time.perf_counter()
+        monki.disable(toggle)
+        monki.enable(toggle)
+        best = min(best, (time.perf_counter() - started) / 2)
+    return best
+
+
+def main():
+    print('{:>10} {:>16}'.format('functions', 'switch us'))
+    with tempfile.TemporaryDirectory() as directory:
+        for function_count in _FUNCTION_COUNTS:
+            funcs = _load_functions(directory, function_count)
+            toggle = 'bench_{}'.format(function_count)
+            monki.patch_many({func: _SPEC for func in funcs}, toggle=toggle)
+            print('{:>10} {:>16.1f}'.format(function_count, _best_switch_time(toggle) * 1e6))
+
+        func = _load_functions(directory, 1)[0]
+        unpatched = min(timeit.repeat(lambda: func(1), number=100000, repeat=5))
+        monki.patch(func, toggle='bench_call', **_SPEC)
+        monki.disable('bench_call')
+        disabled = min(timeit.repeat(lambda: func(1), number=100000, repeat=5))
+        print()
+        print('per call: unpatched {:.1f} ns, disabled {:.1f} ns'.format(unpatched * 1e4, disabled * 1e4))
+
+
+if __name__ == '__main__':
+    main()
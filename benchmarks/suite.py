@@ -0,0 +1,311 @@
+"""
+The benchmark suite: the latency of patching, the overhead of patched calls and the overhead of every enhancer.
+Results are written as JSON, and can be compared against a stored baseline, failing on regressions.
+
+    python benchmarks/suite.py                                   # print the results
+    python benchmarks/suite.py --output results.json             # and store them
+    python benchmarks/suite.py --baseline results.json           # and compare them to stored results
+    python benchmarks/suite.py --quick --only call               # fewer rounds, only the benchmarks in a group
+
+Every result is the best time of a number of rounds, in nanoseconds per operation. The variants of a comparison
+are timed in turns, so a noisy machine affects all of them alike. The exit code is 1 if a result is slower than
+the baseline by more than the threshold (a ratio, 1.25 by default).
+"""
+import argparse
+import functools
+import importlib.util
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import monki  # noqa: E402
+from monki import enhancers  # noqa: E402
+
+
+_FORMAT_VERSION = 1
+_DEFAULT_THRESHOLD = 1.25
+_FUNCTION_SIZES = (5, 50, 500)
+
+_SIZED_FUNCTION_TEMPLATE = '''
+def func_{size}(value):
+{body}
+    return value
+'''
+
+_CLOSURE_AND_METHOD_SOURCE = '''
+def make_closure():
+    factor = 2
+
+    def closure(value):
+        value = value * factor
+        return value
+
+    return closure
+
+
+class Class:
+    def method(self, value):
+        value = value * 2
+        return value
+'''
+
+
+class _Runner:
+    def __init__(self, rounds, only):
+        self.rounds = rounds
+        self.only = only
+        self.results = {}
+
+    def enabled(self, group):
+        return self.only is None or group in self.only
+
+    def record(self, group, name, ns):
+        self.results['{}/{}'.format(group, name)] = ns
+        print('{:>44} {:>12.1f} ns'.format('{}/{}'.format(group, name), ns))
+
+    def time_calls(self, group, variants, number):
+        """ Times every (name, callable) in turns, and records the best time of each per call. """
+        best = {name: float('inf') for name, _ in variants}
+        for _ in range(self.rounds):
+            for name, call in variants:
+                best[name] = min(best[name], timeit.timeit(call, number=number) / number * 1e9)
+        for name, _ in variants:
+            self.record(group, name, best[name])
+
+    def time_patching(self, group, name, make_function, spec):
+        """ Records the best time of patching a fresh function. Unpatching isn't timed. """
+        best = float('inf')
+        for _ in range(self.rounds * 5):
+            func = make_function()
+            started = time.perf_counter_ns()
+            monki.patch(func, **spec)
+            best = min(best, time.perf_counter_ns() - started)
+            monki.unpatch(func)
+        self.record(group, name, best)
+
+
+def _load_module(directory, name, text):
+    path = os.path.join(directory, name + '.py')
+    with open(path, 'w') as f:
+        f.write(text)
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def _copy_function(func):
+    """ A copy to enhance, which keeps everything the enhancers read (e.g. the annotations for typecheck). """
+    copy = type(func)(func.__code__, func.__globals__, func.__name__, func.__defaults__, func.__closure__)
+    copy.__annotations__ = dict(func.__annotations__)
+    copy.__kwdefaults__ = func.__kwdefaults__
+    copy.__qualname__ = func.__qualname__
+    copy.__dict__.update(func.__dict__)
+    return copy
+
+
+def bench_patch(runner, directory):
+    sized = _load_module(directory, 'monki_bench_sized', ''.join(
+        _SIZED_FUNCTION_TEMPLATE.format(size=size, body='\n'.join(
+            '    value = value + {}'.format(line) for line in range(size - 2)))
+        for size in _FUNCTION_SIZES))
+    others = _load_module(directory, 'monki_bench_others', _CLOSURE_AND_METHOD_SOURCE)
+    spec = {'start': 'value = value * 1', 'end': 'value = value - 1'}
+
+    for size in _FUNCTION_SIZES:
+        func = getattr(sized, 'func_{}'.format(size))
+        runner.time_patching('patch', '{} lines'.format(size), functools.partial(_copy_function, func), spec)
+    runner.time_patching('patch', 'closure', others.make_closure, spec)
+    runner.time_patching('patch', 'method', lambda: _copy_function(others.Class.method), spec)
+    runner.time_patching('patch', 'indent_inner', functools.partial(_copy_function, sized.func_5),
+                         {'start': 'for _ in range(1):', 'indent_inner': True})
+
+
+def plain(value):
+    value = value + 1
+    return value
+
+
+def with_wrapper(func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        calls[0] += 1
+        try:
+            return func(*args, **kwargs)
+        finally:
+            calls[1] += 1
+    return wrapper
+
+
+calls = [0, 0]
+
+
+def bench_call(runner):
+    patched_start = _copy_function(plain)
+    monki.patch(patched_start, start='calls[0] += 1')
+    patched_start_end = _copy_function(plain)
+    monki.patch(patched_start_end, start='calls[0] += 1', end='calls[1] += 1')
+    patched_on_exit = _copy_function(plain)
+    monki.patch(patched_on_exit, start='calls[0] += 1', on_exit='calls[1] += 1')
+    patched_indent_inner = _copy_function(plain)
+    monki.patch(patched_indent_inner, start='for _ in range(1):', indent_inner=True)
+    wrapped = with_wrapper(plain)
+
+    runner.time_calls('call', [
+        ('unpatched', lambda: plain(1)),
+        ('start', lambda: patched_start(1)),
+        ('start+end', lambda: patched_start_end(1)),
+        ('start+on_exit', lambda: patched_on_exit(1)),
+        ('indent_inner', lambda: patched_indent_inner(1)),
+        ('decorator wrapper', lambda: wrapped(1)),
+    ], number=100000)
+
+
+def annotated(value: int, name: str) -> int:
+    return value + len(name)
+
+
+def uses_globals(values):
+    total = 0
+    for value in values:
+        total += abs(value) + len(str(value))
+    return total
+
+
+def clamp(value):
+    return value if value < 500 else 500
+
+
+def uses_helper(values):
+    total = 0
+    for value in values:
+        total += clamp(value)
+    return total
+
+
+def checks_types(value):
+    if isinstance(value, str):
+        value = int(value)
+    elif isinstance(value, (list, tuple)):
+        return len(value)
+    return value * 2
+
+
+def fails(value):
+    raise KeyError(value)
+
+
+def bench_enhancers(runner):
+    values = list(range(100))
+    typechecked = enhancers.typecheck(_copy_function(annotated))
+    try:
+        typechecked(1.5, 'a')  # the body accepts a float, so only the check rejects it
+    except TypeError:
+        pass
+    else:
+        raise AssertionError('The typechecked function doesn\'t check its arguments.')
+    memoized = enhancers.memoize(_copy_function(annotated))
+    timed = enhancers.timed(_copy_function(annotated))
+    sampled = enhancers.timed(_copy_function(annotated), sample=64)
+    bound = enhancers.bind_globals(_copy_function(uses_globals))
+    inlined = enhancers.inline(clamp)(_copy_function(uses_helper))
+    specialized = enhancers.specialize(_copy_function(checks_types), warmup=10)
+    for value in range(10):
+        specialized(value)
+    ignoring = enhancers.ignoreerror(KeyError)(_copy_function(fails))
+    profiled = monki.profile_lines(_copy_function(annotated))
+
+    try:
+        runner.time_calls('enhancers', [
+            ('plain', lambda: annotated(1, 'a')),
+            ('typecheck', lambda: typechecked(1, 'a')),
+            ('memoize hit', lambda: memoized(1, 'a')),
+            ('timed', lambda: timed(1, 'a')),
+            ('timed sample=64', lambda: sampled(1, 'a')),
+            ('profile_lines', lambda: profiled(1, 'a')),
+        ], number=50000)
+        runner.time_calls('enhancers', [
+            ('plain loop', lambda: uses_globals(values)),
+            ('bind_globals loop', lambda: bound(values)),
+            ('plain helper loop', lambda: uses_helper(values)),
+            ('inline helper loop', lambda: inlined(values)),
+        ], number=1000)
+        runner.time_calls('enhancers', [
+            ('plain type checks', lambda: checks_types(1)),
+            ('specialize', lambda: specialized(1)),
+            ('plain raise', lambda: _ignore(fails, 1)),
+            ('ignoreerror', lambda: ignoring(1)),
+        ], number=50000)
+    finally:
+        enhancers.reset_latencies()
+
+
+def _ignore(func, value):
+    try:
+        func(value)
+    except KeyError:
+        pass
+
+
+def compare(results, baseline, threshold):
+    """ Returns the names of the results which are slower than the baseline by more than the threshold. """
+    regressions = []
+    print('\n{:>44} {:>12} {:>12} {:>8}'.format('compared to the baseline', 'baseline', 'now', 'ratio'))
+    for name, ns in results.items():
+        if name not in baseline:
+            continue
+        ratio = ns / baseline[name]
+        mark = '  REGRESSION' if ratio > threshold else ''
+        print('{:>44} {:>12.1f} {:>12.1f} {:>8.2f}{}'.format(name, baseline[name], ns, ratio, mark))
+        if ratio > threshold:
+            regressions.append(name)
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--output', help='Write the results to this JSON file.')
+    parser.add_argument('--baseline', help='Compare the results to this JSON file of stored results.')
+    parser.add_argument('--threshold', type=float, default=_DEFAULT_THRESHOLD,
+                        help='The ratio to the baseline above which a result is a regression.')
+    parser.add_argument('--rounds', type=int, default=10, help='The number of rounds to take the best time of.')
+    parser.add_argument('--quick', action='store_true', help='Run 2 rounds, for checking that everything runs.')
+    parser.add_argument('--only', action='append', choices=['patch', 'call', 'enhancers'],
+                        help='Run only the benchmarks of this group. Can be given more than once.')
+    args = parser.parse_args(argv)
+
+    monki.disable_cache()
+    runner = _Runner(2 if args.quick else args.rounds, args.only)
+    if runner.enabled('patch'):
+        with tempfile.TemporaryDirectory() as directory:
+            bench_patch(runner, directory)
+    if runner.enabled('call'):
+        bench_call(runner)
+    if runner.enabled('enhancers'):
+        bench_enhancers(runner)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'format_version': _FORMAT_VERSION,
+                       'python': platform.python_version(),
+                       'implementation': platform.python_implementation(),
+                       'results': runner.results}, f, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get('python') != platform.python_version():
+            print('The baseline is from Python {}, so the comparison may be off.'.format(baseline.get('python')))
+        regressions = compare(runner.results, baseline['results'], args.threshold)
+        if regressions:
+            print('\n{} regression(s): {}'.format(len(regressions), ', '.join(regressions)))
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1 +1,9 @@
-from .core import patch
+from .core import patch, patch_many, patch_module, unpatch, unpatch_all, enable, disable
+from .core import force_lazy_patches, pending_lazy_patches
+from .cache import enable_cache, disable_cache, cache_stats, reset_cache_stats
+from .importhook import install_import_hook, uninstall_import_hook
+from .profiler import profile_lines, line_stats
+from .shm import create_shared_counters, probe, shared_counts, remove_shared_counters
+from .instrumentation import stats, enable_stats, disable_stats, reset_stats
+from .bundle import compile_manifest, apply_bundle
+from .sampling import autoinstrument, autoinstrument_report, remove_autoinstrumentation
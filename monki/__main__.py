@@ -0,0 +1,53 @@
+"""
+Command line tools.
+
+    python -m monki stats PATH          Print the shared counters in PATH, summed over all of the processes.
+    python -m monki compile MANIFEST    Compile the patches of a JSON or TOML manifest into a bundle.
+"""
+import argparse
+import sys
+
+from . import bundle
+from . import shm
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m monki')
+    commands = parser.add_subparsers(dest='command', required=True)
+    stats_parser = commands.add_parser('stats', help='print the shared counters, summed over all of the processes')
+    stats_parser.add_argument('path', help='the file of the shared counters')
+    compile_parser = commands.add_parser('compile', help='compile the patches of a manifest into a bundle')
+    compile_parser.add_argument('manifest', help='the JSON or TOML manifest')
+    compile_parser.add_argument('-o', '--output', help='the bundle file, by default next to the manifest')
+    compile_parser.add_argument('--processes', type=int, help='the number of processes to compile in')
+    args = parser.parse_args(argv)
+
+    if args.command == 'stats':
+        return _print_stats(args.path)
+    if args.command == 'compile':
+        return _compile(args.manifest, args.output, args.processes)
+
+
+def _print_stats(path):
+    try:
+        counts = shm.read_shared_counters(path)
+    except (OSError, ValueError) as e:
+        print('Can\'t read {}: {}'.format(path, e), file=sys.stderr)
+        return 1
+    for name, count in sorted(counts.items()):
+        print('{:>14} {}'.format(count, name))
+    return 0
+
+
+def _compile(manifest_path, bundle_path, processes):
+    try:
+        bundle_path = bundle.compile_manifest(manifest_path, bundle_path, processes)
+    except (OSError, ValueError, ImportError, AttributeError, TypeError) as e:
+        print('Can\'t compile {}: {}'.format(manifest_path, e), file=sys.stderr)
+        return 1
+    print(bundle_path)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,195 @@
+"""
+Precompiled bundles of patches, for deployments which start many worker processes.
+
+A manifest declares the patches, as a JSON or TOML file of module name => qualified name => spec, where each spec
+is a dict of keyword arguments to `patch` (only `start`, `end`, `insert_lines`, `indent_lines`, `indent_inner`,
+`engine`, `on_exit` and `on_return`, since the manifest can only hold text):
+
+    {"package.module": {"SomeClass.some_method": {"start": "print('Starting')", "insert_lines": {"2": "x += 1"}}}}
+
+`compile_manifest` (or ``python -m monki compile MANIFEST``) imports the modules, patches the functions' sources
+and compiles them into a bundle file of code objects, in a pool of processes when the manifest is large.
+`apply_bundle` then installs the whole bundle with a single read of the file: it doesn't read or compile any
+source. A function whose code changed since the bundle was compiled is stale, and is patched from its source
+instead (or left alone), so a bundle never applies a patch to code it wasn't compiled for.
+
+The bundle also keeps the original source of every function, compressed, so a function applied from a bundle can
+be patched again (or have its patch undone) where its source file isn't deployed.
+"""
+import collections
+import concurrent.futures
+import hashlib
+import importlib
+import importlib.util
+import json
+import marshal
+import os
+import zlib
+from types import CodeType
+
+from . import core
+from . import instrumentation
+from . import lazy as lazy_patching
+from . import registry
+from . import source
+
+
+_FORMAT_VERSION = 3
+_MAGIC = importlib.util.MAGIC_NUMBER + b'monki-bundle' + bytes([_FORMAT_VERSION])
+_SPEC_KEYS = ('start', 'end', 'insert_lines', 'indent_lines', 'indent_inner', 'engine', 'on_exit', 'on_return')
+_PARALLEL_TARGET_COUNT = 200  # smaller manifests are compiled in this process, which is faster than starting a pool
+
+BundleReport = collections.namedtuple('BundleReport', ['applied', 'stale', 'compiled'])
+BundleReport.__doc__ = """
+The targets of a bundle, as 'module:qualified_name' strings: the ones which were applied from the bundle,
+the ones which were stale, and the stale ones which were patched from their source instead.
+"""
+
+# one target of a bundle. `digest` is the digest of the code the function had when the bundle was compiled,
+# and `source` is its source, compressed with zlib
+_BundleEntry = collections.namedtuple('BundleEntry', ['module', 'qualname', 'spec', 'digest', 'code', 'source'])
+
+
+def load_manifest(path):
+    """ Returns the specs of a JSON or TOML manifest, as a dict of module name => {qualified name => spec}. """
+    if path.endswith('.toml'):
+        try:
+            import tomllib
+        except ImportError:  # python < 3.11
+            raise ValueError('TOML manifests require Python 3.11 or later.') from None
+        with open(path, 'rb') as f:
+            manifest = tomllib.load(f)
+    else:
+        with open(path) as f:
+            manifest = json.load(f)
+
+    if not isinstance(manifest, dict) or not all(isinstance(specs, dict) for specs in manifest.values()):
+        raise ValueError('A manifest must map module names to dicts of qualified name => spec.')
+    return {module_name: {qualname: _normalize_spec(module_name, qualname, spec) for qualname, spec in specs.items()}
+            for module_name, specs in manifest.items()}
+
+
+def _normalize_spec(module_name, qualname, spec):
+    unknown = set(spec) - set(_SPEC_KEYS)
+    if unknown:
+        raise ValueError('The spec of {}:{} has unsupported keys: {}.'.format(
+            module_name, qualname, ', '.join(sorted(unknown))))
+    spec = dict(spec)
+    # JSON and TOML keys are always strings
+    if 'insert_lines' in spec:
+        spec['insert_lines'] = {int(line): code for line, code in spec['insert_lines'].items()}
+    if isinstance(spec.get('indent_lines'), dict):
+        spec['indent_lines'] = {int(line): level for line, level in spec['indent_lines'].items()}
+    core._make_spec(**spec)  # validates it
+    return spec
+
+
+def compile_manifest(manifest_path, bundle_path=None, processes=None):
+    """
+    Compile the patches of a manifest into a bundle file for `apply_bundle`.
+    The modules of the manifest are imported, so they must be importable.
+
+    :param bundle_path: Where to write the bundle. Defaults to the manifest's path with a '.bundle' extension.
+    :param processes:
+        The number of processes to compile the modules in. By default, manifests with many targets are compiled
+        in a pool of processes, and small ones in this process.
+    :returns: The path of the bundle.
+    """
+    manifest = load_manifest(manifest_path)
+    if bundle_path is None:
+        bundle_path = os.path.splitext(manifest_path)[0] + '.bundle'
+
+    target_count = sum(len(specs) for specs in manifest.values())
+    if processes is None:
+        processes = os.cpu_count() if target_count >= _PARALLEL_TARGET_COUNT else 1
+    if processes > 1 and len(manifest) > 1:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=processes) as pool:
+            compiled = list(pool.map(_compile_module, manifest.keys(), manifest.values()))
+    else:
+        compiled = [_compile_module(module_name, specs) for module_name, specs in manifest.items()]
+
+    entries = [entry for data in compiled for entry in marshal.loads(data)]
+    tmp_path = '{}.{}.tmp'.format(bundle_path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+        f.write(_MAGIC + marshal.dumps(entries))
+    os.replace(tmp_path, bundle_path)  # atomic, so workers never load a partial bundle
+    return bundle_path
+
+
+def _compile_module(module_name, specs):
+    """ Compiles the patched functions of a module. Returns the marshalled entries, since code can't be pickled. """
+    module = importlib.import_module(module_name)
+    funcs = {qualname: core._resolve_qualname(module, qualname) for qualname in specs}
+    for func in funcs.values():
+        lazy_patching.resolve(func)
+        if registry.is_patched(func):
+            raise ValueError('{}:{} is already patched, so it can\'t be compiled into a bundle.'.format(
+                module_name, func.__qualname__))
+    func_sources = source.get_function_sources(list(funcs.values()))
+
+    modified_sources = []
+    for qualname, func in funcs.items():
+        spec = core._make_spec(**specs[qualname])
+        signature, body = core._modify_source_parts(
+            func_sources[func], spec.start, spec.end, dict(spec.insert_lines), spec.indent_inner, spec.indent_lines,
+            spec.engine, spec.on_exit, spec.on_return)
+        modified_sources.append((func, core._declare_free_variables(func, signature, body)))
+    codes = core._compile_modified_codes(modified_sources)
+
+    return marshal.dumps([(module_name, qualname, specs[qualname], _code_digest(func.__code__), code,
+                           zlib.compress(func_sources[func].encode('utf-8')))
+                          for (qualname, func), code in zip(funcs.items(), codes)])
+
+
+def apply_bundle(bundle_path, fallback=True):
+    """
+    Apply all of the patches of a bundle made by `compile_manifest`, e.g. in the initializer of every worker.
+    The modules of the bundle are imported.
+
+    :param fallback:
+        Patch the stale functions (whose code changed since the bundle was compiled) from their source.
+        If False, they're left unpatched.
+    :returns: A BundleReport.
+    """
+    with open(bundle_path, 'rb') as f:
+        data = f.read()
+    if not data.startswith(_MAGIC):
+        raise ValueError('{} is not a monki bundle, or was compiled by another Python version.'.format(bundle_path))
+    entries = [_BundleEntry(*entry) for entry in marshal.loads(data[len(_MAGIC):])]
+
+    applied, stale, compiled = [], [], []
+    for entry in entries:
+        name = '{}:{}'.format(entry.module, entry.qualname)
+        func = core._resolve_qualname(importlib.import_module(entry.module), entry.qualname)
+        with registry.lock_for(func):
+            lazy_patching.resolve(func)
+            if registry.is_patched(func) or _code_digest(func.__code__) != entry.digest:
+                stale.append(name)
+                if fallback:
+                    core.patch(func, **entry.spec)
+                    compiled.append(name)
+                continue
+
+            core._validate_code_fits_function(func, entry.code)
+            with instrumentation.phase('swap', [func]):
+                registry.push(func, func.__code__, core._make_spec(**entry.spec), None, entry.source)
+                func.__code__ = entry.code
+            instrumentation.record_patch(func, entry.code, 0)
+            applied.append(name)
+    return BundleReport(applied, stale, compiled)
+
+
+def _code_digest(code):
+    """ A digest of a code object which is the same in every process, unlike its marshalled bytes. """
+    digest = hashlib.sha256()
+    digest.update(repr((code.co_code, code.co_names, code.co_varnames, code.co_freevars, code.co_cellvars,
+                        code.co_argcount, code.co_posonlyargcount, code.co_kwonlyargcount, code.co_flags,
+                        code.co_firstlineno, code.co_filename)).encode('utf-8'))
+    for const in code.co_consts:
+        if isinstance(const, CodeType):
+            digest.update(_code_digest(const).encode('ascii'))
+        elif isinstance(const, frozenset):  # the order of a set depends on the process' hash seed
+            digest.update(repr(sorted(map(repr, const))).encode('utf-8'))
+        else:
+            digest.update(repr(const).encode('utf-8'))
+    return digest.hexdigest()
@@ -0,0 +1,563 @@
+"""
+Source-free patching, by splicing compiled snippets directly into a function's bytecode.
+
+The original function is never re-parsed or recompiled: only the injected snippets are compiled,
+each in a scope that mirrors the original function's locals, cells and free variables.
+Their instructions are then remapped to the original code object's constants, names and locals,
+and inserted at the right offsets. Jumps, the exception table, the line table and the stack size
+are recomputed when the code object is reassembled.
+
+Bytecode is specific to the interpreter version; this module supports CPython 3.11.
+"""
+import collections
+import dis
+import inspect
+import opcode
+import sys
+
+
+_SUPPORTED_VERSION = (3, 11)
+
+
+def is_supported():
+    return sys.implementation.name == 'cpython' and sys.version_info[:2] == _SUPPORTED_VERSION
+
+
+# the opcodes change between versions (some of these don't exist before 3.11), so they're only looked up where
+# bytecode patching is supported, and the module can be imported anywhere
+if is_supported():
+    _EXTENDED_ARG = opcode.opmap['EXTENDED_ARG']
+    _RESUME = opcode.opmap['RESUME']
+    _RETURN_VALUE = opcode.opmap['RETURN_VALUE']
+    _LOAD_GLOBAL = opcode.opmap['LOAD_GLOBAL']
+    _RETURN_GENERATOR = opcode.opmap['RETURN_GENERATOR']
+    _NO_FALLTHROUGH_OPCODES = {opcode.opmap[name] for name in
+                               ('JUMP_FORWARD', 'JUMP_BACKWARD', 'JUMP_BACKWARD_NO_INTERRUPT',
+                                'RETURN_VALUE', 'RERAISE', 'RAISE_VARARGS')}
+    _LOCAL_OPCODES = set(dis.haslocal) | set(dis.hasfree)
+    _JUMP_OPCODES = set(dis.hasjrel)
+
+    # jumps are relative in 3.11, so a jump whose target ends up on the other side must change direction
+    _FORWARD_TO_BACKWARD = {}
+    for _name in opcode.opname:
+        if 'FORWARD' in _name and _name.replace('FORWARD', 'BACKWARD') in opcode.opmap:
+            _FORWARD_TO_BACKWARD[opcode.opmap[_name]] = opcode.opmap[_name.replace('FORWARD', 'BACKWARD')]
+    _BACKWARD_TO_FORWARD = {backward: forward for forward, backward in _FORWARD_TO_BACKWARD.items()}
+    _BACKWARD_OPCODES = {op for op in _JUMP_OPCODES if 'BACKWARD' in opcode.opname[op]}
+
+_SNIPPET_END = '__monki_snippet_end__'
+_SNIPPET_NAME = '__monki_snippet__'
+_SCOPE_NAME = '__monki_scope__'
+
+
+def _check_supported():
+    if not is_supported():
+        raise NotImplementedError('Bytecode patching is only supported on CPython {}.{}.'.format(*_SUPPORTED_VERSION))
+
+
+class Instruction:
+    """
+    A single instruction, without its EXTENDED_ARG prefixes and inline caches.
+    Jump targets and exception handlers refer to other Instruction objects rather than to offsets.
+    """
+
+    __slots__ = ('opcode', 'arg', 'positions', 'target', 'handler')
+
+    def __init__(self, opcode, arg=0, positions=None, target=None, handler=None):
+        self.opcode = opcode
+        self.arg = arg
+        self.positions = positions
+        self.target = target
+        self.handler = handler
+
+    @property
+    def opname(self):
+        return opcode.opname[self.opcode]
+
+    @property
+    def lineno(self):
+        return self.positions[0] if self.positions is not None else None
+
+    def __repr__(self):
+        return '<Instruction {} {}>'.format(self.opname, self.arg)
+
+
+# the target is an Instruction; depth and lasti are the same as in the code object's exception table
+Handler = collections.namedtuple('Handler', ['target', 'depth', 'lasti'])
+
+
+def disassemble(code):
+    """ Returns the code object's instructions as a list of Instruction objects. """
+    _check_supported()
+    raw = code.co_code
+    positions = list(code.co_positions())
+
+    instructions = []
+    by_offset = {}  # code unit offset => the instruction that starts there (including its EXTENDED_ARGs)
+    jump_offsets = {}
+    unit = 0
+    arg = 0
+    start_unit = 0
+    while unit < len(raw) // 2:
+        op, oparg = raw[unit * 2], raw[unit * 2 + 1]
+        if op == _EXTENDED_ARG:
+            arg = (arg | oparg) << 8
+            unit += 1
+            continue
+
+        arg |= oparg
+        position = positions[unit]
+        instruction = Instruction(op, arg, position if position[0] is not None else None)
+        instructions.append(instruction)
+        by_offset[start_unit] = instruction
+
+        end_unit = unit + 1 + opcode._inline_cache_entries[op]
+        if op in _JUMP_OPCODES:
+            jump_offsets[instruction] = end_unit - arg if op in _BACKWARD_OPCODES else end_unit + arg
+
+        unit = start_unit = end_unit
+        arg = 0
+
+    for instruction, offset in jump_offsets.items():
+        instruction.target = by_offset[offset]
+
+    offsets = sorted(by_offset)
+    for start, end, target, depth, lasti in _parse_exception_table(code.co_exceptiontable):
+        handler = Handler(by_offset[target], depth, lasti)
+        for offset in offsets:
+            if start <= offset < end:
+                by_offset[offset].handler = handler
+
+    return instructions
+
+
+def assemble(code, instructions, **replacements):
+    """
+    Returns a copy of the code object with the given instructions.
+    The bytecode, line table, exception table and stack size are computed from the instructions.
+    Any other attribute can be replaced with keyword arguments, as in CodeType.replace.
+    """
+    _check_supported()
+    sizes = _compute_sizes(instructions)
+    offsets = _compute_offsets(sizes)
+    co_code = _encode_instructions(instructions, sizes)
+    first_lineno = replacements.get('co_firstlineno', code.co_firstlineno)
+
+    return code.replace(co_code=co_code,
+                        co_linetable=_encode_line_table(instructions, sizes, first_lineno),
+                        co_exceptiontable=_encode_exception_table(instructions, sizes, offsets),
+                        co_stacksize=max(compute_stack_depths(instructions).max_depth, 1),
+                        **replacements)
+
+
+def _compute_sizes(instructions):
+    """
+    Returns the size of every instruction in code units, and sets the arguments (and directions) of jumps.
+    Jump distances depend on sizes, which depend on jump distances (through EXTENDED_ARGs),
+    so this repeats until nothing changes. Sizes only grow, so it always ends.
+    """
+    sizes = [_instruction_size(instruction.opcode, instruction.arg) for instruction in instructions]
+    index_of = {instruction: index for index, instruction in enumerate(instructions)}
+    while True:
+        offsets = _compute_offsets(sizes)
+        changed = False
+        for index, instruction in enumerate(instructions):
+            if instruction.target is None:
+                continue
+            _set_jump_arg(instruction, offsets[index] + sizes[index], offsets[index_of[instruction.target]])
+            size = _instruction_size(instruction.opcode, instruction.arg)
+            if size > sizes[index]:
+                sizes[index] = size
+                changed = True
+        if not changed:
+            return sizes
+
+
+def _compute_offsets(sizes):
+    offsets = []
+    unit = 0
+    for size in sizes:
+        offsets.append(unit)
+        unit += size
+    return offsets
+
+
+def _instruction_size(op, arg):
+    extended_args = 0
+    while arg > 0xFF:
+        arg >>= 8
+        extended_args += 1
+    return extended_args + 1 + opcode._inline_cache_entries[op]
+
+
+def _set_jump_arg(instruction, end_unit, target_unit):
+    forward = target_unit >= end_unit
+    if forward and instruction.opcode in _BACKWARD_OPCODES:
+        if instruction.opcode not in _BACKWARD_TO_FORWARD:
+            raise ValueError('Can\'t turn {} into a forward jump.'.format(instruction.opname))
+        instruction.opcode = _BACKWARD_TO_FORWARD[instruction.opcode]
+    elif not forward and instruction.opcode not in _BACKWARD_OPCODES:
+        if instruction.opcode not in _FORWARD_TO_BACKWARD:
+            raise ValueError('Can\'t turn {} into a backward jump.'.format(instruction.opname))
+        instruction.opcode = _FORWARD_TO_BACKWARD[instruction.opcode]
+    instruction.arg = target_unit - end_unit if forward else end_unit - target_unit
+
+
+def _encode_instructions(instructions, sizes):
+    co_code = bytearray()
+    for instruction, size in zip(instructions, sizes):
+        caches = opcode._inline_cache_entries[instruction.opcode]
+        extended_args = size - 1 - caches  # may be more than the argument needs, in which case they are zeros
+        for shift in range(extended_args, 0, -1):
+            co_code += bytes([_EXTENDED_ARG, (instruction.arg >> (8 * shift)) & 0xFF])
+        co_code += bytes([instruction.opcode, instruction.arg & 0xFF])
+        co_code += bytes(2 * caches)
+    return bytes(co_code)
+
+
+def _encode_line_table(instructions, sizes, first_lineno):
+    """ Encodes the 3.11 location table, using the long form for every entry. """
+    table = bytearray()
+    previous_line = first_lineno
+    for instruction, size in zip(instructions, sizes):
+        while size > 0:
+            length = min(size, 8)
+            size -= length
+            positions = instruction.positions
+            if positions is None or positions[0] is None:
+                table.append(0x80 | (15 << 3) | (length - 1))  # no location
+                continue
+
+            lineno, end_lineno, col, end_col = positions
+            if end_lineno is None or col is None or end_col is None:
+                table.append(0x80 | (13 << 3) | (length - 1))  # line only
+                _write_signed_varint(table, lineno - previous_line)
+            else:
+                table.append(0x80 | (14 << 3) | (length - 1))
+                _write_signed_varint(table, lineno - previous_line)
+                _write_varint(table, end_lineno - lineno)
+                _write_varint(table, col + 1)
+                _write_varint(table, end_col + 1)
+            previous_line = lineno
+    return bytes(table)
+
+
+def _write_varint(table, value):
+    while value >= 64:
+        table.append(0x40 | (value & 0x3F))
+        value >>= 6
+    table.append(value)
+
+
+def _write_signed_varint(table, value):
+    _write_varint(table, ((-value) << 1) | 1 if value < 0 else value << 1)
+
+
+def _encode_exception_table(instructions, sizes, offsets):
+    index_of = {instruction: index for index, instruction in enumerate(instructions)}
+    entries = []
+    for index, instruction in enumerate(instructions):
+        handler = instruction.handler
+        if handler is None:
+            continue
+        if entries and entries[-1][3] == handler and entries[-1][1] == offsets[index]:
+            entries[-1][1] = offsets[index] + sizes[index]  # extend the previous entry
+        else:
+            entries.append([offsets[index], offsets[index] + sizes[index], index_of[handler.target], handler])
+
+    table = bytearray()
+    for start, end, target_index, handler in entries:
+        _write_exception_table_item(table, start, 0x80)
+        _write_exception_table_item(table, end - start, 0)
+        _write_exception_table_item(table, offsets[target_index], 0)
+        _write_exception_table_item(table, (handler.depth << 1) | int(handler.lasti), 0)
+    return bytes(table)
+
+
+def _write_exception_table_item(table, value, msb):
+    for shift in (24, 18, 12, 6):
+        if value >= 1 << shift:
+            table.append(((value >> shift) & 0x3F) | 0x40 | msb)
+            msb = 0
+    table.append((value & 0x3F) | msb)
+
+
+def _parse_exception_table(table):
+    iterator = iter(table)
+    entries = []
+    while True:
+        try:
+            start = _read_exception_table_item(iterator)
+        except StopIteration:
+            return entries
+        length = _read_exception_table_item(iterator)
+        target = _read_exception_table_item(iterator)
+        depth_and_lasti = _read_exception_table_item(iterator)
+        entries.append((start, start + length, target, depth_and_lasti >> 1, bool(depth_and_lasti & 1)))
+
+
+def _read_exception_table_item(iterator):
+    byte = next(iterator)
+    value = byte & 0x3F
+    while byte & 0x40:
+        byte = next(iterator)
+        value = (value << 6) | (byte & 0x3F)
+    return value
+
+
+StackDepths = collections.namedtuple('StackDepths', ['depths', 'max_depth'])
+
+
+def compute_stack_depths(instructions):
+    """ Returns the stack depth before every reachable instruction, and the maximal depth. """
+    index_of = {instruction: index for index, instruction in enumerate(instructions)}
+    depths = {}
+    max_depth = 0
+    pending = [(0, 0)]
+
+    while pending:
+        index, depth = pending.pop()
+        while index < len(instructions):
+            instruction = instructions[index]
+            if instruction in depths:
+                break
+            depths[instruction] = depth
+            max_depth = max(max_depth, depth)
+
+            if instruction.handler is not None:
+                handler = instruction.handler
+                pending.append((index_of[handler.target], handler.depth + int(handler.lasti) + 1))
+
+            arg = instruction.arg if instruction.opcode >= opcode.HAVE_ARGUMENT else None
+            if instruction.target is not None:
+                jump_depth = depth + dis.stack_effect(instruction.opcode, arg, jump=True)
+                max_depth = max(max_depth, jump_depth)
+                pending.append((index_of[instruction.target], jump_depth))
+            if instruction.opcode in _NO_FALLTHROUGH_OPCODES:
+                break
+
+            depth += _stack_effect(instruction.opcode, arg)
+            max_depth = max(max_depth, depth)
+            index += 1
+
+    return StackDepths(depths, max_depth)
+
+
+def _stack_effect(op, arg):
+    if op == _RETURN_GENERATOR:
+        return 1  # dis says 0, but the generator is resumed with a value on the stack (popped by the next POP_TOP)
+    return dis.stack_effect(op, arg, jump=False)
+
+
+def patch_code(code, start='', end='', insert_lines=None):
+    """
+    Returns a copy of the code object with compiled snippets spliced into its bytecode.
+
+    :param start: Code to run right after the function's prologue.
+    :param end:
+        Code to run right before the function returns.
+        Since returning and falling off the end look the same in bytecode, this runs before every return.
+    :param insert_lines:
+        A dict of line number => code to inject.
+        Line 0 is the first line of the function that has code (so a docstring isn't counted).
+        The code runs right before the first instruction of that line, inside whatever block the line is in.
+    """
+    _check_supported()
+    insert_lines = insert_lines or {}
+    instructions = disassemble(code)
+
+    # every local variable, cell and free variable, in the order of the frame's "localsplus" array
+    parameters = list(code.co_varnames) + [name for name in code.co_cellvars if name not in code.co_varnames]
+    localsplus = parameters + list(code.co_freevars)
+    snippets = [start, end] + list(insert_lines.values())
+    new_locals = _find_snippet_locals(code, parameters, snippets)
+    new_varnames = list(code.co_varnames) + new_locals
+    new_localsplus = new_varnames + [name for name in code.co_cellvars if name not in code.co_varnames] + \
+        list(code.co_freevars)
+
+    consts = list(code.co_consts)
+    names = list(code.co_names)
+    for instruction in instructions:
+        if instruction.opcode in _LOCAL_OPCODES:
+            instruction.arg = new_localsplus.index(localsplus[instruction.arg])
+
+    depths = compute_stack_depths(instructions).depths
+    body_start = _find_body_start(instructions)
+
+    insertions = []  # (instruction to insert before, snippet, whether jumps to the instruction should run the snippet)
+    if start:
+        insertions.append((instructions[body_start], start, False))
+    for linenum, line_code in insert_lines.items():
+        insertions.append((_find_line_start(instructions, body_start, linenum), line_code, True))
+    if end:
+        insertions.extend((instruction, end, True) for instruction in instructions
+                          if instruction.opcode == _RETURN_VALUE)
+
+    snippet_codes = {}
+    for before, snippet, retarget in insertions:
+        if snippet not in snippet_codes:
+            snippet_codes[snippet] = _compile_snippet(code, parameters + new_locals, snippet)
+        snippet_instructions = _splice_snippet(snippet_codes[snippet], before, depths.get(before, 0),
+                                               consts, names, new_localsplus)
+        if retarget:
+            for instruction in instructions:
+                if instruction.target is before:
+                    instruction.target = snippet_instructions[0]
+        index = instructions.index(before)
+        instructions[index:index] = snippet_instructions
+
+    return assemble(code, instructions, co_consts=tuple(consts), co_names=tuple(names),
+                    co_varnames=tuple(new_varnames), co_nlocals=len(new_varnames))
+
+
+def _find_body_start(instructions):
+    """ Returns the index of the first instruction after the prologue (which ends with RESUME). """
+    for index, instruction in enumerate(instructions):
+        if instruction.opcode == _RESUME:
+            return index + 1
+    raise ValueError('Could not find the start of the function body.')
+
+
+def _find_line_start(instructions, body_start, linenum):
+    first_lineno = next((instruction.lineno for instruction in instructions[body_start:]
+                         if instruction.lineno is not None), None)
+    if first_lineno is None:
+        raise ValueError('The function has no line information.')
+
+    lineno = first_lineno + linenum
+    for instruction in instructions[body_start:]:
+        if instruction.lineno == lineno:
+            return instruction
+    raise ValueError('Line {} has no code to insert before.'.format(linenum))
+
+
+def _snippet_scope_source(code, parameters, snippet):
+    """
+    The snippet is compiled as the body of a function whose parameters are all of the original locals,
+    nested in a scope that declares the original free variables, so every name gets the same kind of access.
+    """
+    cells = [name for name in code.co_cellvars]
+    lines = ['def {}():'.format(_SCOPE_NAME)]
+    lines += ['    {} = None'.format(name) for name in code.co_freevars]
+    lines.append('    def {}({}):'.format(_SNIPPET_NAME, ', '.join(parameters)))
+    if code.co_freevars:
+        lines.append('        nonlocal {}'.format(', '.join(code.co_freevars)))  # so they can be assigned too
+    lines += ['        ' + line for line in snippet.splitlines()]
+    lines += ['        ' + _SNIPPET_END] * 3  # too long to be duplicated by the compiler, so it stays a single block
+    if cells:
+        lines.append('        lambda: ({},)'.format(', '.join(cells)))  # makes the original cells cells here too
+    return '\n'.join(lines) + '\n'
+
+
+def _compile_scope(code, parameters, snippet):
+    try:
+        module_code = compile(_snippet_scope_source(code, parameters, snippet), '<monki-snippet>', 'exec')
+    except SyntaxError as e:
+        raise ValueError('Could not compile injected code: {}'.format(e)) from e
+    scope_code = _find_code_const(module_code, _SCOPE_NAME)
+    return _find_code_const(scope_code, _SNIPPET_NAME)
+
+
+def _find_code_const(code, name):
+    return next(const for const in code.co_consts if hasattr(const, 'co_code') and const.co_name == name)
+
+
+def _find_snippet_locals(code, parameters, snippets):
+    """ Returns the names assigned by the snippets which aren't locals of the original function. """
+    combined = '\n'.join(snippet for snippet in snippets if snippet) or 'pass'
+    snippet_code = _compile_scope(code, parameters, combined)
+    new_locals = list(snippet_code.co_varnames[snippet_code.co_argcount:])
+    if any(name not in parameters for name in snippet_code.co_cellvars):
+        raise ValueError('Injected code can\'t define closures over its own variables in bytecode mode.')
+    return new_locals
+
+
+def _compile_snippet(code, parameters, snippet):
+    snippet_code = _compile_scope(code, parameters, snippet)
+    if snippet_code.co_varnames[snippet_code.co_argcount:]:
+        raise AssertionError('This shouldn\'t happen - all of the snippet\'s locals should be parameters.')
+    if snippet_code.co_flags & (inspect.CO_GENERATOR | inspect.CO_COROUTINE | inspect.CO_ASYNC_GENERATOR):
+        raise ValueError('Injected code can\'t yield or await in bytecode mode.')
+    return snippet_code
+
+
+def _splice_snippet(snippet_code, before, base_depth, consts, names, localsplus):
+    """
+    Returns the snippet's instructions, ready to be inserted before the given instruction:
+    the prologue and the snippet's end marker are dropped, and arguments are remapped.
+    """
+    instructions = disassemble(snippet_code)
+    snippet_localsplus = list(snippet_code.co_varnames) + \
+        [name for name in snippet_code.co_cellvars if name not in snippet_code.co_varnames] + \
+        list(snippet_code.co_freevars)
+
+    body_start = _find_body_start(instructions)
+    end_start = next((index for index, instruction in enumerate(instructions)
+                      if instruction.opcode == _LOAD_GLOBAL and
+                      snippet_code.co_names[instruction.arg >> 1] == _SNIPPET_END), None)
+
+    if end_start is None:  # the snippet always returns, so the compiler dropped the end marker
+        main, cold, end_marker = instructions[body_start:], [], None
+    else:
+        end_stop = next(index for index in range(end_start, len(instructions))
+                        if instructions[index].opcode == _RETURN_VALUE) + 1
+        # exception handlers are placed at the end of the code, after the end marker
+        main, cold, end_marker = instructions[body_start:end_start], instructions[end_stop:], instructions[end_start]
+
+    result = main + cold
+    if any(instruction.opcode == _RETURN_VALUE for instruction in result) and base_depth > 0:
+        raise ValueError('Injected code can only return from the start of the function in bytecode mode.')
+
+    for instruction in result:
+        if instruction.target is end_marker and end_marker is not None:
+            instruction.target = before
+        instruction.arg = _remap_arg(instruction, snippet_code, consts, names, snippet_localsplus, localsplus)
+        if instruction.handler is not None:
+            instruction.handler = instruction.handler._replace(depth=instruction.handler.depth + base_depth)
+        else:
+            instruction.handler = before.handler
+        instruction.positions = (before.lineno, before.lineno, None, None) if before.lineno is not None else None
+
+    if cold and end_marker is not None:  # don't fall through from the snippet into its exception handlers
+        result.insert(len(main), Instruction(opcode.opmap['JUMP_FORWARD'], 0, main[-1].positions if main else None,
+                                             target=before, handler=before.handler))
+    if not result:
+        result.append(Instruction(opcode.opmap['NOP'], 0, None, handler=before.handler))
+    return result
+
+
+def _remap_arg(instruction, snippet_code, consts, names, snippet_localsplus, localsplus):
+    op, arg = instruction.opcode, instruction.arg
+    if op in dis.hasconst:
+        return _index_of_const(consts, snippet_code.co_consts[arg])
+    if op == _LOAD_GLOBAL:
+        return (_index_of(names, snippet_code.co_names[arg >> 1]) << 1) | (arg & 1)
+    if op in dis.hasname:
+        return _index_of(names, snippet_code.co_names[arg])
+    if op in _LOCAL_OPCODES:
+        return localsplus.index(snippet_localsplus[arg])
+    return arg
+
+
+def _index_of(values, value):
+    try:
+        return values.index(value)
+    except ValueError:
+        values.append(value)
+        return len(values) - 1
+
+
+def _index_of_const(consts, value):
+    # constants must match by type as well (1 == 1.0 == True), and code objects by identity
+    for index, const in enumerate(consts):
+        if const is value or (type(const) is type(value) and not hasattr(value, 'co_code') and _equal(const, value)):
+            return index
+    consts.append(value)
+    return len(consts) - 1
+
+
+def _equal(a, b):
+    try:
+        return bool(a == b) and repr(a) == repr(b)  # repr tells apart 0.0 and -0.0, and nested types in tuples
+    except Exception:
+        return False
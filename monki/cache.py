@@ -0,0 +1,148 @@
+"""
+An opt-in on-disk cache of patched code objects, similar in spirit to ``__pycache__``.
+
+When enabled, the code object produced by ``patch()`` is marshalled to disk. The next time the same
+function is patched with the same spec (e.g. in another process), the code object is loaded instead of
+rewriting and recompiling the source.
+
+Every cache file holds a single entry. The file name is derived from the function and the patch spec,
+while the header holds a digest of the function's original source, the spec and the interpreter version.
+When the source changes, the digest no longer matches, the entry counts as a miss and is overwritten.
+"""
+import collections
+import hashlib
+import importlib.util
+import marshal
+import os
+import re
+import sys
+
+
+_FORMAT_VERSION = 1
+_MAGIC = importlib.util.MAGIC_NUMBER + b'monki' + bytes([_FORMAT_VERSION])
+_UNSAFE_FILENAME_CHARS_REGEX = r'[^\w.-]'
+_ENV_VAR = 'MONKI_CACHE_DIR'
+
+
+class _PatchCache:
+    def __init__(self):
+        self.enabled = False
+        self.directory = None
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+
+    def load(self, func, key):
+        """ Returns the cached code object for the key, or None on a miss. """
+        path = self._path(func, key)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except OSError:
+            self.misses += 1
+            return None
+
+        header = _MAGIC + key.source_digest
+        if not data.startswith(header):  # stale or foreign file
+            self.misses += 1
+            return None
+
+        try:
+            code = marshal.loads(data[len(header):])
+        except (EOFError, ValueError, TypeError):
+            self.errors += 1
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        return code
+
+    def store(self, func, key, code):
+        path = self._path(func, key)
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(tmp_path, 'wb') as f:
+                f.write(_MAGIC + key.source_digest + marshal.dumps(code))
+            os.replace(tmp_path, path)  # atomic, so concurrent readers never see a partial file
+        except (OSError, ValueError):  # an unwritable cache (like an unwritable __pycache__) is not an error
+            self.errors += 1
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+
+    def _path(self, func, key):
+        code = func.__code__
+        if self.directory is not None:
+            directory = self.directory
+        else:
+            directory = os.path.join(os.path.dirname(os.path.abspath(code.co_filename)), '__pycache__')
+
+        name = '{module}.{qualname}.{spec}.{tag}.monki'.format(
+            module=getattr(func, '__module__', None) or '_',
+            qualname=getattr(func, '__qualname__', code.co_name),
+            spec=key.spec_digest.hex()[:16],
+            tag=sys.implementation.cache_tag)
+        return os.path.join(directory, re.sub(_UNSAFE_FILENAME_CHARS_REGEX, '_', name))
+
+
+# source_digest covers the source, the spec and the interpreter; spec_digest only names the cache file
+CacheKey = collections.namedtuple('CacheKey', ['source_digest', 'spec_digest'])
+
+
+def make_key(func_source, spec):
+    """
+    :param func_source: The original source of the function, as returned by inspect.getsource.
+    :param spec: Any value with a deterministic repr describing the patch.
+    """
+    spec_digest = hashlib.sha256(repr(spec).encode('utf-8')).digest()
+    source_hash = hashlib.sha256(_MAGIC)
+    source_hash.update(spec_digest)
+    source_hash.update(func_source.encode('utf-8'))
+    return CacheKey(source_hash.digest(), spec_digest)
+
+
+_cache = _PatchCache()
+
+
+def enable_cache(directory=None):
+    """
+    Enable the on-disk cache of patched code objects.
+
+    :param directory:
+        Where to store the cache files. By default, they are stored in the ``__pycache__`` directory
+        next to the source file of each patched function.
+    """
+    _cache.enabled = True
+    _cache.directory = directory
+
+
+def disable_cache():
+    _cache.enabled = False
+    _cache.directory = None
+
+
+def is_cache_enabled():
+    return _cache.enabled
+
+
+def cache_stats():
+    """ Returns a dict with the number of cache hits, misses and errors since the last reset. """
+    return {'hits': _cache.hits, 'misses': _cache.misses, 'errors': _cache.errors}
+
+
+def reset_cache_stats():
+    _cache.hits = _cache.misses = _cache.errors = 0
+
+
+def load(func, key):
+    return _cache.load(func, key)
+
+
+def store(func, key, code):
+    _cache.store(func, key, code)
+
+
+if os.environ.get(_ENV_VAR):
+    enable_cache(os.environ[_ENV_VAR])
@@ -1,23 +1,66 @@
+import ast
+import builtins
 import collections
+import collections.abc
+import dis
 import re
 import inspect
-from types import CodeType, ModuleType
-
-
-_FUNC_SIGNATURE_REGEX = r'def (\w+)\s*\(((\s|.)*?)\)\s*:'
-_INDENT_STRING = '    '
-
-
-def patch(func, start='', end='', insert_lines=None, indent_lines=None, indent_inner=False):
+import itertools
+import sys
+import zlib
+from types import CodeType, FunctionType, MappingProxyType
+
+from . import cache
+from . import instrumentation
+from . import lazy as lazy_patching
+from . import registry
+from . import source
+
+
+_FUNC_SIGNATURE_REGEX = r'(?:async\s+)?def (\w+)\s*\(((\s|.)*?)\)\s*:'
+_INDENT_STRING = source.INDENT_STRING
+_ENGINES = ('ast', 'regex')
+_MODES = ('source', 'bytecode')
+_RETURN_VALUE_NAME = '__return__'
+_CLOSURE_WRAPPER_NAME = '_monki_wrapper'
+_CONSTANT_PLACEHOLDER = '__monki_constant_{}__'
+_constant_ids = itertools.count()
+_NO_ENTRIES = MappingProxyType({})  # shared by the specs with nothing to insert, indent, bind or inline
+
+
+def patch(func, start='', end='', insert_lines=None, indent_lines=None, indent_inner=False, engine='ast',
+          mode='source', lazy=False, toggle=None, on_exit='', on_return='', constants=None, bind=None, inline=None):
     """
     Easily modify a function's code at runtime.
-    Can be called at most once on a single function.
+    Patching a function again layers the new patch on top of the previous ones: its line numbers refer
+    to the body of the function as it is after the previous patches. Use `unpatch` to undo all of them.
 
     Consult the documentation for usage examples.
 
     :param func: The function to patch.
     :param start: Code to inject in the beginning, right after the signature.
     :param end: Code to inject as the last line of the function.
+    :param on_exit:
+        Code to run whenever the function exits: on every return, on an exception, and when a generator,
+        coroutine or async generator finishes or is closed. The body is wrapped in `try` / `finally`.
+    :param on_return:
+        Code to run right before the function returns, with the returned value in `__return__`.
+        Runs before every return statement, and when the function falls off its end (with None).
+        Where a return statement shares its line with other code, e.g. `if x: return y`, this code is
+        joined into that line, so it must be made of simple statements.
+    :param constants:
+        A dict of name => value. The names in the injected code are compiled as constants with these values,
+        so they aren't looked up on every call. Patches with constants are never cached on disk.
+    :param bind:
+        A dict of global name => value. Unlike `constants`, the names are bound in the function's own code:
+        wherever the function reads one of these globals (or builtins), it reads a constant with the given value
+        instead. Names which the function (or a function nested in it) assigns or uses as a local can't be bound.
+    :param inline:
+        A dict of global name => helper function. The calls of these names in the function are replaced by the
+        helper's expression, with the arguments substituted into it, so there's no call. A helper must return a
+        single expression (a lambda, or a function whose body is a single return), and its globals and defaults
+        are bound as constants. Calls which can't be inlined (e.g. with `*args`) are left as they are.
+        Patches which inline helpers are never cached on disk.
     :param insert_lines:
         A dict of line number => code to inject.
         The code will be injected before the line number in the original code.
@@ -27,11 +70,203 @@ def patch(func, start='', end='', insert_lines=None, indent_lines=None, indent_i
     :param indent_inner:
         An int to indicate indentation level or a boolean (True is indent level of 1).
         Indents all of the original code inside the function
+    :param engine:
+        How to find the signature and the body in the function's source.
+        'ast' (the default) parses the source with the ast module and supports any valid signature.
+        'regex' is the original regular expression based engine.
+    :param mode:
+        'source' (the default) rewrites the function's source and recompiles it.
+        'bytecode' compiles only the injected code and splices it into the function's bytecode, so it works
+        without the function's source (e.g. in zip-imported or .pyc-only deployments). Only `start`, `end`
+        and `insert_lines` are supported. `end` runs before every return, and line 0 of `insert_lines` is the
+        first line of the function that has code. See `monki.bytecode.patch_code` for details.
+    :param lazy:
+        If True, the arguments are validated right away, but the function is only patched on its first call.
+        Use `monki.force_lazy_patches()` to apply all of the pending patches.
+    :param toggle:
+        A name of a toggle group. Both the code before the patch and the patched code are kept, so
+        `monki.disable(toggle)` and `monki.enable(toggle)` can switch between them without recompiling.
+        The patch starts out enabled. Patching the function again takes it out of the group, keeping the
+        group's patch, and isn't allowed while the group is disabled.
     """
 
+    spec = _make_spec(start, end, insert_lines, indent_lines, indent_inner, engine, mode, on_exit, on_return,
+                      constants, bind, inline)
+    if lazy:
+        if toggle is not None:
+            raise ValueError('A patch can\'t be both lazy and part of a toggle group.')
+        registry.check_toggles_enabled(func)
+        lazy_patching.install(func, lambda: _apply_patches([(func, spec, _get_base_source(func, spec))]))
+        return
+
+    # the source is read under the lock, so a concurrent patch of the function can't be lost
+    with registry.lock_for(func):
+        lazy_patching.resolve(func)  # pending patches come first, so the new patch is layered on top of them
+        _apply_patches([(func, spec, _get_base_source(func, spec))], toggle)
+
+
+def enable(toggle):
+    """ Switch all of the functions patched with the given toggle name to their patched code. """
+    registry.set_toggle(toggle, True)
+
+
+def disable(toggle):
+    """ Switch all of the functions patched with the given toggle name back to their code before the patch. """
+    registry.set_toggle(toggle, False)
+
+
+def unpatch(func):
+    """ Restore the original code of the function, undoing all of its patches (including pending lazy ones). """
+    with registry.lock_for(func):
+        lazy_patching.cancel(func)
+        registry.unpatch(func)
+
+
+def unpatch_all():
+    """ Restore the original code of every patched function. """
+    lazy_patching.cancel_all()
+    registry.unpatch_all()
+
+
+def force_lazy_patches():
+    """ Apply all of the patches that were made with lazy=True and haven't been applied yet. """
+    lazy_patching.resolve_all()
+
+
+def pending_lazy_patches():
+    """ Returns the number of functions with lazy patches that haven't been applied yet. """
+    return lazy_patching.pending_count()
+
+
+def patch_many(specs, toggle=None):
+    """
+    Patch many functions at once.
+    Functions are grouped by their source file, each file is parsed once and all of the functions
+    from the same file are compiled together.
+
+    :param specs:
+        A dict of function => spec, or an iterable of (function, spec) pairs.
+        Each spec is a dict of keyword arguments to `patch`, e.g. {'start': 'print("Starting")'}.
+    :param toggle: A name of a toggle group for all of the patches. See `patch`.
+    """
+    items = specs.items() if isinstance(specs, collections.abc.Mapping) else specs
+    funcs_and_specs = [(func, _make_spec(**spec)) for func, spec in items]
+    if len({func for func, _ in funcs_and_specs}) != len(funcs_and_specs):
+        raise ValueError('Each function can appear only once in a single call.')
+
+    with registry.locked(func for func, _ in funcs_and_specs):
+        for func, _ in funcs_and_specs:
+            lazy_patching.resolve(func)
+        funcs_to_read = [func for func, spec in funcs_and_specs
+                         if spec.mode == 'source' and not registry.is_patched(func)]
+        with instrumentation.phase('source', funcs_to_read):
+            func_sources = source.get_function_sources(funcs_to_read)
+        _apply_patches([(func, spec, func_sources[func] if func in func_sources else _get_base_source(func, spec))
+                        for func, spec in funcs_and_specs], toggle)
+
+
+def patch_module(module, specs, toggle=None):
+    """
+    Patch many functions of a module at once. See `patch_many`.
+
+    :param module: The module containing the functions.
+    :param specs:
+        A dict of qualified name => spec, e.g. {'some_function': {...}, 'SomeClass.some_method': {...}}.
+    :param toggle: A name of a toggle group for all of the patches. See `patch`.
+    """
+    patch_many([(_resolve_qualname(module, qualname), spec) for qualname, spec in specs.items()], toggle)
+
+
+def _resolve_qualname(module, qualname):
+    obj = module
+    for name in qualname.split('.'):
+        try:
+            obj = inspect.getattr_static(obj, name)
+        except AttributeError:
+            raise ValueError('Can\'t find {} in module {}.'.format(qualname, module.__name__)) from None
+        obj = getattr(obj, '__func__', obj)  # unwrap staticmethod and classmethod
+
+    if not inspect.isfunction(obj):
+        raise TypeError('{} in module {} is not a function.'.format(qualname, module.__name__))
+    return obj
+
+
+def _get_base_source(func, spec):
+    """ Returns the source the spec should be applied to - the original source, with the previous patches applied. """
+    if spec.mode != 'source':
+        return None
+    return _get_current_source(func)
+
+
+def _get_current_source(func):
+    """ Returns the source of the function, with its patches applied. """
+    record = registry.get(func)
+    if record is None:
+        with instrumentation.phase('source', [func]):
+            return inspect.getsource(func)
+    if any(previous_spec.mode != 'source' for previous_spec in record.specs):
+        raise ValueError('Can\'t patch the source of a function which was patched in bytecode mode.')
+    if record.source is not None:
+        return record.source
+    with instrumentation.phase('source', [func]):
+        if record.original_source is not None:
+            current_source = zlib.decompress(record.original_source).decode('utf-8')
+        else:
+            current_source = inspect.getsource(record.original_code)
+    for previous_spec in record.specs:
+        current_source = _modify_source_with_spec(current_source, previous_spec)
+    return current_source
+
+
+_PatchSpec = collections.namedtuple('PatchSpec',
+                                    ['start', 'end', 'insert_lines', 'indent_lines', 'indent_inner', 'engine', 'mode',
+                                     'on_exit', 'on_return', 'constants', 'bind', 'inline'])
+_Inlined = collections.namedtuple('Inlined', ['helper', 'template'])
+
+
+def _make_spec(start='', end='', insert_lines=None, indent_lines=None, indent_inner=False, engine='ast',
+               mode='source', on_exit='', on_return='', constants=None, bind=None, inline=None):
     indent_inner, indent_lines, insert_lines = _validate_arguments(indent_inner, indent_lines, insert_lines)
-    modified_source = _modify_source(func, start, end, insert_lines, indent_inner, indent_lines)
-    _replace_code(func, modified_source)
+    if engine not in _ENGINES:
+        raise ValueError('engine must be one of: {}'.format(', '.join(_ENGINES)))
+    if mode not in _MODES:
+        raise ValueError('mode must be one of: {}'.format(', '.join(_MODES)))
+    if mode == 'bytecode' and (indent_lines or indent_inner):
+        raise ValueError('Indenting is not supported in bytecode mode.')
+    if mode == 'bytecode' and (on_exit or on_return or constants or bind or inline):
+        raise ValueError('on_exit, on_return, constants, bind and inline are not supported in bytecode mode.')
+
+    # each name becomes a unique string literal, which is replaced by the value after compiling
+    bound_constants = {}
+    bound_names = {}  # name => placeholder
+    if constants:
+        placeholders = {name: _CONSTANT_PLACEHOLDER.format(next(_constant_ids)) for name in constants}
+        bound_constants.update((placeholders[name], value) for name, value in constants.items())
+        replacements = {name: _placeholder_expression(placeholder) for name, placeholder in placeholders.items()}
+        start, end, on_exit, on_return = (source.replace_names(code, replacements)
+                                          for code in (start, end, on_exit, on_return))
+        insert_lines = {linenum: source.replace_names(code, replacements) for linenum, code in insert_lines.items()}
+    if bind:
+        bound_names = {name: _CONSTANT_PLACEHOLDER.format(next(_constant_ids)) for name in bind}
+        bound_constants.update((bound_names[name], value) for name, value in bind.items())
+    inlined = {}
+    for name, helper in (inline or {}).items():
+        template, helper_constants = _make_inline_template(helper)
+        inlined[name] = _Inlined(helper, template)
+        bound_constants.update(helper_constants)
+
+    # a spec is kept for every patched function, so equal snippets share a string, and empty dicts share a mapping
+    start, end, on_exit, on_return = (sys.intern(code) for code in (start, end, on_exit, on_return))
+    insert_lines = {linenum: sys.intern(code) for linenum, code in insert_lines.items()}
+    return _PatchSpec(start, end, insert_lines or _NO_ENTRIES, indent_lines or _NO_ENTRIES, indent_inner, engine, mode,
+                      on_exit, on_return, bound_constants or _NO_ENTRIES, bound_names or _NO_ENTRIES,
+                      inlined or _NO_ENTRIES)
+
+
+def _placeholder_expression(placeholder):
+    # the literal is wrapped in a conditional expression, which the compiler reduces to the literal itself,
+    # but only after constant folding, so e.g. `name[0]` isn't folded into the first character of the literal
+    return '({!r} if 1 else 0)'.format(placeholder)
 
 
 def _validate_arguments(indent_inner, indent_lines, insert):
@@ -51,64 +286,391 @@ def _validate_arguments(indent_inner, indent_lines, insert):
     else:
         raise TypeError('indent_lines must be a list of lines to indent or a dict of line_number => indent_level')
 
-    insert = insert or {}
+    insert = dict(insert or {})  # copied, since 'start' and 'end' are added to it later on
 
     return indent_inner, dict_indent_lines, insert
 
 
-def _replace_code(func, modified_source):
-    modified_function = _create_modified_function(func, modified_source)
-    modified_code_object = modified_function.__code__
+def _spec_for_cache(spec):
+    # dicts are sorted so that the repr (and therefore the cache key) doesn't depend on insertion order
+    return spec._replace(constants=sorted(spec.constants), insert_lines=sorted(spec.insert_lines.items()),
+                         indent_lines=sorted(spec.indent_lines.items()), bind=sorted(spec.bind.items()),
+                         inline=sorted(spec.inline))
+
+
+def _apply_patches(targets, toggle=None):
+    """
+    :param targets: A list of (function, spec, base source) triplets.
+    :param toggle: A name of a toggle group to add the functions to, or None.
+    """
+    codes = {}
+    modified_sources = {}
+    specs = {func: spec for func, spec, _ in targets}
+    to_compile = collections.defaultdict(list)  # source file => [(function, modified source, cache key)]
+
+    for func, spec, raw_source in targets:
+        registry.check_toggles_enabled(func)
+        if spec.bind:
+            _validate_names_can_be_bound(func, spec.bind)
+        if spec.inline:
+            _validate_inlined_helpers(func, spec.inline)
+        if spec.mode == 'bytecode':
+            with instrumentation.phase('compile', [func]):
+                codes[func] = _patch_bytecode(func, spec)
+            continue
+
+        cache_key = None
+        # constants can't be marshalled, and inlined helpers aren't part of the key
+        if cache.is_cache_enabled() and not _constants_of(func, spec) and not spec.inline:
+            with instrumentation.phase('cache', [func]):
+                cache_key = cache.make_key(raw_source, _spec_for_cache(spec))
+                codes[func] = cache.load(func, cache_key)
+
+        if codes.get(func) is None:
+            with instrumentation.patching(func):
+                signature, body = _modify_source_parts(raw_source, spec.start, spec.end, dict(spec.insert_lines),
+                                                       spec.indent_inner, spec.indent_lines, spec.engine,
+                                                       spec.on_exit, spec.on_return, spec.bind, spec.inline)
+            modified_sources[func] = signature + body
+            to_compile[func.__code__.co_filename].append(
+                (func, _declare_free_variables(func, signature, body), cache_key))
+
+    for group in to_compile.values():
+        group_codes = _compile_modified_codes([(func, modified_source) for func, modified_source, _ in group])
+        for (func, _, cache_key), code in zip(group, group_codes):
+            constants = _constants_of(func, specs[func])
+            codes[func] = code = _substitute_constants(code, constants) if constants else code
+            if cache_key is not None:
+                with instrumentation.phase('cache', [func]):
+                    cache.store(func, cache_key, code)
+
+    # validate everything before replacing anything, so a failure doesn't leave a partially patched set
+    for func, code in codes.items():
+        _validate_code_fits_function(func, code)
+    for func, spec, _ in targets:
+        with instrumentation.phase('swap', [func]):
+            registry.release_toggles(func)
+            registry.push(func, lazy_patching.current_code(func), spec, modified_sources.get(func))
+            if toggle is not None:
+                registry.add_toggle(toggle, func, func.__code__, codes[func])
+            func.__code__ = codes[func]
+        instrumentation.record_patch(func, codes[func], len(modified_sources.get(func, '')))
+
+
+def _validate_names_can_be_bound(func, names):
+    unbindable = set(names) - _bindable_globals(lazy_patching.current_code(func))
+    if unbindable:
+        raise ValueError('{} can\'t be bound in {}: the function doesn\'t only read them as globals.'.format(
+            ', '.join(sorted(unbindable)), func.__qualname__))
+
+
+def _bindable_globals(code):
+    """
+    Returns the names which the code (and the code nested in it) reads as globals, and never assigns, deletes or
+    uses as local, free or cell variables, so replacing every occurrence of them in the source is safe.
+    """
+    reads, others = set(), set()
+    pending = [code]
+    while pending:
+        current = pending.pop()
+        others.update(current.co_varnames, current.co_cellvars, current.co_freevars)
+        for instruction in dis.get_instructions(current):
+            if instruction.opname in _GLOBAL_READ_OPS:
+                reads.add(instruction.argval)
+            elif instruction.opname in _NAME_WRITE_OPS:
+                others.add(instruction.argval)
+        pending.extend(const for const in current.co_consts if isinstance(const, CodeType))
+    return reads - others
+
+
+def _validate_inlined_helpers(func, inline):
+    _validate_names_can_be_bound(func, inline)
+    for name, inlined in inline.items():
+        if _lookup_global(func, name, None) is not inlined.helper:
+            raise ValueError('{} in {} is not {}.'.format(name, func.__qualname__, inlined.helper.__qualname__))
+
+
+_MISSING = object()
+_NO_DEFAULT = object()
+
+
+def _lookup_global(func, name, default=_NO_DEFAULT):
+    """
+    Returns the value the function gets for a global name, like the interpreter: its global or the builtin.
+    Raises NameError if it's neither, unless a default is given.
+    """
+    if name in func.__globals__:
+        return func.__globals__[name]
+    value = getattr(builtins, name, default)
+    if value is _NO_DEFAULT:
+        raise NameError('name {!r} is not defined'.format(name))
+    return value
+
+
+# builtins which behave differently depending on the frame they're called from
+_FRAME_DEPENDENT_BUILTINS = ('locals', 'vars', 'globals', 'dir', 'eval', 'exec', 'super', 'breakpoint')
+_INLINE_FORBIDDEN_NODES = (ast.Lambda, ast.ListComp, ast.SetComp, ast.DictComp, ast.GeneratorExp, ast.NamedExpr,
+                           ast.Yield, ast.YieldFrom, ast.Await)
+
+
+def _make_inline_template(helper):
+    """ Returns the source.InlineTemplate of the helper, and a dict of the constants it uses. """
+    if not isinstance(helper, FunctionType):
+        raise TypeError('Only functions can be inlined, but got {!r}.'.format(helper))
+    code = helper.__code__
+    if code.co_freevars:
+        raise ValueError('{} is a closure, so it can\'t be inlined.'.format(helper.__qualname__))
+    if code.co_flags & (inspect.CO_VARARGS | inspect.CO_VARKEYWORDS):
+        raise ValueError('{} takes *args or **kwargs, so it can\'t be inlined.'.format(helper.__qualname__))
+    if code.co_flags & (inspect.CO_GENERATOR | inspect.CO_COROUTINE | inspect.CO_ASYNC_GENERATOR):
+        raise ValueError('{} is a generator or a coroutine, so it can\'t be inlined.'.format(helper.__qualname__))
+
+    args, expression = _find_helper_expression(helper)
+    parameters = [arg.arg for arg in args.posonlyargs + args.args + args.kwonlyargs]
+    for node in ast.walk(expression):
+        if isinstance(node, _INLINE_FORBIDDEN_NODES):
+            raise ValueError('{} has a {}, so it can\'t be inlined.'.format(helper.__qualname__,
+                                                                             type(node).__name__))
+
+    constants = {}
+    replacements = {}
+    for index, name in enumerate(parameters):
+        replacements[name] = ast.Name(source.PARAMETER_MARKER.format(index), ast.Load())
+    for name in sorted({node.id for node in ast.walk(expression) if isinstance(node, ast.Name)} - set(parameters)):
+        value = _lookup_global(helper, name, _MISSING)
+        if value is helper:
+            raise ValueError('{} is recursive, so it can\'t be inlined.'.format(helper.__qualname__))
+        if value is _MISSING:
+            raise ValueError('{} uses {}, which isn\'t defined.'.format(helper.__qualname__, name))
+        if name in _FRAME_DEPENDENT_BUILTINS and name not in helper.__globals__:
+            raise ValueError('{} calls {}(), so it can\'t be inlined.'.format(helper.__qualname__, name))
+        replacements[name] = ast.parse(_add_constant(constants, value), mode='eval').body
+
+    defaults = dict(zip(reversed([arg.arg for arg in args.posonlyargs + args.args]), reversed(helper.__defaults__ or ())))
+    defaults.update(helper.__kwdefaults__ or {})
+    # default values are bound rather than evaluated again, so side effects of evaluating them don't repeat
+    default_texts = {name: _add_constant(constants, value) for name, value in defaults.items()}
+
+    expression = _NameReplacer(replacements).visit(expression)
+    template = source.InlineTemplate(parameters, [arg.arg for arg in args.kwonlyargs], default_texts,
+                                     ast.unparse(expression))
+    return template, constants
+
+
+def _find_helper_expression(helper):
+    """ Returns the arguments node and the expression node of a lambda, or of a function with a single return. """
     try:
-        func.__code__ = modified_code_object
-    except ValueError as e:
-        if 'requires a code object with' in str(e).lower():  # making sure it's the right exception
-            raise ValueError('Setting variables from outer function in extension - currently not supported.') from e
+        helper_source = inspect.getsource(helper)
+    except (OSError, TypeError) as e:
+        raise ValueError('Can\'t get the source of {}, so it can\'t be inlined.'.format(helper.__qualname__)) from e
+    is_indented = helper_source[:1].isspace()
+    tree = ast.parse('if 1:\n' + helper_source if is_indented else helper_source)
+
+    if helper.__name__ == '<lambda>':
+        lambdas = [node for node in ast.walk(tree) if isinstance(node, ast.Lambda)]
+        if len(lambdas) != 1:
+            raise ValueError('Can\'t tell which lambda on its line {} is, so it can\'t be inlined.'.format(
+                helper.__qualname__))
+        return lambdas[0].args, lambdas[0].body
+
+    node = tree.body[0].body[0] if is_indented else tree.body[0]
+    statements = [statement for statement in node.body
+                  if not (isinstance(statement, ast.Expr) and isinstance(statement.value, ast.Constant) and
+                          isinstance(statement.value.value, str))]  # the docstring
+    if len(statements) != 1 or not isinstance(statements[0], ast.Return) or statements[0].value is None:
+        raise ValueError('{} isn\'t a single return statement, so it can\'t be inlined.'.format(helper.__qualname__))
+    return node.args, statements[0].value
+
+
+def _add_constant(constants, value):
+    """ Adds the value to the constants under a new placeholder, and returns the placeholder's expression. """
+    placeholder = _CONSTANT_PLACEHOLDER.format(next(_constant_ids))
+    constants[placeholder] = value
+    return _placeholder_expression(placeholder)
+
+
+class _NameReplacer(ast.NodeTransformer):
+    def __init__(self, replacements):
+        self.replacements = replacements
+
+    def visit_Name(self, node):
+        return self.replacements.get(node.id, node)
+
+
+_GLOBAL_READ_OPS = ('LOAD_GLOBAL', 'LOAD_NAME')  # LOAD_NAME is used in class bodies
+_NAME_WRITE_OPS = ('STORE_GLOBAL', 'DELETE_GLOBAL', 'STORE_NAME', 'DELETE_NAME')
+
+
+def _replace_constants(func, values):
+    """
+    Recompiles the function's current source with new values for some of the constants of its patches.
+
+    :param values: A dict of placeholder => new value.
+    """
+    with registry.lock_for(func):
+        record = registry.get(func)
+        record.specs = tuple(spec._replace(constants={placeholder: values.get(placeholder, value)
+                                                      for placeholder, value in spec.constants.items()})
+                             for spec in record.specs)
+        _recompile_current_source(func)
+
+
+def _pop_patch(func):
+    """ Undoes the function's last patch, keeping the patches before it. """
+    with registry.lock_for(func):
+        record = registry.get(func)
+        if len(record.specs) == 1:
+            registry.unpatch(func)
+            return
+        if record.toggles:
+            raise ValueError('Can\'t undo the last patch of {}, since it has toggles.'.format(func.__qualname__))
+        record.specs = record.specs[:-1]
+        record.source = None  # recomputed from the remaining specs
+        _recompile_current_source(func)
+
+
+def _recompile_current_source(func):
+    record = registry.get(func)
+    parsed = source.parse_function_source(_get_current_source(func))
+    body = '\n'.join(parsed.body_lines)
+    code = _compile_modified_codes([(func, _declare_free_variables(func, parsed.signature, body))])[0]
+    constants = {}
+    for spec in record.specs:
+        constants.update(spec.constants)
+    code = _substitute_constants(code, constants)
+    _validate_code_fits_function(func, code)
+    func.__code__ = code
+
+
+def _modify_source_with_spec(raw_source, spec):
+    return _modify_source(raw_source, spec.start, spec.end, dict(spec.insert_lines),
+                          spec.indent_inner, spec.indent_lines, spec.engine, spec.on_exit, spec.on_return, spec.bind,
+                          spec.inline)
+
+
+def _constants_of(func, spec):
+    """ Returns the constants of the spec and of the function's previous patches, which are in its source too. """
+    record = registry.get(func)
+    if record is None:
+        return spec.constants
+    constants = {}
+    for previous_spec in record.specs + (spec,):
+        constants.update(previous_spec.constants)
+    return constants
+
+
+def _substitute_constants(code, constants):
+    return code.replace(co_consts=tuple(_substitute_constant(const, constants) for const in code.co_consts))
+
+
+def _substitute_constant(const, constants):
+    if isinstance(const, str):
+        return constants.get(const, const)
+    if isinstance(const, tuple):  # the compiler folds tuples of constants
+        return tuple(_substitute_constant(item, constants) for item in const)
+    if isinstance(const, CodeType):  # nested functions, comprehensions and generator expressions
+        return _substitute_constants(const, constants)
+    return const
+
+
+def _patch_bytecode(func, spec):
+    if not any([spec.start, spec.end, spec.insert_lines]):
+        raise ValueError('Must supply code to inject or indent.')
+    if (0 in spec.insert_lines) and spec.start:
+        raise ValueError('Can\'t both insert line at index 0 and set \'start\' argument')
+    from . import bytecode  # only needed (and only supported) in bytecode mode
+    return bytecode.patch_code(lazy_patching.current_code(func), spec.start, spec.end, spec.insert_lines)
+
+
+def _validate_code_fits_function(func, modified_code_object):
+    if modified_code_object.co_freevars != func.__code__.co_freevars:
+        raise ValueError('The patched code doesn\'t use the same variables from the outer function as the original.')
+
+
+def _declare_free_variables(func, signature, body):
+    """ Declares the closure's free variables as nonlocal, so the injected code can assign them too. """
+    freevars = func.__code__.co_freevars
+    if not freevars:
+        return signature + body
+
+    # a nonlocal statement must come before any use of its names, so the original ones are replaced by ours
+    body = source.remove_nonlocal_statements(signature + body)[len(signature):]
+    return signature + _INDENT_STRING + 'nonlocal {}\n'.format(', '.join(freevars)) + body
+
+
+def _compile_modified_codes(funcs_and_sources):
+    """
+    Compiles the modified sources of many functions with a single compile.
+    Each function keeps its own name, and its code is found by the line its definition starts at, so functions with
+    the same name don't collide, and no new names are created (the compiler interns names for good).
+    Closures are defined inside a wrapper function which declares their free variables.
+    The code objects are taken from the constants of the compiled code, so nothing is executed
+    (which also means annotations and defaults aren't evaluated away from the function's module).
+    """
+    with instrumentation.phase('compile', [func for func, _ in funcs_and_sources]):
+        return _compile_group(funcs_and_sources)
+
+
+def _compile_group(funcs_and_sources):
+    definitions = []
+    line_ranges = []  # the lines of every definition in the compiled source
+    first_lineno = 1
+    for func, modified_source in funcs_and_sources:
+        if func.__closure__ is not None:
+            definitions.append(_closure_wrapper_source(func, modified_source, _CLOSURE_WRAPPER_NAME))
         else:
-            raise
+            definitions.append(modified_source)
+        next_lineno = first_lineno + definitions[-1].count('\n') + 1
+        line_ranges.append(range(first_lineno, next_lineno))
+        first_lineno = next_lineno
+
+    module_code = _compile_definitions('\n'.join(definitions))
+
+    codes = []
+    for (func, _), lines in zip(funcs_and_sources, line_ranges):
+        if func.__closure__ is not None:
+            wrapper_code = _find_code_const(module_code, _CLOSURE_WRAPPER_NAME, lines)
+            modified_code = _find_code_const(wrapper_code, func.__code__.co_name, lines)
+        else:
+            modified_code = _find_code_const(module_code, func.__code__.co_name, lines)
+        codes.append(_restore_code_names(modified_code, func.__code__))
 
+    return codes
 
-def _create_modified_function(func, modified_source):
-    throwaway_module = ModuleType('_internal_')
 
-    is_closure = func.__closure__ is not None
-    if is_closure:
-        modified_function = _modify_closure_function(func, modified_source, throwaway_module)
+def _find_code_const(code, name, lines):
+    return next(const for const in code.co_consts
+                if isinstance(const, CodeType) and const.co_name == name and const.co_firstlineno in lines)
 
-    else:
-        _create_function_in_inner_module(modified_source, throwaway_module)
-        modified_function = getattr(throwaway_module, func.__name__)
 
-    return modified_function
+def _restore_code_names(modified_code, original_code):
+    if modified_code.co_name == original_code.co_name and \
+            getattr(modified_code, 'co_qualname', None) == getattr(original_code, 'co_qualname', None):
+        return modified_code
+    if hasattr(original_code, 'co_qualname'):  # python 3.11+
+        return modified_code.replace(co_name=original_code.co_name, co_qualname=original_code.co_qualname)
+    return modified_code.replace(co_name=original_code.co_name)
 
 
-def _modify_closure_function(func, modified_source, throwaway_module):
+def _closure_wrapper_source(func, modified_source, wrapper_name):
     func_freevars = func.__code__.co_freevars
     freevars_declarations = '\n    '.join('{} = None'.format(varname) for varname in func_freevars)
 
-    closure_signature, closure_body_lines = _divide_source(modified_source)
-    closure_body_lines = _indent_source_lines(closure_body_lines, indent_level=1)
-    closure_body = '\n'.join(line.code for line in closure_body_lines)
-    closure_source = closure_signature + closure_body
+    closure_source = ('\n' + _INDENT_STRING).join(modified_source.splitlines())
 
-    wrapper_name = '_wrapper'
     wrapper_source = \
-        """def {wrapper_name}():\n    {freevars_declarations}\n    {closure_source}\n    return {func_name}""".format(
+        """def {wrapper_name}():\n    {freevars_declarations}\n    {closure_source}\n""".format(
             freevars_declarations=freevars_declarations,
             closure_source=closure_source,
-            func_name=func.__name__,
             wrapper_name=wrapper_name)
 
-    _create_function_in_inner_module(wrapper_source, throwaway_module)
-    wrapper_func = getattr(throwaway_module, wrapper_name)
-    modified_function = wrapper_func()
-
-    return modified_function
+    return wrapper_source
 
 
-def _create_function_in_inner_module(function_source, module):
+def _compile_definitions(definitions_source):
+    instrumentation.count_compiled_module()
     try:
-        exec(function_source, module.__dict__)
+        return compile(definitions_source, '<string>', 'exec')
     except IndentationError as e:
         raise ValueError('There\'s a problem with the indentation. Maybe forgot to set indent_inner?') from e
 
@@ -116,12 +678,31 @@ def _create_function_in_inner_module(function_source, module):
 _SourceLine = collections.namedtuple('SourceLine', ['code', 'number'])
 
 
-def _modify_source(func, start, end, insert_lines, indent_inner, indent_lines):
-    if not any([start, end, insert_lines, indent_lines]):
+def _modify_source(raw_source, start, end, insert_lines, indent_inner, indent_lines, engine, on_exit='',
+                   on_return='', bind=None, inline=None):
+    func_signature, func_body = _modify_source_parts(raw_source, start, end, insert_lines, indent_inner,
+                                                     indent_lines, engine, on_exit, on_return, bind, inline)
+    return func_signature + func_body
+
+
+def _modify_source_parts(raw_source, start, end, insert_lines, indent_inner, indent_lines, engine, on_exit='',
+                         on_return='', bind=None, inline=None):
+    if not any([start, end, insert_lines, indent_lines, on_exit, on_return, bind, inline]):
         raise ValueError('Must supply code to inject or indent.')
 
-    func_source = _get_function_source(func)
-    func_signature, func_body_lines = _divide_source(func_source)
+    with instrumentation.phase('parse'):
+        func_signature, func_body_lines = _parse_function_source(raw_source, engine)
+    with instrumentation.phase('modify'):
+        return _modify_body(func_signature, func_body_lines, start, end, insert_lines, indent_inner, indent_lines,
+                            on_exit, on_return, bind, inline)
+
+
+def _modify_body(func_signature, func_body_lines, start, end, insert_lines, indent_inner, indent_lines, on_exit,
+                 on_return, bind, inline):
+    if bind:
+        func_body_lines = _bind_names(func_body_lines, bind)
+    if inline:
+        func_body_lines = _inline_calls(func_body_lines, inline)
 
     _put_wrappers_in_insert_lines(start, end, func_body_lines, insert_lines)
     if indent_inner:
@@ -129,9 +710,33 @@ def _modify_source(func, start, end, insert_lines, indent_inner, indent_lines):
 
     insert_lines = _indent_inserted_lines(insert_lines)
     func_body = _process_body(insert_lines, func_body_lines, indent_lines)
+    if on_return:
+        func_body = source.add_return_code(func_signature + func_body, on_return,
+                                           _RETURN_VALUE_NAME)[len(func_signature):]
+    if on_exit:
+        func_body = _wrap_in_try_finally(func_body, on_exit)
+    return func_signature, func_body
+
+
+def _bind_names(func_body_lines, bind):
+    replacements = {name: _placeholder_expression(placeholder) for name, placeholder in bind.items()}
+    # the whole body is replaced at once, since a line on its own may not be valid code (e.g. in a multi-line string)
+    bound_body = source.replace_names('\n'.join(line.code for line in func_body_lines), replacements)
+    return [_SourceLine(code, line.number) for code, line in zip(bound_body.split('\n'), func_body_lines)]
+
 
-    modified_source = func_signature + func_body
-    return modified_source
+def _inline_calls(func_body_lines, inline):
+    templates = {name: inlined.template for name, inlined in inline.items()}
+    inlined_body = source.inline_calls('\n'.join(line.code for line in func_body_lines), templates)
+    return [_SourceLine(code, line.number) for code, line in zip(inlined_body.split('\n'), func_body_lines)]
+
+
+def _wrap_in_try_finally(func_body, on_exit):
+    # finally also runs when a generator is exhausted or closed, so it covers every way out of the function
+    return '\n'.join([_INDENT_STRING + 'try:',
+                      _indent_code(func_body, indent_level=1),
+                      _INDENT_STRING + 'finally:',
+                      _indent_code(on_exit, indent_level=2)])
 
 
 def _put_wrappers_in_insert_lines(start, end, func_body_lines, insert_lines):
@@ -219,8 +824,15 @@ def _indent_inserted_lines(insert_lines):
 #     return start_indented
 
 
-def _get_function_source(func):
-    func_source = inspect.getsource(func)
+def _parse_function_source(raw_source, engine):
+    if engine == 'regex':
+        return _divide_source(_prepare_function_source(raw_source))
+
+    parsed = source.parse_function_source(raw_source)
+    return parsed.signature, [_SourceLine(code, linenum) for linenum, code in enumerate(parsed.body_lines)]
+
+
+def _prepare_function_source(func_source):
     func_source = _unindent_source(func_source)
     func_source = _strip_leading_decorators(func_source)
     return func_source
@@ -228,14 +840,13 @@ def _get_function_source(func):
 
 def _indent_code(code, indent_level):
     relative_indent_string = indent_level * _INDENT_STRING
-    return '\n' + relative_indent_string + ('\n' + relative_indent_string).join(code.splitlines()) + '\n'
+    return relative_indent_string + ('\n' + relative_indent_string).join(code.splitlines())
 
 
 def _unindent_source(func_source):
     signature_regex = re.search(_FUNC_SIGNATURE_REGEX, func_source)
     sig_start_index = signature_regex.start()
 
-    # TODO: all of this probably currently doesn't support async syntax and such
     try:
         newline_before_sig_index = func_source[:sig_start_index].rindex('\n')  # get the new-line closest to the signature on it's left
         white_before_sig_index = newline_before_sig_index + 1  # truncate the newline itself
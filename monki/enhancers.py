@@ -1,30 +1,1018 @@
+import array
+import ast
+import bisect
+import builtins
+import collections
+import copy
+import functools
 import inspect
+import itertools
+import math
+import threading
+import time
+import types
+import typing
+import weakref
 
 from . import core
+from . import lazy as lazy_patching
+from . import registry
+from . import source
 
 
-def typecheck(func):
+def typecheck(func=None, depth=1, sample=1):
     """
     This decorator injects runtime type-checking in the beginning of the function, according to the function's
-    type annotations.
+    type annotations, and checks the returned value according to the return annotation.
     Unannotated parameters are not typechecked.
+
+    The types of every check are compiled into the function as constants, so nothing is looked up on each call.
+    Plain classes are checked with a single isinstance. `Optional`, `Union` and the builtin containers and their
+    `typing` aliases (e.g. `List[int]`, `Dict[str, int]`, `Tuple[int, ...]`) are supported, while annotations
+    which can't be checked (like `Any` or a `TypeVar`) are skipped.
+
+    Can be used as `@typecheck` or as `@typecheck(depth=2, sample=100)`.
+
+    :param depth:
+        How many levels of containers to check the items of. With the default of 1, the items of a `List[int]`
+        are checked, but only the lists (and not their items) of a `List[List[int]]`.
+    :param sample:
+        Check only 1 in `sample` calls, to bound the overhead.
+    Use `disable_typechecks()` to turn off all of the checks in the process at once.
     """
-    func_annotations = func.__annotations__
+    if func is None:
+        return lambda func: typecheck(func, depth, sample)
+    if not (isinstance(sample, int) and sample >= 1):
+        raise ValueError('sample must be a positive integer.')
 
-    if not func_annotations:
+    lazy_patching.resolve(func)  # the trampoline of a pending lazy patch has no annotated parameters
+    constants = {}
+    annotations = _get_annotations(func)
+    check_lines = []
+    for parameter in inspect.signature(func).parameters.values():
+        if parameter.name not in annotations:
+            continue
+        annotation, parameter_depth = annotations[parameter.name], depth
+        if parameter.default is None:  # `a: int = None` is implicitly optional
+            annotation = typing.Optional[annotation]
+        if parameter.kind == inspect.Parameter.VAR_POSITIONAL:
+            annotation, parameter_depth = typing.Tuple[annotation, ...], depth + 1
+        elif parameter.kind == inspect.Parameter.VAR_KEYWORD:
+            annotation, parameter_depth = typing.Dict[str, annotation], depth + 1
+        check = _check_statement(parameter.name, parameter.name, annotation, parameter_depth, constants)
+        if check is not None:
+            check_lines.append(check)
+
+    return_check = None
+    if 'return' in annotations and not (inspect.isgeneratorfunction(func) or inspect.isasyncgenfunction(func)):
+        return_check = _check_statement('return value', core._RETURN_VALUE_NAME, annotations['return'], depth,
+                                        constants)
+
+    if not check_lines and return_check is None:
         return func
 
-    check_lines = []
-    for arg_name, arg_type in func_annotations.items():
-        check_lines.append('if not isinstance({arg_name}, {arg_type}): '
-                           'raise TypeError("{arg_name} must be of type {arg_type}. Was of type: {{actual_type}}".format(actual_type=type({arg_name}).__name__))'
-                           .format(arg_name=arg_name, arg_type=arg_type.__name__))
-    checks = '\n'.join(check_lines)
+    # the checks read the switch of disable_typechecks() on every call, so it works whatever is patched on top
+    constants['__monki_typechecks_enabled'] = _typechecks_enabled
+    guard = '__monki_typechecks_enabled[0]'
+    if sample > 1:
+        constants['__monki_next_call'] = itertools.count().__next__
+        guard += ' and not __monki_next_call() % {}'.format(sample)
+    check_lines = ['__monki_checked = {}'.format(guard)] + \
+        ['__monki_checked and ({})'.format(line) for line in check_lines]
+    if return_check is not None:
+        return_check = '__monki_checked and ({})'.format(return_check)
 
-    core.patch(func, start=checks)
+    core.patch(func, start='\n'.join(check_lines), on_return=return_check or '', constants=constants)
     return func
 
 
+def disable_typechecks():
+    """
+    Turn off the checks of every function decorated with `typecheck`, including ones decorated later and ones
+    which were patched again since. A disabled check only reads a flag.
+    """
+    _typechecks_enabled[0] = False
+
+
+def enable_typechecks():
+    _typechecks_enabled[0] = True
+
+
+_typechecks_enabled = [True]  # compiled into every check, which reads it on every call
+_NONE_TYPE = type(None)
+_ITEM_NAME = '__monki_item_{}'
+_UNION_ORIGINS = (typing.Union, getattr(types, 'UnionType', typing.Union))  # X | Y is python 3.10+
+_SINGLE_ITEM_TYPE_ORIGINS = (list, set, frozenset)
+
+
+def _get_annotations(func):
+    try:
+        return typing.get_type_hints(func)
+    except Exception:  # e.g. a string annotation of a name which can't be resolved
+        return {name: annotation for name, annotation in func.__annotations__.items()
+                if not isinstance(annotation, str)}
+
+
+def _check_statement(description, name, annotation, depth, constants):
+    check = _check_expression(name, annotation, depth, constants, level=0)
+    if check is None:
+        return None
+    fail = _constant(constants, _raise_type_error)
+    return '{check} or {fail}({description!r}, {name}, {expected!r})'.format(
+        check=check, fail=fail, description=description, name=name, expected=_describe(annotation))
+
+
+def _check_expression(name, annotation, depth, constants, level):
+    """ Returns an expression which is true if `name` matches the annotation, or None if it can't be checked. """
+    isinstance_name = _constant(constants, isinstance)
+    if annotation is None or annotation is _NONE_TYPE:
+        return '{} is None'.format(name)
+    if annotation is typing.Any or annotation is object:
+        return None
+
+    origin = typing.get_origin(annotation)
+    if origin is None:
+        if not isinstance(annotation, type):  # e.g. a TypeVar
+            return None
+        return '{}({}, {})'.format(isinstance_name, name, _constant(constants, annotation))
+
+    args = typing.get_args(annotation)
+    if origin in _UNION_ORIGINS:
+        plain_types = tuple(arg for arg in args if isinstance(arg, type) and typing.get_origin(arg) is None)
+        checks = ['{}({}, {})'.format(isinstance_name, name, _constant(constants, plain_types))] if plain_types else []
+        for arg in args:
+            if arg not in plain_types:
+                check = _check_expression(name, arg, depth, constants, level)
+                if check is None:  # anything may match this member, so there's nothing to check
+                    return None
+                checks.append(check)
+        return '({})'.format(' or '.join(checks))
+
+    if not isinstance(origin, type):  # e.g. Literal or Callable
+        return None
+    origin_check = '{}({}, {})'.format(isinstance_name, name, _constant(constants, origin))
+    if level >= depth or not args:
+        return origin_check
+
+    item = _ITEM_NAME.format(level)
+    all_name = _constant(constants, all)
+    if origin in _SINGLE_ITEM_TYPE_ORIGINS or (origin is tuple and len(args) == 2 and args[1] is Ellipsis):
+        item_check = _check_expression(item, args[0], depth, constants, level + 1)
+        if item_check is None:
+            return origin_check
+        return '({} and {}({} for {} in {}))'.format(origin_check, all_name, item_check, item, name)
+
+    if origin is tuple:
+        item_types = [] if args == ((),) else args  # Tuple[()] is the empty tuple
+        checks = [origin_check, '{}({}) == {}'.format(_constant(constants, len), name, len(item_types))]
+        for index, arg in enumerate(item_types):
+            checks.append(_check_expression('{}[{}]'.format(name, index), arg, depth, constants, level + 1))
+        return '({})'.format(' and '.join(check for check in checks if check is not None))
+
+    if origin is dict:
+        key, value = item + '_key', item + '_value'
+        checks = [check for check in (_check_expression(key, args[0], depth, constants, level + 1),
+                                      _check_expression(value, args[1], depth, constants, level + 1))
+                  if check is not None]
+        if not checks:
+            return origin_check
+        return '({} and {}({} for {}, {} in {}.items()))'.format(
+            origin_check, all_name, ' and '.join(checks), key, value, name)
+
+    return origin_check
+
+
+def _constant(constants, value):
+    """ Returns the name of a constant with the given value, adding it if it's new. """
+    for name, existing in constants.items():
+        if existing is value:
+            return name
+    name = '__monki_constant_{}'.format(len(constants))
+    constants[name] = value
+    return name
+
+
+def _describe(annotation):
+    if isinstance(annotation, type) and typing.get_origin(annotation) is None:
+        return annotation.__name__
+    return repr(annotation).replace('typing.', '')
+
+
+def _raise_type_error(name, value, expected):
+    raise TypeError('{} must be of type {}. Was of type: {}'.format(name, expected, type(value).__name__))
+
+
+def memoize(func=None, maxsize=128, ttl=None, key=None, thread_safe=False):
+    """
+    This decorator caches the function's results, like `functools.lru_cache`, but the cache lookup is injected
+    in the beginning of the function and the store before every return, instead of wrapping the function.
+    A cache hit costs no extra call, and the function stays the same object with its own `__code__`.
+
+    The cached arguments are the values of the parameters after binding, so `f(1, b=2)` and `f(1, 2)` share an
+    entry, and so do calls which rely on a default. Coroutine functions cache the awaited result.
+
+    The function gets `cache_info()`, `cache_clear()` and `cache_invalidate(*args, **kwargs)` attributes.
+
+    Can be used as `@memoize` or as `@memoize(maxsize=1000, ttl=60)`.
+
+    :param maxsize:
+        The number of results to keep. When it's exceeded, the least recently used result is evicted.
+        None keeps every result.
+    :param ttl:
+        The number of seconds a result is valid for, or None to keep results until they're evicted.
+    :param key:
+        A callable which is called with the same arguments as the function, and returns the cache key to use
+        instead of the arguments, e.g. to cache by an id. Its result must be hashable.
+    :param thread_safe:
+        Lock the cache around every lookup and store. Without it, the function must not be called from more than
+        one thread at a time.
+    """
+    if func is None:
+        return lambda func: memoize(func, maxsize, ttl, key, thread_safe)
+    if maxsize is not None and not (isinstance(maxsize, int) and maxsize >= 1):
+        raise ValueError('maxsize must be a positive integer or None.')
+    if ttl is not None and not (isinstance(ttl, (int, float)) and ttl > 0):
+        raise ValueError('ttl must be a positive number or None.')
+    if key is not None and not callable(key):
+        raise TypeError('key must be callable.')
+    lazy_patching.resolve(func)  # the trampoline of a pending lazy patch has neither the parameters nor the flags
+    if inspect.isgeneratorfunction(func) or inspect.isasyncgenfunction(func):
+        raise TypeError('Generator functions can\'t be memoized.')
+
+    parameters = list(inspect.signature(func).parameters.values())
+    cache = _MemoCache(maxsize, ttl, thread_safe)
+    constants = {
+        '__monki_get': cache.data.get,
+        '__monki_move_to_end': cache.data.move_to_end,
+        '__monki_miss': _MISSING,
+        '__monki_stats': cache.stats,
+        '__monki_store': cache.store,
+    }
+    if key is not None:
+        constants['__monki_key_func'] = key
+        key_code = '__monki_key_func({})'.format(_call_arguments(parameters))
+    else:
+        constants.update(__monki_tuple=tuple, __monki_sorted=sorted)
+        key_code = _key_expression(parameters)
+
+    lookup_lines = ['__monki_key = ' + key_code,
+                    '__monki_value = __monki_get(__monki_key, __monki_miss)',
+                    'if __monki_value is not __monki_miss:']
+    hit_lines = ['__monki_stats[{}] += 1'.format(_HITS)]
+    if maxsize is not None:  # without evictions, the order of the results doesn't matter
+        hit_lines.insert(0, '__monki_move_to_end(__monki_key)')
+    if ttl is None:
+        lookup_lines += ['    ' + line for line in hit_lines + ['return __monki_value']]
+    else:
+        constants['__monki_time'] = time.monotonic
+        lookup_lines.append('    if __monki_value[1] > __monki_time():')
+        lookup_lines += ['        ' + line for line in hit_lines + ['return __monki_value[0]']]
+        lookup_lines.append('    __monki_value = __monki_miss')
+    lookup_lines.append('__monki_stats[{}] += 1'.format(_MISSES))
+    if thread_safe:
+        constants['__monki_lock'] = cache.lock
+        lookup_lines = ['with __monki_lock:'] + ['    ' + line for line in lookup_lines]
+
+    # the returns of cache hits are rewritten too, but only misses store their result
+    core.patch(func, start='\n'.join(lookup_lines),
+               on_return='__monki_value is __monki_miss and __monki_store(__monki_key, __return__)',
+               constants=constants)
+
+    def cache_invalidate(*args, **kwargs):
+        """ Drop the cached result of calling the function with these arguments. Returns whether there was one. """
+        bound = inspect.signature(func).bind(*args, **kwargs)
+        bound.apply_defaults()
+        if key is not None:
+            return cache.invalidate(key(*bound.args, **bound.kwargs))
+        return cache.invalidate(_key_from_arguments(parameters, bound.arguments))
+
+    func.cache_info = cache.info
+    func.cache_clear = cache.clear
+    func.cache_invalidate = cache_invalidate
+    return func
+
+
+CacheInfo = collections.namedtuple('CacheInfo', ['hits', 'misses', 'evictions', 'size', 'maxsize', 'ttl'])
+
+_MISSING = object()
+_HITS, _MISSES, _EVICTIONS = range(3)
+
+
+class _MemoCache:
+    """
+    The results of a memoized function. The cache hit path is compiled into the function itself and only reads
+    `data` and increments `stats`, so everything else lives here.
+    With a ttl, every value is stored as (value, expiry time). Expired values are replaced when they're stored
+    again, or evicted like any other value.
+    """
+    def __init__(self, maxsize, ttl, thread_safe):
+        self.data = collections.OrderedDict()  # in LRU order, so evicting pops the first item
+        self.stats = [0, 0, 0]  # hits, misses, evictions
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.lock = threading.Lock() if thread_safe else None
+
+    def store(self, key, value):
+        if self.lock is not None:
+            with self.lock:
+                self._store(key, value)
+        else:
+            self._store(key, value)
+
+    def _store(self, key, value):
+        self.data[key] = value if self.ttl is None else (value, time.monotonic() + self.ttl)
+        self.data.move_to_end(key)  # a key which is stored again (e.g. because it expired) was just used
+        if self.maxsize is not None and len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
+            self.stats[_EVICTIONS] += 1
+
+    def invalidate(self, key):
+        return self._locked(self.data.pop, key, _MISSING) is not _MISSING
+
+    def clear(self):
+        """ Drop every cached result and reset the stats. """
+        self._locked(self._clear)
+
+    def _clear(self):
+        self.data.clear()
+        self.stats[:] = [0, 0, 0]
+
+    def info(self):
+        return CacheInfo(*self.stats, size=len(self.data), maxsize=self.maxsize, ttl=self.ttl)
+
+    def _locked(self, func, *args):
+        if self.lock is None:
+            return func(*args)
+        with self.lock:
+            return func(*args)
+
+
+def _key_expression(parameters):
+    """ Returns an expression of the cache key: the values of the parameters, or the only value if there's one. """
+    if not parameters:
+        return 'None'
+    values = [('__monki_tuple(__monki_sorted({}.items()))' if parameter.kind == inspect.Parameter.VAR_KEYWORD
+               else '{}').format(parameter.name) for parameter in parameters]
+    if len(parameters) == 1 and parameters[0].kind != inspect.Parameter.VAR_KEYWORD:
+        return values[0]
+    return '({},)'.format(', '.join(values))
+
+
+def _key_from_arguments(parameters, arguments):
+    """ The key which `_key_expression` computes in the function, from the bound arguments of a call. """
+    if not parameters:
+        return None
+    values = [tuple(sorted(arguments[parameter.name].items())) if parameter.kind == inspect.Parameter.VAR_KEYWORD
+              else arguments[parameter.name] for parameter in parameters]
+    if len(parameters) == 1 and parameters[0].kind != inspect.Parameter.VAR_KEYWORD:
+        return values[0]
+    return tuple(values)
+
+
+def _call_arguments(parameters):
+    """ Returns the arguments which pass the function's parameters on to a function with the same signature. """
+    arguments = []
+    for parameter in parameters:
+        if parameter.kind == inspect.Parameter.VAR_POSITIONAL:
+            arguments.append('*' + parameter.name)
+        elif parameter.kind == inspect.Parameter.VAR_KEYWORD:
+            arguments.append('**' + parameter.name)
+        elif parameter.kind == inspect.Parameter.KEYWORD_ONLY:
+            arguments.append('{0}={0}'.format(parameter.name))
+        else:
+            arguments.append(parameter.name)
+    return ', '.join(arguments)
+
+
+def timed(func=None, histogram=None, sample=1):
+    """
+    This decorator records the function's latency into a histogram with fixed buckets. The timing is injected into
+    the function itself, in a try/finally around its body, so it covers returns and exceptions alike and there's no
+    wrapper call. Recording a call only reads the clock twice and increments a bucket, without allocating anything.
+    For generators and coroutines, the latency includes the time they were suspended.
+
+    Read the histograms with `latency_snapshot()` or `latency_percentiles()`, and clear them with `reset_latencies()`.
+
+    Can be used as `@timed` or as `@timed(sample=100)`.
+
+    :param histogram:
+        The upper bounds of the buckets, in nanoseconds, in increasing order. Latencies above the last bound are
+        counted in an extra bucket. Defaults to powers of 2 from about 1 microsecond to about a minute.
+    :param sample:
+        Time only 1 in `sample` calls. The calls which aren't timed only decrement a counter.
+    """
+    if func is None:
+        return lambda func: timed(func, histogram, sample)
+    if not (isinstance(sample, int) and sample >= 1):
+        raise ValueError('sample must be a positive integer.')
+    bounds = _DEFAULT_LATENCY_BOUNDS if histogram is None else tuple(histogram)
+    if not bounds or any(not isinstance(bound, int) or bound <= 0 for bound in bounds) or \
+            any(low >= high for low, high in zip(bounds, bounds[1:])):
+        raise ValueError('histogram must be increasing positive integers.')
+
+    counts = array.array('Q', bytes(8 * (len(bounds) + 1)))
+    constants = {'__monki_clock': time.perf_counter_ns, '__monki_bisect': bisect.bisect_left,
+                 '__monki_bounds': bounds, '__monki_counts': counts}
+    record = '__monki_counts[__monki_bisect(__monki_bounds, __monki_clock() - __monki_started)] += 1'
+    if sample == 1:
+        start = '__monki_started = __monki_clock()'
+    else:
+        constants['__monki_countdown'] = [sample]
+        start = '\n'.join(['__monki_started = 0',
+                           '__monki_countdown[0] -= 1',
+                           'if __monki_countdown[0] <= 0:',
+                           '    __monki_countdown[0] = {}'.format(sample),
+                           '    __monki_started = __monki_clock()'])
+        record = 'if __monki_started:\n    ' + record
+
+    core.patch(func, start=start, on_exit=record, constants=constants)
+    _latency_histograms[func] = LatencyHistogram(bounds, counts, sample)
+    return func
+
+
+LatencyHistogram = collections.namedtuple('LatencyHistogram', ['bounds', 'counts', 'sample'])
+LatencyPercentiles = collections.namedtuple('LatencyPercentiles', ['p50', 'p99', 'p999', 'count'])
+
+_DEFAULT_LATENCY_BOUNDS = tuple(2 ** exponent for exponent in range(10, 37))
+_latency_histograms = weakref.WeakKeyDictionary()  # function => LatencyHistogram
+
+
+def latency_snapshot():
+    """
+    Returns a dict of function => LatencyHistogram for every function decorated with `timed`.
+    The counts of the snapshot are a copy, with the count of the overflow bucket last.
+    """
+    return {func: histogram._replace(counts=tuple(histogram.counts))
+            for func, histogram in list(_latency_histograms.items())}
+
+
+def latency_percentiles():
+    """
+    Returns a dict of function => LatencyPercentiles for every function decorated with `timed`.
+    A percentile is the upper bound of the bucket it falls in, inf if it's the overflow bucket, or None if no call
+    was timed yet. `count` is the number of timed calls.
+    """
+    percentiles = {}
+    for func, histogram in latency_snapshot().items():
+        percentiles[func] = LatencyPercentiles(
+            *(_percentile(histogram, quantile) for quantile in (0.5, 0.99, 0.999)), count=sum(histogram.counts))
+    return percentiles
+
+
+def reset_latencies():
+    """ Clear the histograms of every function decorated with `timed`. """
+    for histogram in list(_latency_histograms.values()):
+        histogram.counts[:] = array.array('Q', bytes(8 * len(histogram.counts)))  # in place, the function uses it
+
+
+def _percentile(histogram, quantile):
+    remaining = math.ceil(quantile * sum(histogram.counts))
+    if not remaining:
+        return None
+    for index, count in enumerate(histogram.counts):
+        remaining -= count
+        if remaining <= 0:
+            return histogram.bounds[index] if index < len(histogram.bounds) else math.inf
+
+
+def bind_globals(func=None, names=None, freeze=True):
+    """
+    This decorator binds the globals and builtins which the function reads to their current values, by compiling
+    them into the function as constants. It's the `def func(..., _len=len)` trick, without changing the signature.
+
+    Rebinding a global afterwards doesn't affect the function, until `rebind(func)` is called.
+    Names which the function assigns or uses as locals (including in nested functions) are never bound.
+
+    Can be used as `@bind_globals` or as `@bind_globals(names=['len', 'helper'])`.
+
+    :param names:
+        The names to bind. Defaults to every global and builtin the function reads and which is defined.
+    :param freeze:
+        If False, only builtins (which aren't shadowed by a global) are bound, and module globals are
+        looked up on every call as usual.
+    """
+    if func is None:
+        return lambda func: bind_globals(func, names, freeze)
+
+    lazy_patching.resolve(func)
+    bindable = core._bindable_globals(func.__code__)
+    if names is None:
+        names = sorted(name for name in bindable if _is_defined(func, name))
+    elif set(names) - bindable:
+        raise ValueError('{} can\'t be bound in {}: the function doesn\'t only read them as globals.'.format(
+            ', '.join(sorted(set(names) - bindable)), func.__qualname__))
+    if not freeze:
+        names = [name for name in names if name not in func.__globals__]
+
+    values = {name: core._lookup_global(func, name) for name in names}
+    if values:
+        core.patch(func, bind=values)
+    return func
+
+
+def rebind(func):
+    """
+    Bind the names which `bind_globals` bound in the function again, to their current values.
+    Call it after replacing a global which the function uses, e.g. in tests.
+    """
+    record = registry.get(func)
+    if record is None or not any(spec.bind for spec in record.specs):
+        raise ValueError('{} has no bound globals.'.format(func.__qualname__))
+    values = {placeholder: core._lookup_global(func, name)
+              for spec in record.specs for name, placeholder in spec.bind.items()}
+    core._replace_constants(func, values)
+
+
+def inline(*helpers):
+    """
+    This decorator inlines the calls of small helper functions: every call of a helper in the decorated function
+    is replaced by the helper's expression, with the arguments substituted into it.
+    A helper must be a lambda or a function whose body is a single return statement. Helpers which are recursive,
+    closures, take *args or **kwargs, or use frame-dependent builtins like `locals()` are refused.
+
+    Arguments which are names or constants are substituted as they are. When a call has a more complex argument,
+    all of its arguments are evaluated once, in order, into temporary variables.
+    The helper's globals and its default values are bound as they are when the function is decorated, like
+    `bind_globals` does, so the helper's default expressions are never evaluated again.
+
+        @inline(clamp, is_valid)
+        def process(items):
+            return [clamp(item, 0, 100) for item in items if is_valid(item)]
+    """
+    def dec(func):
+        lazy_patching.resolve(func)
+        bindable = core._bindable_globals(func.__code__)
+        inlined = {}
+        for helper in helpers:
+            names = [name for name in bindable if _is_defined(func, name) and core._lookup_global(func, name) is helper]
+            if not names:
+                raise ValueError('{} doesn\'t call {}.'.format(func.__qualname__, getattr(helper, '__qualname__', helper)))
+            inlined.update(dict.fromkeys(names, helper))
+        core.patch(func, inline=inlined)
+        return func
+
+    return dec
+
+
+def specialize(func=None, warmup=1000, max_variants=2, max_deopts=3):
+    """
+    This decorator specializes the function for the types of the arguments it's actually called with.
+
+    For the first `warmup` calls, an injected probe counts the combinations of the argument types. Then the most
+    common combinations get their own copy of the body, in which `isinstance(arg, SomeType)` and
+    `type(arg) is SomeType` checks of the arguments are folded into constants, and the branches they decide are
+    dropped. A single comparison of the tuple of the argument types picks the copy, and calls with other types
+    run the original body. Checks of an argument are only folded until it may have been reassigned.
+
+    Every `warmup` calls which run the original body, the function checks whether they were the majority since
+    the last check, and if so it's deoptimized: it goes back to counting types, and is specialized again.
+
+    The names of the checked types are looked up when the copies are made. *args and **kwargs aren't specialized
+    for. If none of the copies would be simpler, the function is left as it was.
+    Read the guard hits with `specialization_stats(func)`.
+
+    Can be used as `@specialize` or as `@specialize(warmup=100)`.
+
+    :param warmup: The number of calls to count the argument types of before specializing.
+    :param max_variants: The number of type combinations to make copies of the body for.
+    :param max_deopts: The number of times the function can be deoptimized before its copies are kept for good.
+    """
+    if func is None:
+        return lambda func: specialize(func, warmup, max_variants, max_deopts)
+    if not all(isinstance(value, int) and value >= 1 for value in (warmup, max_variants)):
+        raise ValueError('warmup and max_variants must be positive integers.')
+    if not (isinstance(max_deopts, int) and max_deopts >= 0):
+        raise ValueError('max_deopts must be a non-negative integer.')
+
+    lazy_patching.resolve(func)
+    if func in _specializers and func.__code__ is _specializers[func].patched_code:
+        raise ValueError('{} is already specialized.'.format(func.__qualname__))
+    code = func.__code__
+    parameters = code.co_varnames[:code.co_argcount + code.co_kwonlyargcount]
+    if not parameters:
+        raise ValueError('{} has no parameters to specialize for.'.format(func.__qualname__))
+    reassigned_cells = set()  # parameters which nested functions can reassign
+    for statement in _body_statements(func):
+        if any(isinstance(node, (ast.Global, ast.Nonlocal)) for node in _walk_scope(statement)):
+            raise ValueError('Functions with global or nonlocal statements can\'t be specialized.')
+        reassigned_cells.update(name for node in ast.walk(statement) if isinstance(node, ast.Nonlocal)
+                                for name in node.names)
+
+    specializer = _specializers[func] = _Specializer(func, parameters, reassigned_cells, warmup, max_variants,
+                                                     max_deopts)
+    specializer.observe()
+    return func
+
+
+SpecializationStats = collections.namedtuple('SpecializationStats',
+                                             ['variants', 'guard_hits', 'fallbacks', 'hit_rate', 'deopts'])
+
+_specializers = weakref.WeakKeyDictionary()  # function => _Specializer
+
+
+def specialization_stats(func):
+    """
+    Returns the SpecializationStats of a specialized function: the type combinations it has copies for (empty while
+    it's counting types), the calls which each copy ran, the calls which ran the original body, the fraction of the
+    calls which ran a copy (None before the first call), and the number of times it was deoptimized.
+    """
+    specializer = _specializers.get(func)
+    if specializer is None:
+        raise ValueError('{} isn\'t specialized.'.format(func.__qualname__))
+    return specializer.stats()
+
+
+class _Specializer:
+    def __init__(self, func, parameters, reassigned_cells, warmup, max_variants, max_deopts):
+        self.func_ref = weakref.ref(func)  # the function's code holds the specializer
+        self.parameters = parameters
+        # the types of parameters which nested functions reassign are only used in the guard
+        self.foldable = [name not in reassigned_cells for name in parameters]
+        self.warmup = warmup
+        self.max_variants = max_variants
+        self.max_deopts = max_deopts
+        self.deopts = 0
+        self.lock = threading.Lock()
+        self.observed = collections.Counter()
+        self.remaining = warmup
+        self.variants = []
+        self.counts = []  # the hits of every variant, and then the fallbacks
+        self.checked_counts = (0, 0)  # the hits and fallbacks at the last check
+        self.patched_code = None  # only the specializer's own patch is undone, if nothing was patched on top of it
+
+    def observe(self):
+        func = self.func_ref()
+        self.observed.clear()
+        self.remaining = self.warmup
+        self.variants = []
+        self.counts = []
+        core.patch(func, start='__monki_count_types({})'.format(self.types_expression()),
+                   constants={'__monki_count_types': self.count_types, '__monki_type': type})
+        self.patched_code = func.__code__
+
+    def count_types(self, types):
+        self.observed[types] += 1
+        self.remaining -= 1
+        if self.remaining <= 0:
+            self.specialize()
+
+    def specialize(self):
+        func = self.func_ref()
+        with self.lock:
+            if func is None or func.__code__ is not self.patched_code:  # another thread already specialized it
+                return
+            core._pop_patch(func)
+            self.patched_code = None
+
+            statements = _body_statements(func)
+            resolve = functools.partial(_resolve_names, func, core._bindable_globals(func.__code__))
+            variants = []
+            for types, _ in self.observed.most_common(self.max_variants):
+                if len(self.parameters) == 1:
+                    types = (types,)
+                known_types = {name: value for name, value, foldable in zip(self.parameters, types, self.foldable)
+                               if foldable}
+                folder = _TypeCheckFolder(known_types, resolve)
+                folded = folder.visit(ast.Module(body=copy.deepcopy(statements), type_ignores=[]))
+                if folder.folded:
+                    variants.append((types, _fill_empty_blocks(folded.body)))
+            if not variants:
+                return
+
+            self.variants = [types for types, _ in variants]
+            self.counts = [0] * (len(variants) + 1)
+            self.checked_counts = (0, 0)
+            core.patch(func, start=self.dispatch_code([body for _, body in variants]),
+                       constants={'__monki_type': type, '__monki_guards': self.guards(),
+                                  '__monki_counts': self.counts, '__monki_check': self.check})
+            self.patched_code = func.__code__
+
+    def check(self):
+        hits, fallbacks = sum(self.counts[:-1]), self.counts[-1]
+        checked_hits, checked_fallbacks = self.checked_counts
+        self.checked_counts = (hits, fallbacks)
+        if fallbacks - checked_fallbacks <= hits - checked_hits or self.deopts >= self.max_deopts:
+            return
+        func = self.func_ref()
+        with self.lock:
+            if func is None or func.__code__ is not self.patched_code:
+                return
+            core._pop_patch(func)
+            self.deopts += 1
+            self.observe()
+
+    def guards(self):
+        # a single argument's type is compared by identity, and a tuple of types element by element
+        if len(self.parameters) == 1:
+            return tuple(types[0] for types in self.variants)
+        return tuple(self.variants)
+
+    def types_expression(self):
+        if len(self.parameters) == 1:
+            return '__monki_type({})'.format(self.parameters[0])
+        return '({})'.format(', '.join('__monki_type({})'.format(name) for name in self.parameters))
+
+    def dispatch_code(self, bodies):
+        fallback = len(bodies)
+        guards = [ast.parse('__monki_types {} __monki_guards[{}]'.format(
+            'is' if len(self.parameters) == 1 else '==', index), mode='eval').body for index in range(fallback)]
+        branches = ast.parse('__monki_counts[{0}] += 1\n'
+                             'if not __monki_counts[{0}] % {1}:\n'
+                             '    __monki_check()'.format(fallback, self.warmup)).body
+        for index in reversed(range(fallback)):
+            body = ast.parse('__monki_counts[{}] += 1'.format(index)).body + bodies[index]
+            if not isinstance(body[-1], (ast.Return, ast.Raise)):  # the original body mustn't run after the copy
+                body.append(ast.Return())
+            branches = [ast.If(test=guards[index], body=body, orelse=branches)]
+        return '__monki_types = {}\n{}'.format(self.types_expression(), ast.unparse(branches[0]))
+
+    def stats(self):
+        hits = self.counts[:-1]
+        fallbacks = self.counts[-1] if self.counts else 0
+        calls = sum(hits) + fallbacks
+        return SpecializationStats(list(self.variants), hits, fallbacks, sum(hits) / calls if calls else None,
+                                   self.deopts)
+
+
+class _TypeCheckFolder(ast.NodeTransformer):
+    """
+    Folds the type checks of parameters with known types into constants, and drops the branches they decide.
+    The statements are visited in order, and a parameter is forgotten from the first statement which may assign it.
+    """
+
+    def __init__(self, known_types, resolve):
+        self.known_types = known_types
+        self.resolve = resolve  # returns the value an expression names, or _MISSING
+        self.folded = False
+
+    def visit(self, node):
+        if isinstance(node, ast.stmt) and not isinstance(node, ast.If):
+            self.forget(_assigned_names(node))
+        return super().visit(node)
+
+    def forget(self, names):
+        self.known_types = {name: value for name, value in self.known_types.items() if name not in names}
+
+    def visit_If(self, node):
+        self.forget(_assigned_names(node.test))
+        node.test = self.visit(node.test)
+        after_test = self.known_types
+        node.body = self.visit_block(node.body)
+        self.known_types = after_test
+        node.orelse = self.visit_block(node.orelse)
+        self.known_types = after_test
+        if isinstance(node.test, ast.Constant):
+            self.folded = True
+            kept = node.body if node.test.value else node.orelse
+            self.forget(set().union(*map(_assigned_names, kept)))  # a dropped branch doesn't assign anything
+            return kept
+        self.forget(_assigned_names(node))
+        return node
+
+    def visit_block(self, statements):
+        block = []
+        for statement in statements:
+            result = self.visit(statement)
+            block.extend(result if isinstance(result, list) else [result])
+        return block
+
+    def visit_Assert(self, node):
+        node.test = self.visit(node.test)
+        if isinstance(node.test, ast.Constant) and node.test.value:
+            self.folded = True
+            return []
+        return node
+
+    def visit_Call(self, node):
+        self.generic_visit(node)
+        if self.is_builtin_call(node, 'isinstance', 2):
+            known_type = self.known_types.get(node.args[0].id)
+            classinfo = self.resolve(node.args[1])
+            if known_type is not None and classinfo is not _MISSING:
+                return self.constant(_isinstance_of_type(known_type, classinfo), node)
+        return node
+
+    def visit_Compare(self, node):
+        self.generic_visit(node)
+        if len(node.ops) != 1 or not self.is_builtin_call(node.left, 'type', 1):
+            return node
+        known_type = self.known_types.get(node.left.args[0].id)
+        other = self.resolve(node.comparators[0])
+        if known_type is None or other is _MISSING:
+            return node
+        op = node.ops[0]
+        if isinstance(op, (ast.Is, ast.IsNot)) or (isinstance(op, (ast.Eq, ast.NotEq)) and
+                                                   type(known_type) is type and type(other) is type):
+            return self.constant((known_type is other) == isinstance(op, (ast.Is, ast.Eq)), node)
+        return node
+
+    def visit_BoolOp(self, node):
+        self.generic_visit(node)
+        # `x and y` is x if x is falsy and otherwise y, so constants which can't be the result are dropped
+        is_and = isinstance(node.op, ast.And)
+        values = []
+        for value in node.values:
+            if isinstance(value, ast.Constant):
+                if bool(value.value) != is_and:
+                    values.append(value)
+                    break
+                if value is not node.values[-1]:
+                    continue
+            values.append(value)
+        if len(values) == len(node.values):
+            return node
+        self.folded = True
+        if len(values) == 1:
+            return values[0]
+        node.values = values
+        return node
+
+    def visit_UnaryOp(self, node):
+        self.generic_visit(node)
+        if isinstance(node.op, ast.Not) and isinstance(node.operand, ast.Constant):
+            return self.constant(not node.operand.value, node)
+        return node
+
+    def visit_IfExp(self, node):
+        self.generic_visit(node)
+        if isinstance(node.test, ast.Constant):
+            self.folded = True
+            return node.body if node.test.value else node.orelse
+        return node
+
+    def visit_FunctionDef(self, node):
+        return node  # nested scopes can shadow the parameters
+
+    visit_AsyncFunctionDef = visit_ClassDef = visit_Lambda = visit_FunctionDef
+
+    def is_builtin_call(self, node, name, argument_count):
+        return isinstance(node, ast.Call) and len(node.args) == argument_count and not node.keywords and \
+            isinstance(node.args[0], ast.Name) and self.resolve(node.func) is getattr(builtins, name)
+
+    def constant(self, value, node):
+        if value is None:
+            return node
+        self.folded = True
+        return ast.copy_location(ast.Constant(value=value), node)
+
+
+def _isinstance_of_type(known_type, classinfo):
+    """ Returns isinstance() of any instance of the type, or None if it depends on the instance. """
+    try:
+        if issubclass(known_type, classinfo):
+            return True
+    except TypeError:
+        return None
+    # isinstance also checks the instance's __class__, which a class can fake in Python
+    for base in known_type.__mro__[:-1]:
+        get_attribute = vars(base).get('__getattribute__', object.__getattribute__)
+        if '__class__' in vars(base) or not isinstance(get_attribute, types.WrapperDescriptorType):
+            return None
+    return False
+
+
+def _resolve_names(func, bindable, node):
+    """ Returns the value of a global name, an attribute of one or a tuple of these, or _MISSING. """
+    if isinstance(node, ast.Name):
+        return core._lookup_global(func, node.id) if node.id in bindable and _is_defined(func, node.id) else _MISSING
+    if isinstance(node, ast.Attribute):
+        value = _resolve_names(func, bindable, node.value)
+        return _MISSING if value is _MISSING else getattr(value, node.attr, _MISSING)
+    if isinstance(node, ast.Tuple):
+        values = tuple(_resolve_names(func, bindable, item) for item in node.elts)
+        return _MISSING if _MISSING in values else values
+    return _MISSING
+
+
+def _body_statements(func):
+    """ Returns the statements of the function's current body, without the docstring. """
+    parsed = source.parse_function_source(core._get_current_source(func))
+    statements = ast.parse(parsed.signature + '\n'.join(parsed.body_lines)).body[0].body
+    first = statements[0]
+    if isinstance(first, ast.Expr) and isinstance(first.value, ast.Constant) and isinstance(first.value.value, str):
+        statements = statements[1:]
+    return statements
+
+
+def _assigned_names(node):
+    """ Returns the names which the node may assign or delete. """
+    names = set()
+    for child in ast.walk(node):
+        if isinstance(child, ast.Name) and not isinstance(child.ctx, ast.Load):
+            names.add(child.id)
+        elif isinstance(child, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            names.add(child.name)
+        elif isinstance(child, ast.alias):
+            names.add((child.asname or child.name).split('.')[0])
+        elif isinstance(child, (ast.ExceptHandler, *_CAPTURE_PATTERNS)) and child.name:
+            names.add(child.name)
+        elif isinstance(child, _MAPPING_PATTERNS) and child.rest:
+            names.add(child.rest)
+    return names
+
+
+_CAPTURE_PATTERNS = tuple(getattr(ast, name) for name in ('MatchAs', 'MatchStar') if hasattr(ast, name))
+_MAPPING_PATTERNS = tuple(getattr(ast, name) for name in ('MatchMapping',) if hasattr(ast, name))
+
+
+def _walk_scope(node):
+    """ Like ast.walk, without going into nested functions and classes. """
+    pending = [node]
+    while pending:
+        current = pending.pop()
+        yield current
+        if current is node or not isinstance(current, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef,
+                                                       ast.Lambda)):
+            pending.extend(ast.iter_child_nodes(current))
+
+
+def _fill_empty_blocks(statements):
+    """ Puts a `pass` in the blocks which were emptied by dropping statements. """
+    for node in ast.walk(ast.Module(body=statements, type_ignores=[])):
+        if isinstance(getattr(node, 'body', None), list) and not node.body:
+            node.body = [ast.Pass()]
+        if hasattr(node, 'handlers') and hasattr(node, 'finalbody') and not (node.handlers or node.finalbody):
+            node.finalbody = [ast.Pass()]
+    return statements or [ast.Pass()]
+
+
+def batched(func=None, typecode=None):
+    """
+    This decorator adds a `func.batch(*columns)` function, which calls the function for every item, like
+    `list(map(func, *columns))`, but in a single frame: the function's body is wrapped in a loop over the items,
+    and every return statement stores its value in a preallocated result list and continues to the next item.
+    Items which fall off the end of the body get None.
+
+    There's a column for every parameter, with the same name (defaults aren't used), and every column must be
+    a sequence, e.g. a list, an `array.array` or a memoryview. The results stop at the shortest column.
+    The function itself isn't changed.
+
+        @batched
+        def to_celsius(fahrenheit):
+            return (fahrenheit - 32) * 5 / 9
+
+        to_celsius.batch(array.array('d', readings))
+
+    Can be used as `@batched` or as `@batched(typecode='d')`.
+
+    :param typecode:
+        Return an `array.array` of this typecode instead of a list, for numeric results.
+        Every item must then return a number.
+    """
+    if func is None:
+        return lambda func: batched(func, typecode)
+    lazy_patching.resolve(func)
+    if inspect.isgeneratorfunction(func) or inspect.isasyncgenfunction(func) or inspect.iscoroutinefunction(func):
+        raise TypeError('Generator functions and coroutine functions can\'t be batched.')
+    parameters = list(inspect.signature(func).parameters.values())
+    if not parameters or any(parameter.kind not in (inspect.Parameter.POSITIONAL_ONLY,
+                                                    inspect.Parameter.POSITIONAL_OR_KEYWORD)
+                             for parameter in parameters):
+        raise ValueError('Only functions with positional parameters, and no *args, can be batched.')
+
+    parsed = source.parse_function_source(core._get_current_source(func))
+    func_source = parsed.signature + '\n'.join(parsed.body_lines)
+    for node in _walk_scope(ast.parse(func_source).body[0]):
+        if isinstance(node, (ast.For, ast.AsyncFor, ast.While)) and \
+                any(isinstance(child, ast.Return) for child in _walk_scope(node)):
+            raise ValueError('Functions which return from inside a loop can\'t be batched.')
+
+    # every return stores its value and continues to the next item
+    func_source = source.replace_returns(func_source, lambda value: [
+        '__monki_results[__monki_index] = ({})'.format(value), 'continue'])
+    # the columns are named after the parameters, so errors about the arguments of batch() name them too.
+    # the length and the iterator read the columns before the loop assigns the names to the items
+    names = [parameter.name for parameter in parameters]
+    if len(parameters) == 1:
+        length = '__monki_len({})'.format(names[0])
+        loop = 'for __monki_index, {0} in __monki_enumerate({0}):'.format(names[0])
+    else:
+        length = '__monki_min({})'.format(', '.join('__monki_len({})'.format(name) for name in names))
+        loop = 'for __monki_index, ({0}) in __monki_enumerate(__monki_zip({0})):'.format(', '.join(names))
+    spec = core._make_spec(start='__monki_results = __monki_empty * {}\n{}'.format(length, loop),
+                           end='return __monki_results', indent_inner=1, constants={
+                               '__monki_empty': [None] if typecode is None else array.array(typecode, [0]),
+                               '__monki_len': len, '__monki_min': min, '__monki_enumerate': enumerate,
+                               '__monki_zip': zip})
+
+    _, body = core._modify_source_parts(func_source, spec.start, spec.end, dict(spec.insert_lines), spec.indent_inner,
+                                        spec.indent_lines, spec.engine)
+    signature = 'def {}({}):\n'.format(func.__code__.co_name, ', '.join(names))
+    code = core._compile_modified_codes([(func, core._declare_free_variables(func, signature, body))])[0]
+    code = core._substitute_constants(code, spec.constants)
+
+    batch = types.FunctionType(code, func.__globals__, func.__name__, None, func.__closure__)
+    batch.__qualname__ = func.__qualname__ + '.batch'
+    batch.__doc__ = 'Calls {} for every item of the columns, and returns the list of the results.'.format(
+        func.__qualname__)
+    func.batch = batch
+    return func
+
+
+def _is_defined(func, name):
+    return name in func.__globals__ or hasattr(builtins, name)
+
+
 def ignoreerror(error):
     code_for_error = _error_to_python_code(error)
 
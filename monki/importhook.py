@@ -0,0 +1,188 @@
+"""
+An import hook which patches functions while their module is being imported.
+
+The hook is a `sys.meta_path` finder. For the modules it was given specs for, it rewrites the module's AST
+before the module is compiled, so the functions are compiled once, already patched, and unpatched code
+never runs. The compiled module is written to its own bytecode file in ``__pycache__`` (next to the
+regular one, with an optimization tag derived from the specs), so warm imports load as fast as unpatched
+modules and nothing is patched at runtime.
+"""
+import ast
+import hashlib
+import importlib.machinery
+import importlib.util
+import io
+import marshal
+import sys
+
+from . import core
+
+
+_FORMAT_VERSION = 1
+_MAGIC = importlib.util.MAGIC_NUMBER + b'monki-import' + bytes([_FORMAT_VERSION])
+_LOCALS_MARKER = '<locals>'
+_STATEMENT_LIST_FIELDS = ('body', 'orelse', 'finalbody', 'handlers', 'cases')
+
+
+def install_import_hook(specs):
+    """
+    Patch functions when their modules are imported.
+
+    :param specs:
+        A dict of module name => {qualified name => spec}, where each spec is a dict of keyword arguments
+        to `patch`, e.g. {'package.module': {'SomeClass.some_method': {'start': 'print("Starting")'}}}.
+        Only source mode is supported, and the modules must not be imported yet.
+    """
+    module_specs = {}
+    for module_name, qualname_specs in specs.items():
+        if module_name in sys.modules:
+            raise ValueError('{} is already imported, so it can\'t be patched on import.'.format(module_name))
+        module_specs[module_name] = {qualname: core._make_spec(**spec)
+                                     for qualname, spec in qualname_specs.items()}
+        if any(spec.mode != 'source' for spec in module_specs[module_name].values()):
+            raise ValueError('Only source mode patches can be applied on import.')
+        if any(spec.constants for spec in module_specs[module_name].values()):
+            raise ValueError('Patches with constants can\'t be applied on import.')
+
+    finder = _get_finder()
+    if finder is None:
+        finder = _PatchingFinder()
+        sys.meta_path.insert(0, finder)
+    finder.module_specs.update(module_specs)
+
+
+def uninstall_import_hook():
+    """ Stop patching modules on import. Modules which were already imported stay patched. """
+    finder = _get_finder()
+    if finder is not None:
+        sys.meta_path.remove(finder)
+
+
+def _get_finder():
+    return next((finder for finder in sys.meta_path if isinstance(finder, _PatchingFinder)), None)
+
+
+class _PatchingFinder:
+    def __init__(self):
+        self.module_specs = {}
+
+    def find_spec(self, fullname, path=None, target=None):
+        qualname_specs = self.module_specs.get(fullname)
+        if qualname_specs is None:
+            return None
+
+        spec = _find_spec_with_other_finders(self, fullname, path, target)
+        if spec is None:
+            return None
+        if not isinstance(spec.loader, importlib.machinery.SourceFileLoader):
+            raise ImportError('monki can only patch modules which are imported from source files, '
+                              'but {} is loaded by {!r}.'.format(fullname, spec.loader), name=fullname)
+        spec.loader = _PatchingLoader(fullname, spec.origin, qualname_specs)
+        return spec
+
+    def invalidate_caches(self):
+        pass
+
+
+def _find_spec_with_other_finders(this_finder, fullname, path, target):
+    for finder in sys.meta_path:
+        if finder is not this_finder and hasattr(finder, 'find_spec'):
+            spec = finder.find_spec(fullname, path, target)
+            if spec is not None:
+                return spec
+    return None
+
+
+class _PatchingLoader(importlib.machinery.SourceFileLoader):
+    def __init__(self, fullname, path, qualname_specs):
+        super().__init__(fullname, path)
+        self.qualname_specs = qualname_specs
+        self.specs_digest = hashlib.sha256(repr(sorted(
+            (qualname, core._spec_for_cache(spec)) for qualname, spec in qualname_specs.items())).encode()).digest()
+
+    def get_code(self, fullname):
+        source_path = self.get_filename(fullname)
+        bytecode_path = importlib.util.cache_from_source(
+            source_path, optimization='monki' + self.specs_digest.hex()[:16])
+        stats = self.path_stats(source_path)
+        header = _MAGIC + self.specs_digest + _pack_stats(stats)
+
+        try:
+            data = self.get_data(bytecode_path)
+        except OSError:
+            data = None
+        if data is not None and data.startswith(header):
+            try:
+                return marshal.loads(data[len(header):])
+            except (EOFError, ValueError, TypeError):
+                pass  # a corrupt file is simply rewritten
+
+        code = self.source_to_code(self.get_data(source_path), source_path)
+        if not sys.dont_write_bytecode:
+            self.set_data(bytecode_path, header + marshal.dumps(code))  # atomic, like regular bytecode files
+        return code
+
+    def source_to_code(self, data, path, *, _optimize=-1):
+        source_text = importlib.util.decode_source(data)
+        tree = ast.parse(source_text, path)
+        lines = io.StringIO(source_text).readlines()  # splits like ast does, unlike str.splitlines
+        for qualname, spec in self.qualname_specs.items():
+            _patch_definition(tree, lines, qualname, spec, self.name)
+        return compile(tree, path, 'exec', dont_inherit=True, optimize=_optimize)
+
+
+def _pack_stats(stats):
+    return (int(stats['mtime']) & 0xFFFFFFFFFFFFFFFF).to_bytes(8, 'little') + \
+        (stats.get('size', 0) & 0xFFFFFFFFFFFFFFFF).to_bytes(8, 'little')
+
+
+def _patch_definition(tree, lines, qualname, spec, module_name):
+    """ Replaces the function's node in the module's tree with the node of the patched function. """
+    statements, index = _find_definition(tree, qualname, module_name)
+    node = statements[index]
+
+    func_source = ''.join(lines[node.lineno - 1:node.end_lineno])
+    modified_source = core._modify_source_with_spec(func_source, spec)
+    new_node = ast.parse(modified_source).body[0]
+    ast.increment_lineno(new_node, node.lineno - 1)  # the rest of the module keeps its line numbers
+    new_node.decorator_list = node.decorator_list
+    statements[index] = new_node
+
+
+def _find_definition(tree, qualname, module_name):
+    """ Returns the statement list which defines the function, and the function's index in it. """
+    scope = tree
+    found = None
+    for name in qualname.split('.'):
+        if name == _LOCALS_MARKER:
+            continue
+        found = next(((statements, index) for statements, index in _iter_definitions(scope.body)
+                      if statements[index].name == name), None)
+        if found is None:
+            raise ValueError('Can\'t find {} in module {}.'.format(qualname, module_name))
+        scope = found[0][found[1]]
+
+    if not isinstance(scope, (ast.FunctionDef, ast.AsyncFunctionDef)):
+        raise TypeError('{} in module {} is not a function.'.format(qualname, module_name))
+    return found
+
+
+def _iter_definitions(statements):
+    """
+    Returns (statement list, index) for every function and class defined directly in the scope,
+    including ones nested in if/try/with blocks. When a name is defined more than once, the last one wins.
+    """
+    definitions = []
+    pending = [statements]
+    while pending:
+        current = pending.pop()
+        for index, node in enumerate(current):
+            if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+                definitions.append((node.lineno, current, index))
+                continue
+            for field in _STATEMENT_LIST_FIELDS:
+                body = getattr(node, field, None)
+                if body:
+                    pending.append(body)
+    definitions.sort(key=lambda definition: definition[0], reverse=True)
+    return [(current, index) for _, current, index in definitions]
@@ -0,0 +1,167 @@
+"""
+Timing of the phases of patching, to tell how much of a program's startup time goes to monki.
+
+Collecting is off by default, and then every phase costs a single check of a flag. When it's on (with
+`enable_stats()`, or with the ``MONKI_TRACE=1`` environment variable), the time of every phase is added to the
+totals of the function being patched and to the global totals, which `stats()` returns. With ``MONKI_TRACE=1``,
+a line is also written to stderr for every patch.
+
+The phases are:
+
+- source: reading the function's source (``inspect.getsource``, or reading its file once in `patch_many`)
+- parse: finding the signature and the body in the source
+- modify: injecting, indenting, binding and inlining the code
+- compile: compiling the modified source, or splicing the bytecode in bytecode mode
+- cache: loading and storing patched code in the on-disk cache
+- swap: replacing the function's ``__code__``
+
+The functions of a `patch_many` call which share a source file are compiled together, so the compile time of
+the group is split evenly between them.
+"""
+import collections
+import contextlib
+import os
+import sys
+import time
+import weakref
+
+
+PHASES = ('source', 'parse', 'modify', 'compile', 'cache', 'swap')
+_TRACE_ENV_VAR = 'MONKI_TRACE'
+
+PatchStats = collections.namedtuple('PatchStats', ['patches', 'compiled_modules', 'code_size', 'source_size',
+                                                   'phase_ns', 'functions'])
+PatchStats.__doc__ = """
+The totals of all of the patches since the stats were enabled or reset.
+`compiled_modules` is the number of throwaway modules which were compiled to get the patched code objects from,
+`code_size` is the total size of the patched bytecode in bytes and `source_size` the total length of the
+modified sources. `phase_ns` is a dict of phase => nanoseconds, and `functions` is a dict of
+'module.qualified_name' => FunctionPatchStats.
+"""
+FunctionPatchStats = collections.namedtuple('FunctionPatchStats', ['patches', 'code_size', 'source_size',
+                                                                   'phase_ns'])
+
+_NO_PHASE = contextlib.nullcontext()
+
+
+class _Collector:
+    def __init__(self):
+        self.enabled = False
+        self.trace = False
+        self.reset()
+
+    def reset(self):
+        self.patches = 0
+        self.compiled_modules = 0
+        self.code_size = 0
+        self.source_size = 0
+        self.phase_ns = dict.fromkeys(PHASES, 0)
+        self.functions = {}  # 'module.qualified_name' => [patches, code size, source size, phase_ns]
+        self.pending = weakref.WeakKeyDictionary()  # function => phase_ns of the patch in progress
+        self.current = None  # the function whose patch is in progress
+
+    @contextlib.contextmanager
+    def time_phase(self, name, funcs):
+        started = time.perf_counter_ns()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter_ns() - started
+            self.phase_ns[name] += elapsed
+            if funcs is None:
+                funcs = [] if self.current is None else [self.current]
+            for func in funcs:
+                pending = self.pending.setdefault(func, dict.fromkeys(PHASES, 0))
+                pending[name] += elapsed // len(funcs)
+
+    @contextlib.contextmanager
+    def patching(self, func):
+        previous, self.current = self.current, func
+        try:
+            yield
+        finally:
+            self.current = previous
+
+    def record_patch(self, func, code, source_size):
+        phase_ns = self.pending.pop(func, None) or dict.fromkeys(PHASES, 0)
+        name = '{}.{}'.format(getattr(func, '__module__', None), func.__qualname__)
+        totals = self.functions.setdefault(name, [0, 0, 0, dict.fromkeys(PHASES, 0)])
+        totals[0] += 1
+        totals[1] += len(code.co_code)
+        totals[2] += source_size
+        for phase, elapsed in phase_ns.items():
+            totals[3][phase] += elapsed
+        self.patches += 1
+        self.code_size += len(code.co_code)
+        self.source_size += source_size
+
+        if self.trace:
+            sys.stderr.write('monki: patched {} in {:.3f}ms ({}), {} bytes of bytecode\n'.format(
+                name, sum(phase_ns.values()) / 1e6,
+                ', '.join('{} {:.3f}'.format(phase, elapsed / 1e6) for phase, elapsed in phase_ns.items() if elapsed),
+                len(code.co_code)))
+
+
+_collector = _Collector()
+
+
+def enable_stats(trace=False):
+    """
+    Start collecting the timings of patching.
+
+    :param trace: Also write a line to stderr for every patch.
+    """
+    _collector.enabled = True
+    _collector.trace = trace
+
+
+def disable_stats():
+    """ Stop collecting the timings of patching. The stats collected so far are kept. """
+    _collector.enabled = False
+    _collector.trace = False
+
+
+def reset_stats():
+    _collector.reset()
+
+
+def stats():
+    """ Returns the PatchStats of all of the patches since the stats were enabled or reset. """
+    return PatchStats(
+        _collector.patches, _collector.compiled_modules, _collector.code_size, _collector.source_size,
+        dict(_collector.phase_ns),
+        {name: FunctionPatchStats(patches, code_size, source_size, dict(phase_ns))
+         for name, (patches, code_size, source_size, phase_ns) in _collector.functions.items()})
+
+
+def phase(name, funcs=None):
+    """
+    A context manager which times a phase of patching.
+
+    :param funcs: The functions to split the time between. Defaults to the function whose patch is in progress.
+    """
+    if not _collector.enabled:
+        return _NO_PHASE
+    return _collector.time_phase(name, funcs)
+
+
+def patching(func):
+    """ A context manager which attributes the phases inside it to the function. """
+    if not _collector.enabled:
+        return _NO_PHASE
+    return _collector.patching(func)
+
+
+def count_compiled_module():
+    if _collector.enabled:
+        _collector.compiled_modules += 1
+
+
+def record_patch(func, code, source_size):
+    """ Adds the phases of the function's patch, which was just applied, to its totals. """
+    if _collector.enabled:
+        _collector.record_patch(func, code, source_size)
+
+
+if os.environ.get(_TRACE_ENV_VAR) == '1':
+    enable_stats(trace=True)
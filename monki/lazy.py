@@ -0,0 +1,141 @@
+"""
+Lazy patching: instead of patching a function right away, its code is replaced by a tiny trampoline.
+The first call to the function applies the pending patches and then forwards the call to the patched function,
+so functions which are never called never pay for patching. The trampoline stays in place until the patched code
+replaces it: calls from other threads in the meantime wait for the patches in the trampoline, instead of running
+the unpatched code. While the patches are applied, `current_code` returns the code under the trampoline.
+
+The function's lock (see `registry`) is always taken before the lock of the pending patches, which is only held
+to update the pending patches, and not while they're applied.
+"""
+import collections
+import itertools
+import threading
+import weakref
+
+from . import registry
+
+
+_TRAMPOLINE_NAME = '__monki_trampoline__'
+_SCOPE_NAME = '__monki_scope__'
+
+_PendingPatch = collections.namedtuple('PendingPatch', ['original_code', 'trampoline_code', 'appliers'])
+
+_pending = {}  # function => _PendingPatch
+_resolving = {}  # function => _PendingPatch, while its patches are applied
+# kept after the patches are applied, for calls which already entered the trampoline in another thread
+_funcs_by_token = weakref.WeakValueDictionary()
+_tokens = itertools.count()
+_lock = threading.RLock()
+
+
+def install(func, applier):
+    """
+    Replace the function's code with a trampoline which calls `applier()` on the first call.
+    Installing more than once before the first call runs the appliers in order.
+
+    :param applier: A callable with no arguments, which patches the function.
+    """
+    with registry.lock_for(func), _lock:
+        pending = _pending.get(func)
+        if pending is not None:
+            pending.appliers.append(applier)
+            return
+
+        token = next(_tokens)
+        pending = _pending[func] = _PendingPatch(func.__code__, _make_trampoline_code(func.__code__, token), [applier])
+        _funcs_by_token[token] = func
+        func.__code__ = pending.trampoline_code
+
+
+def resolve(func):
+    """ Apply the function's pending patches, if it has any. """
+    with registry.lock_for(func):
+        with _lock:
+            pending = _pending.pop(func, None)
+            if pending is None:
+                return
+            _resolving[func] = pending
+        try:
+            for applier in pending.appliers:
+                applier()
+        finally:
+            with _lock:
+                del _resolving[func]
+            if func.__code__ is pending.trampoline_code:  # the first patch failed, so nothing replaced the trampoline
+                func.__code__ = pending.original_code
+
+
+def current_code(func):
+    """
+    Returns the function's code, or the original code under its trampoline while its pending patches are applied,
+    which is the code the patches are applied to.
+    """
+    pending = _resolving.get(func)
+    return pending.original_code if pending is not None and func.__code__ is pending.trampoline_code else func.__code__
+
+
+def cancel(func):
+    """ Drop the function's pending patches and restore its code. """
+    with registry.lock_for(func), _lock:
+        _pop(func)
+
+
+def cancel_all():
+    with _lock:
+        funcs = list(_pending)
+    for func in funcs:
+        cancel(func)
+
+
+def _pop(func):
+    pending = _pending.pop(func, None)
+    if pending is not None:
+        func.__code__ = pending.original_code
+    return pending
+
+
+def resolve_all():
+    """ Apply all of the pending patches. """
+    with _lock:
+        funcs = list(_pending)
+    for func in funcs:
+        resolve(func)
+
+
+def pending_count():
+    return len(_pending)
+
+
+def is_pending(func):
+    return func in _pending
+
+
+def _call(token, args, kwargs):
+    """ Called by the trampolines. """
+    func = _funcs_by_token[token]
+    resolve(func)
+    return func(*args, **kwargs)
+
+
+def _trampoline_source(code, token):
+    lines = ['def {}():'.format(_SCOPE_NAME)]
+    lines += ['    {} = None'.format(name) for name in code.co_freevars]
+    lines.append('    def {}(*__monki_args__, **__monki_kwargs__):'.format(_TRAMPOLINE_NAME))
+    if code.co_freevars:
+        # never runs, but makes the trampoline a closure over the same number of cells as the original function
+        lines.append('        if 0: {},'.format(', '.join(code.co_freevars)))
+    lines.append('        return __import__("monki.lazy", fromlist=["_"])._call('
+                 '{}, __monki_args__, __monki_kwargs__)'.format(token))
+    return '\n'.join(lines) + '\n'
+
+
+def _make_trampoline_code(code, token):
+    module_code = compile(_trampoline_source(code, token), code.co_filename, 'exec')
+    scope_code = next(const for const in module_code.co_consts if hasattr(const, 'co_code'))
+    trampoline_code = next(const for const in scope_code.co_consts if hasattr(const, 'co_code'))
+    # keep the name and location, so tracebacks and inspect.getsource still point at the original function
+    trampoline_code = trampoline_code.replace(co_name=code.co_name, co_firstlineno=code.co_firstlineno)
+    if hasattr(code, 'co_qualname'):  # python 3.11+
+        trampoline_code = trampoline_code.replace(co_qualname=code.co_qualname)
+    return trampoline_code
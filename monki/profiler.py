@@ -0,0 +1,99 @@
+"""
+A line profiler which is injected into the profiled functions, instead of tracing them.
+
+Before every top-level statement of the function's body, a probe reads `time.perf_counter_ns`, adds the time since
+the previous probe to the previous statement and counts a hit for the next one. The time of the last statement is
+added when the function exits. The counts and times are kept in preallocated lists (which the interpreter
+indexes faster than `array.array`, since it specializes list subscripts), so a probe is a handful of bytecodes
+and a single call, and the functions which aren't profiled don't pay anything.
+"""
+import ast
+import collections
+import time
+import weakref
+
+from . import core
+from . import lazy as lazy_patching
+from . import source
+
+
+LineStats = collections.namedtuple('LineStats', ['line', 'hits', 'time_ns', 'code'])
+
+_LineTable = collections.namedtuple('LineTable', ['lines', 'codes', 'hits', 'times', 'profiled_code'])
+
+_tables = weakref.WeakKeyDictionary()  # function => _LineTable
+
+_FIRST_PROBE = '''\
+__monki_hits[0] += 1
+__monki_line = 0
+__monki_started = __monki_clock()'''
+
+_PROBE = '''\
+__monki_now = __monki_clock()
+__monki_times[__monki_line] += __monki_now - __monki_started
+__monki_hits[{index}] += 1
+__monki_line = {index}
+__monki_started = __monki_now'''
+
+_EXIT = '__monki_times[__monki_line] += __monki_clock() - __monki_started'
+
+
+def profile_lines(func):
+    """
+    Count the hits and measure the time of every top-level statement in the function's body.
+    The time of a statement includes everything it runs, e.g. a whole loop, and for generators and coroutines
+    it also includes the time they were suspended in it.
+    Read the results with `line_stats(func)`, and stop profiling with `unpatch(func)`.
+    """
+    lazy_patching.resolve(func)
+    table = _tables.get(func)
+    if table is not None and func.__code__ is table.profiled_code:
+        raise ValueError('{} is already profiled.'.format(func.__qualname__))
+
+    parsed = source.parse_function_source(core._get_current_source(func))
+    lines = _statement_lines(parsed)
+    hits = [0] * len(lines)
+    times = [0] * len(lines)
+    insert_lines = {line: _PROBE.format(index=index) for index, line in enumerate(lines)}
+    insert_lines[lines[0]] = _FIRST_PROBE
+
+    core.patch(func, insert_lines=insert_lines, on_exit=_EXIT,
+               constants={'__monki_hits': hits, '__monki_times': times, '__monki_clock': time.perf_counter_ns})
+    codes = [parsed.body_lines[line].strip() for line in lines]
+    _tables[func] = _LineTable(lines, codes, hits, times, func.__code__)
+    return func
+
+
+def line_stats(func):
+    """
+    Returns a list of LineStats of the function's profiled statements, in order. Each one has the number of the
+    statement's first body line (numbered like `insert_lines`), its hits, its total time in nanoseconds and its code.
+    The stats are kept after the function is unpatched.
+    """
+    table = _tables.get(func)
+    if table is None:
+        raise ValueError('{} was never profiled.'.format(func.__qualname__))
+    return [LineStats(*stats) for stats in zip(table.lines, table.hits, table.times, table.codes)]
+
+
+def _statement_lines(parsed):
+    """ Returns the body line numbers of the top-level statements, without the docstring. """
+    signature_line_count = parsed.signature.count('\n')
+    tree = ast.parse(parsed.signature + '\n'.join(parsed.body_lines))
+    statements = tree.body[0].body
+    if _is_docstring(statements[0]):
+        statements = statements[1:]
+    if not statements:
+        raise ValueError('There are no statements to profile.')
+    # statements which share a line (`a = 1; b = 2`) are profiled together. a decorated def or class starts at its
+    # first decorator, so the probe goes before the decorators
+    return sorted({_first_line(statement) - 1 - signature_line_count for statement in statements})
+
+
+def _first_line(statement):
+    return min([statement.lineno] + [decorator.lineno for decorator in getattr(statement, 'decorator_list', [])])
+
+
+def _is_docstring(statement):
+    return isinstance(statement, ast.Expr) and isinstance(statement.value, ast.Constant) and \
+        isinstance(statement.value.value, str)
@@ -0,0 +1,158 @@
+"""
+A registry of patched functions.
+
+For every patched function, the registry keeps its original code object and the stack of specs applied to it,
+so patches can be layered on top of each other and undone. The source of a function which was patched once isn't
+kept, since sources can take more memory than the code itself when whole packages are patched: patching it again
+reads its original source again (from ``linecache``, which keeps the lines of the file anyway) and applies the spec
+to it. From the second patch on, the current source is kept, so patching the function again doesn't reapply all of
+the specs. A function patched from a bundle keeps the bundle's copy of its original source instead, compressed,
+since its source file may not be deployed.
+
+It also keeps the toggle groups: for every function in a group, the code before and after the group's patch,
+so switching a group on or off is only a matter of assigning ``__code__``.
+
+Every function has its own lock, which is held while it's patched or unpatched, from reading its current source
+to publishing its new code, so concurrent patches of the same function are applied one after the other.
+Publishing is a single assignment of ``__code__``: calls which already started finish running the old code,
+and calls which start after it run the new code. Calling a function, and switching a toggle group, never take a lock.
+When patching needs more than one lock, they are taken in a fixed order, so patches can't deadlock.
+"""
+import collections
+import contextlib
+import threading
+import weakref
+
+
+_NO_TOGGLES = frozenset()
+
+
+class PatchRecord:
+    # a record per patched function, so it's kept small: no __dict__, and tuples which are only replaced
+    __slots__ = ('original_code', 'specs', 'toggles', 'source', 'original_source')
+
+    def __init__(self, original_code):
+        self.original_code = original_code
+        self.specs = ()
+        self.toggles = _NO_TOGGLES
+        self.source = None  # the source with all of the specs applied, if it's kept
+        self.original_source = None  # the zlib compressed source before the patches, if it isn't read from its file
+
+
+_records = weakref.WeakKeyDictionary()  # function => PatchRecord
+_toggles = collections.defaultdict(list)  # toggle name => [_ToggleEntry]
+
+_ToggleEntry = collections.namedtuple('ToggleEntry', ['func', 'disabled_code', 'enabled_code'])
+
+_locks = weakref.WeakKeyDictionary()  # function => RLock
+_locks_lock = threading.RLock()  # reentrant, for a signal handler which interrupts lock_for()
+
+
+def lock_for(func):
+    """ Returns the function's lock. It's reentrant, so a patch can patch the same function again. """
+    with _locks_lock:
+        lock = _locks.get(func)
+        if lock is None:
+            lock = _locks[func] = threading.RLock()
+        return lock
+
+
+@contextlib.contextmanager
+def locked(funcs):
+    """ Holds the locks of all of the functions, which are taken in a fixed order. """
+    with contextlib.ExitStack() as stack:
+        for func in sorted(set(funcs), key=id):
+            stack.enter_context(lock_for(func))
+        yield
+
+
+def get(func):
+    return _records.get(func)
+
+
+def push(func, original_code, spec, modified_source, original_source=None):
+    record = _records.get(func)
+    if record is None:
+        record = _records[func] = PatchRecord(original_code)
+        record.original_source = original_source
+    record.specs += (spec,)
+    record.source = modified_source if len(record.specs) > 1 else None
+
+
+def is_patched(func):
+    return func in _records
+
+
+def unpatch(func):
+    """ Restore the function's original code. Returns False if the function isn't patched. """
+    with lock_for(func):
+        record = _records.pop(func, None)
+        if record is None:
+            return False
+        _remove_from_toggles(func, record.toggles)
+        func.__code__ = record.original_code
+        return True
+
+
+def unpatch_all():
+    for func in list(_records):
+        unpatch(func)
+
+
+def add_toggle(name, func, disabled_code, enabled_code):
+    record = _records[func]
+    record.toggles = record.toggles | {name}
+    _toggles[name].append(_ToggleEntry(func, disabled_code, enabled_code))
+
+
+def check_toggles_enabled(func):
+    """ Raises ValueError if the function is in a toggle group which is disabled, so it can't be patched again. """
+    record = _records.get(func)
+    if record is None:
+        return
+    for name in record.toggles:
+        for entry in _toggles[name]:
+            if entry.func is func and func.__code__ is entry.disabled_code:
+                raise ValueError('{} is part of the disabled toggle {!r}, so it can\'t be patched again until the '
+                                 'toggle is enabled.'.format(func.__qualname__, name))
+
+
+def release_toggles(func):
+    """
+    Removes the function from its toggle groups, keeping its current code. Called when it's patched again, since the
+    group's patch is then part of the code the new patch is made of, and can't be switched off on its own anymore.
+    """
+    record = _records.get(func)
+    if record is not None and record.toggles:
+        _remove_from_toggles(func, record.toggles)
+        record.toggles = _NO_TOGGLES
+
+
+def _remove_from_toggles(func, names):
+    for name in names:
+        _toggles[name] = [entry for entry in _toggles[name] if entry.func is not func]
+        if not _toggles[name]:
+            del _toggles[name]
+
+
+def has_toggle(name):
+    return name in _toggles
+
+
+def set_toggle(name, enabled):
+    entries = _toggles.get(name)
+    if entries is None:
+        raise ValueError('There are no patches with the toggle {!r}.'.format(name))
+
+    # switching is a single assignment of __code__ per function, so it takes no locks: it's fast for large groups,
+    # and can't deadlock when it's called from a signal handler which interrupted a patch
+    for entry in entries:
+        func = entry.func
+        if func.__code__ is entry.disabled_code or func.__code__ is entry.enabled_code:
+            func.__code__ = entry.enabled_code if enabled else entry.disabled_code
+        else:
+            # its code was replaced since (e.g. by an enhancer), so the group's patch can't be switched anymore
+            _remove_from_toggles(func, [name])
+            record = _records.get(func)
+            if record is not None:
+                record.toggles = record.toggles - {name}
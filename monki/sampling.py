@@ -0,0 +1,224 @@
+"""
+Finding the hot functions of a package with a sampling profiler, and timing only them.
+
+A background thread takes snapshots of the stacks of all of the other threads with `sys._current_frames()`, at a
+fixed interval. Every snapshot of a thread which is running code of the package counts a sample for the innermost
+function of the package on its stack (so time spent in the standard library or in C code, or in comprehensions,
+is counted for the package's function which called it). The sampler only reads the stacks, so the sampled threads
+aren't slowed down, except for sharing the interpreter with it while it takes a snapshot.
+
+When the sampling is over, the most sampled functions are timed with `enhancers.timed`, which patches them with
+`core.patch`. Functions which can't be patched (e.g. ones without source, or which were already patched) are
+skipped, so the `top` hottest functions which can be patched are the ones which get timed.
+
+A thread which is waiting inside the package (e.g. on a lock or a socket) is counted like one which is running,
+since a stack doesn't tell them apart.
+"""
+import collections
+import inspect
+import sys
+import threading
+import time
+import types
+
+from . import core
+from . import enhancers
+from . import lazy as lazy_patching
+from . import registry
+
+
+AutoInstrumentReport = collections.namedtuple('AutoInstrumentReport', ['sampling', 'samples', 'hot', 'probed',
+                                                                       'skipped'])
+AutoInstrumentReport.__doc__ = """
+The results of `autoinstrument`. `sampling` is True until the sampling is over and the probes were added.
+`samples` is the number of stack snapshots in which a thread was running code of the package, and `hot` is a list of
+HotFunction of every function of the package which was sampled, the most sampled first. `probed` is a dict of
+'module.qualified_name' => LatencyPercentiles of the functions which were timed, and `skipped` is a dict of
+'module.qualified_name' => the reason why a function which was hot enough to be timed wasn't.
+"""
+HotFunction = collections.namedtuple('HotFunction', ['name', 'samples', 'share'])
+
+_COMPREHENSIONS = ('<listcomp>', '<setcomp>', '<dictcomp>', '<genexpr>')
+
+
+class _Session:
+    def __init__(self, package_name, duration, top, interval, excluded_thread_ids):
+        self.package_name = package_name
+        self.duration = duration
+        self.top = top
+        self.interval = interval
+        self.excluded_thread_ids = set(excluded_thread_ids)
+        self.lock = threading.Lock()  # for the counts, which the report reads while the sampler adds to them
+        # codes are keyed by id: hashing a code object hashes its constants, which patched code can't always do
+        self.counts = collections.Counter()  # id(code) => samples
+        self.codes = {}  # id(code) => code, which also keeps the ids from being reused
+        self.code_modules = {}  # id(code) => name of its module, or None if it isn't part of the package
+        self.samples = 0
+        self.probed = {}  # name => function
+        self.skipped = {}  # name => reason
+        self.removed = False
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name='monki-sampler', daemon=True)
+
+    def run(self):
+        self.excluded_thread_ids.add(threading.get_ident())
+        deadline = time.perf_counter() + self.duration
+        while time.perf_counter() < deadline and not self.stopped.is_set():
+            self.take_sample()
+            time.sleep(self.interval)
+        if not self.stopped.is_set():
+            self.add_probes()
+
+    def take_sample(self):
+        sampled = [self.innermost_code(frame) for thread_id, frame in sys._current_frames().items()
+                   if thread_id not in self.excluded_thread_ids]
+        sampled = [code for code in sampled if code is not None]
+        with self.lock:
+            self.samples += len(sampled)
+            self.counts.update(sampled)
+
+    def innermost_code(self, frame):
+        """ Returns the code of the innermost frame of the stack which runs code of the package, or None. """
+        while frame is not None and (self.module_of(frame) is None or frame.f_code.co_name in _COMPREHENSIONS):
+            frame = frame.f_back
+        return None if frame is None else id(frame.f_code)
+
+    def module_of(self, frame):
+        """ Returns the name of the frame's module if it's part of the package, or None. """
+        code_id = id(frame.f_code)
+        try:
+            return self.code_modules[code_id]
+        except KeyError:
+            name = frame.f_globals.get('__name__')
+            if not (isinstance(name, str) and (name == self.package_name or
+                                               name.startswith(self.package_name + '.'))):
+                name = None
+            self.codes[code_id] = frame.f_code
+            self.code_modules[code_id] = name
+            return name
+
+    def add_probes(self):
+        funcs = _package_functions(self.package_name)
+        counts, _ = self.ranking()
+        for code_id, _ in counts:
+            if len(self.probed) == self.top:
+                break
+            func = funcs.get(code_id)
+            name = self.name_of(code_id, func)
+            if func is None:
+                self.skipped[name] = 'not found in the namespaces of the package (e.g. a closure or a lambda)'
+                continue
+            if registry.is_patched(func) or lazy_patching.is_pending(func):
+                self.skipped[name] = 'already patched'
+                continue
+            try:
+                enhancers.timed(func)
+            except (OSError, TypeError, ValueError, SyntaxError) as e:
+                self.skipped[name] = 'can\'t be patched: {}'.format(e)
+                continue
+            self.probed[name] = func
+
+    def ranking(self):
+        with self.lock:
+            return self.counts.most_common(), self.samples
+
+    def name_of(self, code_id, func=None):
+        code = self.codes[code_id]
+        qualname = func.__qualname__ if func is not None else getattr(code, 'co_qualname', code.co_name)
+        return '{}.{}'.format(self.code_modules[code_id], qualname)
+
+    def report(self):
+        counts, samples = self.ranking()
+        funcs = _package_functions(self.package_name) if counts else {}
+        hot = [HotFunction(self.name_of(code_id, funcs.get(code_id)), count, count / samples)
+               for code_id, count in counts]
+        latencies = enhancers.latency_percentiles()
+        probed = {name: latencies.get(func) for name, func in self.probed.items()}
+        return AutoInstrumentReport(self.thread.is_alive(), samples, hot, probed, dict(self.skipped))
+
+
+_session = None
+
+
+def autoinstrument(package, duration=1.0, top=10, interval=0.001, wait=True):
+    """
+    Sample the stacks of the running threads for a while, and then time the hottest functions of the package
+    (see `enhancers.timed`).
+
+    :param package: The package (or module) whose functions are candidates, or its name.
+    :param duration: How long to sample for, in seconds.
+    :param top: The number of functions to time.
+    :param interval: The time between two samples, in seconds.
+    :param wait:
+        Wait until the probes were added, and return the report. If False, the sampling runs in the background
+        (the calling thread is sampled too), and the report is read with `autoinstrument_report()`.
+    :returns: The AutoInstrumentReport, or None if not waiting.
+    """
+    global _session
+    package_name = package.__name__ if isinstance(package, types.ModuleType) else package
+    if not isinstance(package_name, str):
+        raise TypeError('package must be a module or the name of one.')
+    if not (duration > 0 and interval > 0):
+        raise ValueError('duration and interval must be positive.')
+    if not (isinstance(top, int) and top >= 1):
+        raise ValueError('top must be a positive integer.')
+    if _session is not None and (_session.thread.is_alive() or _session.probed) and not _session.removed:
+        raise ValueError('autoinstrument() was already called. Call remove_autoinstrumentation() first.')
+
+    _session = _Session(package_name, duration, top, interval, [threading.get_ident()] if wait else [])
+    _session.thread.start()
+    if not wait:
+        return None
+    _session.thread.join()
+    return _session.report()
+
+
+def autoinstrument_report():
+    """ Returns the AutoInstrumentReport of the last `autoinstrument`. It can be read while sampling too. """
+    if _session is None:
+        raise ValueError('autoinstrument() wasn\'t called.')
+    return _session.report()
+
+
+def remove_autoinstrumentation():
+    """
+    Stop the sampling if it's still running, and restore the original code of the timed functions.
+    The report is kept, with the latencies measured so far.
+    """
+    if _session is None:
+        return
+    _session.stopped.set()
+    if _session.thread.is_alive() and _session.thread is not threading.current_thread():
+        _session.thread.join()
+    if not _session.removed:
+        for func in _session.probed.values():
+            core.unpatch(func)
+        _session.removed = True
+
+
+def _package_functions(package_name):
+    """ Returns a dict of id(code) => function of the functions and methods in the package's modules' namespaces. """
+    funcs = {}
+    seen = set()
+    for module_name, module in list(sys.modules.items()):
+        if module is None or not (module_name == package_name or module_name.startswith(package_name + '.')):
+            continue
+        pending = [vars(module)]
+        while pending:
+            for value in list(pending.pop().values()):
+                if id(value) in seen:
+                    continue
+                seen.add(id(value))
+                if isinstance(value, (staticmethod, classmethod)):
+                    value = value.__func__
+                elif isinstance(value, property):
+                    pending.append({'fget': value.fget, 'fset': value.fset, 'fdel': value.fdel})
+                    continue
+                if isinstance(value, types.FunctionType):
+                    funcs.setdefault(id(value.__code__), value)
+                    wrapped = inspect.unwrap(value)  # the decorated function, for decorators which use functools.wraps
+                    if isinstance(wrapped, types.FunctionType):
+                        funcs.setdefault(id(wrapped.__code__), wrapped)
+                elif isinstance(value, type) and value.__module__ == module_name:
+                    pending.append(vars(value))
+    return funcs
@@ -0,0 +1,258 @@
+"""
+Probe counters in shared memory, for processes which fork workers (like gunicorn's prefork workers).
+
+The counters live in a file which is mapped into memory (in ``/dev/shm`` when it's available), and is created
+before forking, so every worker shares it. Every probe gets a fixed slot, and every process gets its own stripe of
+slots, which it's the only one to write to: a probe increments its slot in the stripe of the current process,
+without any locking or contention between the processes. Reading the counters sums the slot over all of the
+stripes, which can be done from any process, including ones outside of the process tree (``python -m monki stats``),
+without pausing the processes which write to them.
+
+The default file is removed when the process which created it exits, and `remove_shared_counters` removes it
+earlier. Removing it doesn't unmap it, so the probes keep counting (the memory is freed when the processes exit).
+
+Layout: a header, the pid of the owner of every stripe, the name of every slot, and then the stripes of counters.
+"""
+import atexit
+import mmap
+import os
+import struct
+import tempfile
+import warnings
+
+from . import core
+
+
+_MAGIC = b'monkishm'
+_FORMAT_VERSION = 1
+_HEADER = struct.Struct('<8sIII')  # magic, format version, slots, stripes
+_HEADER_SIZE = 64
+_NAME_SIZE = 128
+_PID = struct.Struct('<Q')
+_COUNTER_SIZE = 8
+_COUNTER_FORMAT = 'Q'
+
+
+class _Segment:
+    def __init__(self, path, mapped, slot_count, stripe_count):
+        self.path = path
+        self.mapped = mapped
+        self.slot_count = slot_count
+        self.stripe_count = stripe_count
+        self.slots = {}  # name => slot
+        self.creator_pid = os.getpid()
+        self.next_stripe = None  # the stripe claimed for the next forked process
+        self.fork_warning = None  # why no stripe was claimed
+        # the counters of the current process' stripe. the probes hold the list, so it's swapped in a forked process
+        self.stripe = [self.stripe_counters(0)]
+        self.set_owner(0, self.creator_pid)
+
+    def stripe_counters(self, stripe):
+        offset = _counters_offset(self.slot_count, self.stripe_count) + stripe * self.slot_count * _COUNTER_SIZE
+        return memoryview(self.mapped)[offset:offset + self.slot_count * _COUNTER_SIZE].cast(_COUNTER_FORMAT)
+
+    def set_owner(self, stripe, pid):
+        _PID.pack_into(self.mapped, _HEADER_SIZE + stripe * _PID.size, pid)
+
+    def claim_slot(self, name):
+        slot = self.slots.get(name)
+        if slot is not None:
+            return slot
+        if os.getpid() != self.creator_pid:
+            raise ValueError('Probes must be added in the process which created the shared counters, before forking.')
+        encoded_name = name.encode('utf-8')
+        if len(encoded_name) > _NAME_SIZE:
+            raise ValueError('The probe name {!r} is longer than {} bytes.'.format(name, _NAME_SIZE))
+        if len(self.slots) == self.slot_count:
+            raise ValueError('All of the {} slots of the shared counters are taken.'.format(self.slot_count))
+
+        slot = len(self.slots)
+        name_offset = _names_offset(self.stripe_count) + slot * _NAME_SIZE
+        self.mapped[name_offset:name_offset + _NAME_SIZE] = encoded_name.ljust(_NAME_SIZE, b'\0')
+        self.slots[name] = slot
+        return slot
+
+    def claim_stripe_for_fork(self):
+        """ Called in the parent before forking, so stripes are claimed one at a time. """
+        self.next_stripe = None
+        if os.getpid() != self.creator_pid:
+            self.fork_warning = 'Only processes forked by the process which created the shared counters get ' \
+                                'their own stripe, so this process shares its parent\'s stripe.'
+            return
+        owners = _read_owners(self.mapped, self.stripe_count)
+        # stripes of processes which exited are reused, their counts simply keep adding up
+        self.next_stripe = next((stripe for stripe, pid in enumerate(owners) if not _is_alive(pid)), None)
+        if self.next_stripe is None:
+            self.fork_warning = 'All of the {} stripes of the shared counters are taken, so this process shares ' \
+                                'its parent\'s stripe.'.format(self.stripe_count)
+        else:
+            self.set_owner(self.next_stripe, os.getpid())  # until the child replaces it with its own pid
+
+    def use_claimed_stripe(self):
+        """ Called in the child after forking. """
+        self.creator_pid = None  # slots can't be added from here anymore
+        if self.next_stripe is None:
+            warnings.warn(self.fork_warning + ' Counts of the same probe at the same time may be lost.',
+                          RuntimeWarning)
+            return
+        self.set_owner(self.next_stripe, os.getpid())
+        self.stripe[0] = self.stripe_counters(self.next_stripe)
+
+
+_segment = None
+
+
+def create_shared_counters(path=None, max_probes=1024, max_workers=64):
+    """
+    Create the shared counters which `probe` counts into. Must be called before forking the workers.
+
+    :param path:
+        The file to map, which `python -m monki stats` reads. Defaults to a new file in ``/dev/shm``
+        (or in the temporary directory if there's no ``/dev/shm``), which is removed when this process exits.
+        A given file is kept until `remove_shared_counters()` is called.
+    :param max_probes: The number of slots, one for every probe.
+    :param max_workers: The number of stripes, one for every live process (including this one).
+    :returns: The path of the file.
+    """
+    global _segment
+    if _segment is not None:
+        raise ValueError('Shared counters were already created at {}.'.format(_segment.path))
+    if not (isinstance(max_probes, int) and max_probes >= 1 and isinstance(max_workers, int) and max_workers >= 1):
+        raise ValueError('max_probes and max_workers must be positive integers.')
+
+    if path is None:
+        directory = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+        path = os.path.join(directory, 'monki-{}'.format(os.getpid()))
+        # forked processes inherit the hook, so it only removes the file in this process
+        atexit.register(_remove_at_exit, path, os.getpid())
+    size = _counters_offset(max_probes, max_workers) + max_workers * max_probes * _COUNTER_SIZE
+    with open(path, 'w+b') as f:
+        f.truncate(size)  # zero filled
+        mapped = mmap.mmap(f.fileno(), size)  # shared, so forked processes write to the same memory
+    mapped[:_HEADER.size] = _HEADER.pack(_MAGIC, _FORMAT_VERSION, max_probes, max_workers)
+
+    _segment = _Segment(path, mapped, max_probes, max_workers)
+    return path
+
+
+def probe(func, name='calls', line=None):
+    """
+    Count the calls of the function (or the times a line of it runs) in the shared counters.
+    The probe's slot is named after the function's module and qualified name, and the name of the probe,
+    e.g. 'package.module.SomeClass.some_method:calls'.
+
+    :param name: The name of the probe, so a function can have more than one.
+    :param line: The top-level line to count, numbered like `insert_lines`, or None to count the calls.
+    """
+    if _segment is None:
+        raise ValueError('create_shared_counters() must be called before adding probes.')
+    slot = _segment.claim_slot('{}.{}:{}'.format(func.__module__, func.__qualname__, name))
+    code = '__monki_stripe[0][{}] += 1'.format(slot)
+    constants = {'__monki_stripe': _segment.stripe}
+    if line is None:
+        core.patch(func, start=code, constants=constants)
+    else:
+        core.patch(func, insert_lines={line: code}, constants=constants)
+    return func
+
+
+def shared_counts():
+    """ Returns a dict of probe name => count, summed over all of the processes. """
+    if _segment is None:
+        raise ValueError('create_shared_counters() wasn\'t called.')
+    return _sum_counters(_segment.mapped)
+
+
+def remove_shared_counters():
+    """
+    Remove the file of the shared counters, e.g. when the workers are stopped. The probes keep counting, and
+    `shared_counts()` still reads their counts, but `python -m monki stats` can't anymore.
+    Can only be called in the process which created them.
+    """
+    if _segment is None:
+        raise ValueError('create_shared_counters() wasn\'t called.')
+    if os.getpid() != _segment.creator_pid:
+        raise ValueError('Only the process which created the shared counters can remove them.')
+    _remove_file(_segment.path)
+
+
+def _remove_at_exit(path, creator_pid):
+    if os.getpid() == creator_pid:
+        _remove_file(path)
+
+
+def _remove_file(path):
+    try:
+        os.unlink(path)
+    except FileNotFoundError:  # already removed
+        pass
+
+
+def read_shared_counters(path):
+    """ Returns a dict of probe name => count, summed over all of the processes, from the file of the counters. """
+    with open(path, 'rb') as f:
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        return _sum_counters(mapped)
+    finally:
+        mapped.close()
+
+
+def _sum_counters(mapped):
+    magic, version, slot_count, stripe_count = _HEADER.unpack_from(mapped)
+    if magic != _MAGIC or version != _FORMAT_VERSION:
+        raise ValueError('Not a file of monki shared counters.')
+
+    names_offset = _names_offset(stripe_count)
+    names = []
+    for slot in range(slot_count):
+        name = bytes(mapped[names_offset + slot * _NAME_SIZE:names_offset + (slot + 1) * _NAME_SIZE]).rstrip(b'\0')
+        if not name:  # slots are taken in order
+            break
+        names.append(name.decode('utf-8'))
+
+    counters = memoryview(mapped)[_counters_offset(slot_count, stripe_count):].cast(_COUNTER_FORMAT)
+    try:
+        return {name: sum(counters[stripe * slot_count + slot] for stripe in range(stripe_count))
+                for slot, name in enumerate(names)}
+    finally:
+        counters.release()
+
+
+def _names_offset(stripe_count):
+    return _HEADER_SIZE + stripe_count * _PID.size
+
+
+def _counters_offset(slot_count, stripe_count):
+    return _names_offset(stripe_count) + slot_count * _NAME_SIZE
+
+
+def _read_owners(mapped, stripe_count):
+    return [_PID.unpack_from(mapped, _HEADER_SIZE + stripe * _PID.size)[0] for stripe in range(stripe_count)]
+
+
+def _is_alive(pid):
+    if not pid:
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:  # a process of another user took the pid
+        return True
+    return True
+
+
+def _before_fork():
+    if _segment is not None:
+        _segment.claim_stripe_for_fork()
+
+
+def _after_fork_in_child():
+    if _segment is not None:
+        _segment.use_claimed_stripe()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(before=_before_fork, after_in_child=_after_fork_in_child)
+
@@ -0,0 +1,494 @@
+"""
+Source retrieval and parsing.
+
+`inspect.getsource` re-reads and re-tokenizes a function's file for every single function.
+`get_function_sources` parses every source file once into an index of function spans, which is then shared
+by all of the functions defined in that file.
+
+`parse_function_source` splits a function's source into its signature and body using the `ast` module,
+so it handles `async def`, annotations, defaults of any complexity and tab indentation.
+"""
+import ast
+import collections
+import inspect
+import io
+import itertools
+import linecache
+import re
+import tokenize
+
+
+INDENT_STRING = '    '
+
+
+class SourceIndex:
+    """
+    The spans of all of the functions in a single source file, keyed by their first line number
+    (which is the line of the first decorator, same as `co_firstlineno`).
+    """
+
+    def __init__(self, lines):
+        self._lines = lines
+        self._spans = {}
+
+        tree = ast.parse(''.join(lines))
+        for node in _iter_function_nodes(tree.body):
+            first_lineno = min([node.lineno] + [decorator.lineno for decorator in node.decorator_list])
+            self._spans[first_lineno] = (first_lineno, node.end_lineno)
+
+    @classmethod
+    def from_file(cls, filename):
+        lines = linecache.getlines(filename)
+        if not lines:
+            raise OSError('Could not get source lines of file: {}'.format(filename))
+        return cls(lines)
+
+    def get_source(self, code):
+        """ Returns the source of the function with the given code object, or None if it isn't indexed. """
+        span = self._spans.get(code.co_firstlineno)
+        if span is None:
+            return None
+        first_lineno, end_lineno = span
+        return ''.join(self._lines[first_lineno - 1:end_lineno])
+
+
+_STATEMENT_LIST_FIELDS = ('body', 'orelse', 'finalbody', 'handlers', 'cases')
+
+
+def _iter_function_nodes(statements):
+    # functions can only be defined in statement lists, so expressions aren't visited at all
+    # (which makes this a lot faster than ast.walk)
+    pending = list(statements)
+    while pending:
+        node = pending.pop()
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+            yield node
+        for field in _STATEMENT_LIST_FIELDS:
+            pending.extend(getattr(node, field, ()))
+
+
+def get_function_sources(funcs):
+    """
+    Returns a dict of function => source for all of the functions, parsing each source file once.
+    Functions whose source can't be found in the index fall back to `inspect.getsource`.
+    """
+    indexes = {}
+    sources = {}
+
+    for func in funcs:
+        func_source = None
+        filename = inspect.getsourcefile(func)
+        if filename is not None:
+            if filename not in indexes:
+                linecache.checkcache(filename)
+                try:
+                    indexes[filename] = SourceIndex.from_file(filename)
+                except (OSError, SyntaxError):
+                    indexes[filename] = None
+            if indexes[filename] is not None:
+                func_source = indexes[filename].get_source(func.__code__)
+
+        sources[func] = func_source if func_source is not None else inspect.getsource(func)
+
+    return sources
+
+
+ParsedFunction = collections.namedtuple('ParsedFunction', ['signature', 'body_lines', 'name', 'is_async'])
+
+_MULTI_LINE_STRING_MARKERS = ('"""', "'''", '\\\n')
+_PARAMETER_FIELDS = ('posonlyargs', 'args', 'vararg', 'kwonlyargs', 'kwarg')
+
+
+def parse_function_source(func_source):
+    """
+    Splits the source of a function (as returned by inspect.getsource) into its signature and body.
+
+    Decorators are dropped and the signature is unindented. Every body line that isn't inside
+    a multi-line string is re-indented so that the body's own indentation is exactly one `INDENT_STRING`,
+    with tabs expanded. Leading and trailing blank lines of the body are dropped.
+
+    :returns: A ParsedFunction. The signature ends with its colon and a newline.
+    """
+    lines = func_source.split('\n')
+
+    # an indented function (e.g. a method) can't be parsed on its own, so it's parsed as the body of an `if`
+    is_indented = func_source[:1].isspace()
+    row_offset = 1 if is_indented else 0
+    tree = ast.parse('if 1:\n' + func_source if is_indented else func_source)
+    node = tree.body[0].body[0] if is_indented else tree.body[0]
+    if not isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+        raise ValueError('Could not find a function definition in the source.')
+
+    def_row = node.lineno - row_offset
+    def_col = _char_col(lines[def_row - 1], node.col_offset)
+    colon_row, colon_col = _find_signature_colon(lines, node, row_offset)
+
+    def_indent = lines[def_row - 1][:def_col]
+    signature_lines = lines[def_row - 1:colon_row]
+    signature_lines[-1] = signature_lines[-1][:colon_col + 1]
+    signature_lines = [signature_lines[0][def_col:]] + [_remove_prefix(line, def_indent) for line in signature_lines[1:]]
+    signature = '\n'.join(signature_lines) + '\n'
+
+    first_statement = node.body[0]
+    first_statement_row = first_statement.lineno - row_offset
+
+    body_lines = []
+    if first_statement_row == colon_row:  # a one-liner, such as `def func(): return 1`
+        body_indent = None
+        body_lines.append(INDENT_STRING + lines[colon_row - 1][colon_col + 1:].strip())
+    else:
+        first_statement_line = lines[first_statement_row - 1]
+        body_indent = first_statement_line[:_char_col(first_statement_line, first_statement.col_offset)].expandtabs()
+
+    string_rows = _multi_line_string_rows(func_source, node, row_offset)
+    for row in range(colon_row + 1, len(lines) + 1):
+        line = lines[row - 1]
+        if row in string_rows:
+            body_lines.append(line)
+            continue
+
+        stripped = line.lstrip()
+        if not stripped:
+            body_lines.append('')
+            continue
+
+        indent = line[:len(line) - len(stripped)].expandtabs()
+        if body_indent is not None and indent.startswith(body_indent):
+            body_lines.append(INDENT_STRING + indent[len(body_indent):] + stripped)
+        else:  # a comment or a continuation line inside brackets, where indentation doesn't matter
+            body_lines.append(indent + stripped)
+
+    return ParsedFunction(signature, _strip_blank_lines(body_lines), node.name,
+                          isinstance(node, ast.AsyncFunctionDef))
+
+
+def _find_signature_colon(lines, node, row_offset):
+    """
+    Returns the (row, column) of the colon that ends the signature.
+    The colon comes right after the closing parenthesis of the parameters, or after the return annotation.
+    Only whitespace, commas, `*`, `/`, parentheses, comments and line continuations can come in between.
+    """
+    if node.returns is not None:
+        row, col = node.returns.end_lineno - row_offset, node.returns.end_col_offset
+        return _scan_for(lines, row, _char_col(lines[row - 1], col), ':')
+
+    parameter_nodes = [n for field in _PARAMETER_FIELDS for n in _as_list(getattr(node.args, field))]
+    parameter_nodes += [n for n in node.args.defaults + node.args.kw_defaults if n is not None]
+    if parameter_nodes:
+        last = max(parameter_nodes, key=lambda n: (n.end_lineno, n.end_col_offset))
+        row = last.end_lineno - row_offset
+        col = _char_col(lines[row - 1], last.end_col_offset)
+    else:
+        row = node.lineno - row_offset
+        col = lines[row - 1].index('(', _char_col(lines[row - 1], node.col_offset)) + 1
+
+    row, col = _scan_for(lines, row, col, ')')
+    return _scan_for(lines, row, col + 1, ':')
+
+
+def _scan_for(lines, row, col, char):
+    while True:
+        line = lines[row - 1]
+        while col < len(line):
+            if line[col] == char:
+                return row, col
+            if line[col] == '#':
+                break
+            col += 1
+        row, col = row + 1, 0
+
+
+def _multi_line_string_rows(func_source, node, row_offset):
+    """ Returns the rows (1-based) that start inside a multi-line string, and must be kept as-is. """
+    if not any(marker in func_source for marker in _MULTI_LINE_STRING_MARKERS):
+        return set()  # no string can span more than a single line
+
+    rows = set()
+    for child in ast.walk(node):
+        if isinstance(child, (ast.Constant, ast.JoinedStr)) and child.end_lineno > child.lineno:
+            rows.update(range(child.lineno + 1 - row_offset, child.end_lineno + 1 - row_offset))
+    return rows
+
+
+def _as_list(value):
+    if value is None:
+        return []
+    return value if isinstance(value, list) else [value]
+
+
+def _char_col(line, byte_col):
+    # ast column offsets are in UTF-8 bytes
+    if line.isascii():
+        return byte_col
+    return len(line.encode('utf-8')[:byte_col].decode('utf-8'))
+
+
+def _remove_prefix(line, prefix):
+    return line[len(prefix):] if line.startswith(prefix) else line
+
+
+def _strip_blank_lines(lines):
+    start = 0
+    while start < len(lines) and not lines[start]:
+        start += 1
+    end = len(lines)
+    while end > start and not lines[end - 1]:
+        end -= 1
+    return lines[start:end]
+
+
+_NESTED_SCOPE_NODES = (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)
+
+
+def remove_nonlocal_statements(func_source):
+    """
+    Replaces the `nonlocal` statements of an unindented function's own scope (not of functions nested in it)
+    with `pass`, keeping all of the other code in its place.
+    """
+    if 'nonlocal' not in func_source:
+        return func_source
+
+    func_node = ast.parse(func_source).body[0]
+    nonlocal_nodes = [node for node in _iter_scope_statements(func_node.body) if isinstance(node, ast.Nonlocal)]
+
+    lines = func_source.split('\n')
+    for node in sorted(nonlocal_nodes, key=lambda node: (node.lineno, node.col_offset), reverse=True):
+        first_line, last_line = lines[node.lineno - 1], lines[node.end_lineno - 1]
+        replaced = first_line[:_char_col(first_line, node.col_offset)] + 'pass' + \
+            last_line[_char_col(last_line, node.end_col_offset):]
+        # a statement continued with backslashes leaves blank lines behind, so the other lines don't move
+        lines[node.lineno - 1:node.end_lineno] = [replaced] + [''] * (node.end_lineno - node.lineno)
+    return '\n'.join(lines)
+
+
+def _iter_scope_statements(statements):
+    pending = list(statements)
+    while pending:
+        node = pending.pop()
+        yield node
+        if isinstance(node, _NESTED_SCOPE_NODES):
+            continue
+        for field in _STATEMENT_LIST_FIELDS:
+            pending.extend(getattr(node, field, ()))
+
+
+def replace_names(code, replacements):
+    """
+    Replaces the names in a piece of code (not attributes, keyword arguments or the names of `global` and
+    `nonlocal` statements) with the given replacement texts.
+
+    :param replacements: A dict of name => replacement text.
+    """
+    if not code or not any(name in code for name in replacements):
+        return code
+
+    lines = code.split('\n')
+    spans = []  # (row, start column, end column, replacement)
+    tokens = list(tokenize.generate_tokens(io.StringIO(code).readline))
+    bracket_depth = 0
+    in_declaration = False  # in a global or nonlocal statement, whose names must stay names
+    for index, token in enumerate(tokens):
+        if token.type == tokenize.NEWLINE or token.type == tokenize.OP and token.string == ';':
+            in_declaration = False
+        elif token.type == tokenize.NAME and token.string in ('global', 'nonlocal'):
+            in_declaration = True
+        elif token.type == tokenize.OP and token.string in '([{':
+            bracket_depth += 1
+        elif token.type == tokenize.OP and token.string in ')]}':
+            bracket_depth -= 1
+        elif token.type == tokenize.NAME and token.string in replacements:
+            previous_token = tokens[index - 1] if index else None
+            next_token = tokens[index + 1] if index + 1 < len(tokens) else None
+            is_attribute = previous_token is not None and previous_token.string == '.'
+            is_keyword_argument = bracket_depth and next_token is not None and next_token.string == '='
+            if not is_attribute and not is_keyword_argument and not in_declaration:
+                spans.append((token.start[0], token.start[1], token.end[1], replacements[token.string]))
+
+    for row, start_col, end_col, replacement in reversed(spans):
+        line = lines[row - 1]
+        lines[row - 1] = line[:start_col] + replacement + line[end_col:]
+    return '\n'.join(lines)
+
+
+def add_return_code(func_source, return_code, result_name):
+    """
+    Makes an unindented function run `return_code` right before it returns, with the returned value
+    assigned to `result_name`. Covers every return statement of the function's own scope,
+    as well as falling off the end of the function.
+    """
+    return_code_lines = return_code.split('\n')
+    lines = replace_returns(func_source, lambda value: ['{} = ({})'.format(result_name, value)] + return_code_lines +
+                            ['return ' + result_name]).split('\n')
+
+    # falling off the end of the function returns None
+    lines.append('{}{} = None'.format(INDENT_STRING, result_name))
+    lines += [INDENT_STRING + line for line in return_code_lines]
+    return '\n'.join(lines)
+
+
+def replace_returns(func_source, make_statements):
+    """
+    Replaces every return statement of an unindented function's own scope with other statements.
+
+    :param make_statements:
+        A callable which gets the source of the returned value ('None' for a bare return),
+        and returns the lines of the statements to replace the return statement with.
+    """
+    lines = func_source.split('\n')
+    func_node = ast.parse(func_source).body[0]
+    return_nodes = [node for node in _iter_scope_statements(func_node.body) if isinstance(node, ast.Return)]
+
+    for node in sorted(return_nodes, key=lambda node: (node.lineno, node.col_offset), reverse=True):
+        first_line, last_line = lines[node.lineno - 1], lines[node.end_lineno - 1]
+        start_col = _char_col(first_line, node.col_offset)
+        end_col = _char_col(last_line, node.end_col_offset)
+        value = _node_text(lines, node.value) if node.value is not None else 'None'
+        before, after = first_line[:start_col], last_line[end_col:]
+        statements = make_statements(value)
+
+        if not before.strip() and (not after.strip() or after.strip().startswith('#')):
+            # the return statement has its own lines, so the statements are added as lines with the same indentation
+            replacement = [before + line for line in statements]
+        else:  # e.g. `if x: return y`, so everything has to fit in a single line
+            replacement = [before + '; '.join(statements) + after]
+        lines[node.lineno - 1:node.end_lineno] = replacement
+    return '\n'.join(lines)
+
+
+def _node_text(lines, node):
+    if node.lineno == node.end_lineno:
+        line = lines[node.lineno - 1]
+        return line[_char_col(line, node.col_offset):_char_col(line, node.end_col_offset)]
+    first_line, last_line = lines[node.lineno - 1], lines[node.end_lineno - 1]
+    return '\n'.join([first_line[_char_col(first_line, node.col_offset):]] + lines[node.lineno:node.end_lineno - 1] +
+                     [last_line[:_char_col(last_line, node.end_col_offset)]])
+
+
+InlineTemplate = collections.namedtuple('InlineTemplate', ['parameters', 'keyword_only', 'defaults', 'expression'])
+InlineTemplate.__doc__ = """
+The expression to replace the calls of a helper with.
+`parameters` are the names of the parameters, in order, of which the `keyword_only` ones come last.
+`defaults` is a dict of parameter name => expression of its default.
+In `expression`, the parameters are replaced by `PARAMETER_MARKER.format(index)`.
+"""
+
+PARAMETER_MARKER = '__monki_parameter_{}__'
+_PARAMETER_MARKER_REGEX = r'__monki_parameter_(\d+)__'
+_TEMPORARY_NAME = '__monki_inlined_{}'
+_temporary_ids = itertools.count()
+# walrus assignments (which are needed for some arguments) aren't allowed in parts of comprehensions and class bodies
+_NO_TEMPORARIES_NODES = (ast.ListComp, ast.SetComp, ast.DictComp, ast.GeneratorExp, ast.ClassDef)
+
+_CallSite = collections.namedtuple('CallSite', ['start', 'end', 'node', 'allows_temporaries'])
+
+
+def inline_calls(body, templates):
+    """
+    Replaces the calls of the given names in an indented function body with the expressions of their templates.
+    Arguments which are names or constants are substituted into the expression. When any argument is more complex,
+    all of them are first assigned to temporary variables, in order, so each one is evaluated exactly once.
+
+    The body keeps its number of lines. Calls which can't be inlined (e.g. with `*args`, with arguments which
+    don't match the parameters, or with complex arguments inside a comprehension) are left as they are.
+
+    :param templates: A dict of name => InlineTemplate.
+    """
+    lines = body.split('\n')
+    line_starts = list(itertools.accumulate([0] + [len(line) + 1 for line in lines[:-1]]))
+
+    def offset(lineno, col_offset):
+        row = lineno - 2  # the body is parsed after an `if 1:` line
+        return line_starts[row] + _char_col(lines[row], col_offset)
+
+    sites = []
+    pending = [(ast.parse('if 1:\n' + body), True)]
+    while pending:
+        node, allows_temporaries = pending.pop()
+        if isinstance(node, ast.JoinedStr):  # f-strings have no reliable positions
+            continue
+        if isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id in templates:
+            sites.append(_CallSite(offset(node.lineno, node.col_offset), offset(node.end_lineno, node.end_col_offset),
+                                   node, allows_temporaries))
+        child_allows_temporaries = allows_temporaries and not isinstance(node, _NO_TEMPORARIES_NODES)
+        pending.extend((child, child_allows_temporaries) for child in ast.iter_child_nodes(node))
+    if not sites:
+        return body
+
+    sites.sort(key=lambda site: (site.start, -site.end))
+    return _rewrite_range(body, 0, len(body), sites, templates, offset)
+
+
+def _rewrite_range(body, start, end, sites, templates, offset):
+    parts = []
+    position = start
+    for site in sites:
+        if site.start < position or site.end > end:  # nested in a call which was already rewritten, or outside
+            continue
+        if site.start >= end:
+            break
+        parts.append(body[position:site.start])
+        parts.append(_rewrite_call(body, site, sites, templates, offset))
+        position = site.end
+    parts.append(body[position:end])
+    return ''.join(parts)
+
+
+def _rewrite_call(body, site, sites, templates, offset):
+    inner_sites = [inner for inner in sites if inner is not site]
+
+    def text_of(node):
+        return _rewrite_range(body, offset(node.lineno, node.col_offset), offset(node.end_lineno, node.end_col_offset),
+                              inner_sites, templates, offset)
+
+    node, template = site.node, templates[site.node.func.id]
+    arguments = _bind_call_arguments(node, template)
+    needs_temporaries = arguments is not None and not all(_is_simple(argument) for argument in arguments.values())
+    if arguments is None or (needs_temporaries and not site.allows_temporaries):
+        return _rewrite_range(body, site.start, site.end, inner_sites, templates, offset)
+
+    values = {}
+    assignments = []
+    for name, argument in arguments.items():  # in the order they're evaluated in the call
+        if needs_temporaries:
+            temporary = _TEMPORARY_NAME.format(next(_temporary_ids))
+            assignments.append('(({0} := ({1})) is {0})'.format(temporary, text_of(argument)))
+            values[name] = temporary
+        else:
+            values[name] = '({})'.format(text_of(argument))
+    for name in template.parameters:
+        values.setdefault(name, template.defaults.get(name))
+
+    expression = re.sub(_PARAMETER_MARKER_REGEX, lambda match: values[template.parameters[int(match.group(1))]],
+                        template.expression)
+    if assignments:
+        # `x is x` is always true, so the assignments are evaluated in order and then the expression is the result
+        expression = ' and '.join(assignments + ['({})'.format(expression)])
+    # the call may span a few lines, which the rest of the patch relies on
+    padding = body.count('\n', site.start, site.end) - expression.count('\n')
+    return '({}{})'.format(expression, '\n' * max(padding, 0))
+
+
+def _is_simple(argument):
+    # a simple argument can be evaluated any number of times (including none), and doesn't add lines
+    if isinstance(argument, ast.UnaryOp) and isinstance(argument.op, ast.USub):  # negative numbers
+        argument = argument.operand
+    return isinstance(argument, (ast.Name, ast.Constant)) and argument.lineno == argument.end_lineno
+
+
+def _bind_call_arguments(node, template):
+    """ Returns an ordered dict of parameter name => argument node, or None if the call doesn't match. """
+    if any(isinstance(argument, ast.Starred) for argument in node.args) or \
+            any(keyword.arg is None for keyword in node.keywords):
+        return None
+    positional = [name for name in template.parameters if name not in template.keyword_only]
+    if len(node.args) > len(positional):
+        return None
+
+    arguments = collections.OrderedDict(zip(positional, node.args))
+    for keyword in node.keywords:
+        if keyword.arg in arguments or keyword.arg not in template.parameters:
+            return None
+        arguments[keyword.arg] = keyword.value
+    if any(name not in arguments and name not in template.defaults for name in template.parameters):
+        return None
+    return arguments
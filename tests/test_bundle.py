@@ -0,0 +1,189 @@
+import importlib
+import inspect
+import json
+import linecache
+import sys
+
+import pytest
+
+import monki
+from monki import __main__ as cli
+
+
+_MODULE_SOURCE = '''
+outlist = []
+
+
+def func(a):
+    a += 1
+    return a
+
+
+class SomeClass:
+    def method(self, a):
+        return [a]
+'''
+
+_MANIFEST = {'bundled_module': {
+    'func': {'start': 'outlist.append("start")', 'insert_lines': {'1': 'a *= 10'}},
+    'SomeClass.method': {'on_return': 'outlist.append(__return__)'},
+}}
+
+_TOML_MANIFEST = '''
+[bundled_module.func]
+start = 'outlist.append("start")'
+insert_lines = {1 = 'a *= 10'}
+
+[bundled_module."SomeClass.method"]
+on_return = 'outlist.append(__return__)'
+'''
+
+
+@pytest.fixture
+def make_module(tmp_path, monkeypatch):
+    monkeypatch.syspath_prepend(str(tmp_path))
+
+    def _make_module(name='bundled_module', text=_MODULE_SOURCE):
+        with open(str(tmp_path / (name + '.py')), 'w') as f:
+            f.write(text)
+        sys.modules.pop(name, None)
+        importlib.invalidate_caches()
+        return importlib.import_module(name)
+
+    yield _make_module
+    for name in ('bundled_module', 'other_bundled_module'):
+        module = sys.modules.pop(name, None)
+        if module is not None:
+            monki.unpatch(module.func)
+            monki.unpatch(module.SomeClass.method)
+
+
+@pytest.fixture
+def manifest_path(tmp_path):
+    path = str(tmp_path / 'manifest.json')
+    with open(path, 'w') as f:
+        json.dump(_MANIFEST, f)
+    return path
+
+
+class TestBundles:
+    """
+    Tests for compiling manifests into bundles, and applying them.
+    """
+
+    def test_apply_bundle(self, make_module, manifest_path):
+        make_module()
+        bundle_path = monki.compile_manifest(manifest_path)
+        assert bundle_path.endswith('manifest.bundle')
+
+        module = make_module()  # like a new worker, which imports the module again
+        report = monki.apply_bundle(bundle_path)
+        assert report == (['bundled_module:func', 'bundled_module:SomeClass.method'], [], [])
+        assert module.func(1) == 20
+        assert module.SomeClass().method(2) == [2]
+        assert module.outlist == ['start', [2]]
+
+    def test_applying_reads_no_source(self, make_module, manifest_path, monkeypatch):
+        make_module()
+        bundle_path = monki.compile_manifest(manifest_path)
+        module = make_module()
+
+        def fail(*args, **kwargs):
+            raise AssertionError('The source was read.')
+
+        monkeypatch.setattr(inspect, 'getsource', fail)
+        monkeypatch.setattr(linecache, 'getlines', fail)
+        monki.apply_bundle(bundle_path)
+        assert module.func(1) == 20
+
+    def test_toml_manifest(self, make_module, tmp_path):
+        module = make_module()
+        path = str(tmp_path / 'manifest.toml')
+        with open(path, 'w') as f:
+            f.write(_TOML_MANIFEST)
+        bundle_path = monki.compile_manifest(path, str(tmp_path / 'patches.bundle'))
+
+        assert len(monki.apply_bundle(bundle_path).applied) == 2
+        assert module.func(1) == 20
+
+    def test_stale_functions_are_patched_from_source(self, make_module, manifest_path):
+        make_module()
+        bundle_path = monki.compile_manifest(manifest_path)
+        module = make_module(text=_MODULE_SOURCE.replace('a += 1', 'a += 2'))
+
+        report = monki.apply_bundle(bundle_path)
+        assert report.applied == ['bundled_module:SomeClass.method']
+        assert report.stale == report.compiled == ['bundled_module:func']
+        assert module.func(1) == 30
+        assert module.outlist == ['start']
+
+    def test_stale_functions_can_be_left_unpatched(self, make_module, manifest_path):
+        make_module()
+        bundle_path = monki.compile_manifest(manifest_path)
+        module = make_module(text=_MODULE_SOURCE.replace('a += 1', 'a += 2'))
+
+        report = monki.apply_bundle(bundle_path, fallback=False)
+        assert report.stale == ['bundled_module:func'] and report.compiled == []
+        assert module.func(1) == 3
+
+    def test_patching_and_unpatching_after_a_bundle(self, make_module, manifest_path):
+        make_module()
+        bundle_path = monki.compile_manifest(manifest_path)
+        module = make_module()
+        original_code = module.func.__code__
+        monki.apply_bundle(bundle_path)
+
+        monki.patch(module.func, start='outlist.append("again")')  # layered on top of the bundle's patch
+        assert module.func(1) == 20
+        assert module.outlist == ['again', 'start']
+        monki.unpatch(module.func)
+        assert module.func.__code__ is original_code
+
+    def test_patching_again_without_source(self, make_module, manifest_path, monkeypatch):
+        make_module()
+        bundle_path = monki.compile_manifest(manifest_path)
+        module = make_module()
+        monki.apply_bundle(bundle_path)
+
+        def fail(*args, **kwargs):
+            raise OSError('The source file isn\'t deployed.')
+
+        monkeypatch.setattr(inspect, 'getsource', fail)
+        monkeypatch.setattr(linecache, 'getlines', fail)
+        monki.patch(module.func, start='outlist.append("again")')
+        monki.patch(module.func, start='a -= 1')
+        assert module.func(1) == 10
+        assert module.outlist == ['again', 'start']
+
+    def test_compiling_in_processes(self, make_module, tmp_path):
+        make_module()
+        make_module('other_bundled_module')
+        path = str(tmp_path / 'manifest.json')
+        with open(path, 'w') as f:
+            json.dump(dict(_MANIFEST, other_bundled_module=_MANIFEST['bundled_module']), f)
+        bundle_path = monki.compile_manifest(path, processes=2)
+
+        assert len(monki.apply_bundle(bundle_path).applied) == 4
+        assert sys.modules['other_bundled_module'].func(1) == 20
+
+    def test_unsupported_spec_keys(self, tmp_path):
+        path = str(tmp_path / 'manifest.json')
+        with open(path, 'w') as f:
+            json.dump({'bundled_module': {'func': {'start': 'pass', 'constants': {}}}}, f)
+        with pytest.raises(ValueError, match='constants'):
+            monki.compile_manifest(path)
+
+    def test_not_a_bundle(self, tmp_path):
+        path = tmp_path / 'patches.bundle'
+        path.write_bytes(b'not a bundle')
+        with pytest.raises(ValueError):
+            monki.apply_bundle(str(path))
+
+    def test_compile_command(self, make_module, manifest_path, tmp_path, capsys):
+        make_module()
+        bundle_path = str(tmp_path / 'out.bundle')
+        assert cli.main(['compile', manifest_path, '-o', bundle_path]) == 0
+        assert capsys.readouterr().out.strip() == bundle_path
+
+        assert cli.main(['compile', str(tmp_path / 'missing.json')]) == 1
+        assert 'missing.json' in capsys.readouterr().err
@@ -0,0 +1,118 @@
+import asyncio
+
+import pytest
+
+import monki
+from monki import bytecode
+
+pytestmark = pytest.mark.skipif(not bytecode.is_supported(), reason='bytecode mode requires CPython 3.11')
+
+
+class TestBytecodeRoundTrip:
+    """
+    Tests for disassembling and re-assembling code objects without changes.
+    """
+
+    def test_round_trip_is_exact(self):
+        def func(items):
+            total = 0
+            for item in items:
+                try:
+                    total += item
+                except TypeError:
+                    continue
+            return total
+
+        code = func.__code__
+        new_code = bytecode.assemble(code, bytecode.disassemble(code))
+        assert new_code.co_code == code.co_code
+        assert new_code.co_exceptiontable == code.co_exceptiontable
+        assert new_code.co_stacksize == code.co_stacksize
+
+
+class TestPatchingBytecode:
+    """
+    Tests for patching functions with mode='bytecode'.
+    """
+
+    def test_start_end_and_insert_lines(self):
+        def func(a):
+            """ The docstring doesn't count as a line. """
+            b = a + 1
+            return b
+
+        monki.patch(func, start='calls.append("start")', end='calls.append(b)',
+                    insert_lines={1: 'b *= 10'}, mode='bytecode')
+        calls = []
+        func.__globals__['calls'] = calls
+        try:
+            assert func(1) == 20
+            assert calls == ['start', 20]
+        finally:
+            del func.__globals__['calls']
+
+    def test_inserted_line_in_loop_runs_every_iteration(self):
+        def func(n):
+            total = 0
+            for i in range(n):
+                total += i
+            return total
+
+        monki.patch(func, insert_lines={2: 'total += 100'}, mode='bytecode')
+        assert func(3) == 303
+
+    def test_closure_reads_free_variables_and_handles_exceptions(self):
+        factor = 3
+
+        def func(a):
+            return a * factor
+
+        monki.patch(func, start='try:\n    a = int(a)\nexcept ValueError:\n    a = factor', mode='bytecode')
+        assert func('2') == 6
+        assert func('x') == 9
+
+    def test_setting_free_variable(self):
+        factor = 3
+
+        def func(a):
+            return a * factor
+
+        monki.patch(func, start='factor = 2', mode='bytecode')
+        assert func(5) == 10
+        assert factor == 2
+
+    def test_generator_and_coroutine(self):
+        def gen(n):
+            for i in range(n):
+                yield i
+
+        async def coro(a):
+            await asyncio.sleep(0)
+            return a
+
+        monki.patch(gen, insert_lines={1: 'i *= 2'}, mode='bytecode')
+        monki.patch(coro, end='a = a + 1', mode='bytecode')
+        assert list(gen(3)) == [0, 2, 4]
+        assert asyncio.run(coro(1)) == 1  # the returned value was already computed when `end` runs
+
+    def test_function_without_source(self):
+        namespace = {}
+        exec('def func(a):\n    return a + 1\n', namespace)
+        func = namespace['func']
+
+        monki.patch(func, start='a = a * 2', mode='bytecode')
+        assert func(5) == 11
+
+    def test_indenting_is_rejected(self):
+        def func():
+            pass
+
+        with pytest.raises(ValueError, match='not supported in bytecode mode'):
+            monki.patch(func, start='for i in range(2):', indent_inner=True, mode='bytecode')
+
+    def test_unknown_mode_raises_error(self):
+        def func():
+            pass
+
+        with pytest.raises(ValueError, match='mode must be one of'):
+            monki.patch(func, start='pass', mode='ast')
@@ -0,0 +1,113 @@
+import importlib
+import os
+import sys
+
+import pytest
+import monki
+
+
+_MODULE_SOURCE = '''
+def func(outlist):
+    outlist.append("{middle}")
+    return outlist
+'''
+
+
+@pytest.fixture
+def cache_dir(tmp_path):
+    monki.enable_cache(str(tmp_path / 'cache'))
+    monki.reset_cache_stats()
+    yield str(tmp_path / 'cache')
+    monki.disable_cache()
+
+
+@pytest.fixture
+def make_module(tmp_path, monkeypatch):
+    monkeypatch.syspath_prepend(str(tmp_path))
+
+    def _make_module(middle):
+        with open(str(tmp_path / 'cached_module.py'), 'w') as f:
+            f.write(_MODULE_SOURCE.format(middle=middle))
+        sys.modules.pop('cached_module', None)
+        importlib.invalidate_caches()
+        return importlib.import_module('cached_module')
+
+    yield _make_module
+    sys.modules.pop('cached_module', None)
+
+
+def _patch(func):
+    monki.patch(func, start='outlist.append("start")', end='outlist.append("end")')
+
+
+def test_first_patch_is_a_miss_and_second_is_a_hit(cache_dir, make_module):
+    module = make_module('middle')
+    _patch(module.func)
+    assert monki.cache_stats() == {'hits': 0, 'misses': 1, 'errors': 0}
+    assert len(os.listdir(cache_dir)) == 1
+
+    module = make_module('middle')  # a fresh, unpatched function with the same source
+    _patch(module.func)
+    assert monki.cache_stats() == {'hits': 1, 'misses': 1, 'errors': 0}
+    assert module.func([]) == ['start', 'middle']
+
+
+def test_different_spec_is_a_miss(cache_dir, make_module):
+    _patch(make_module('middle').func)
+    module = make_module('middle')
+    monki.patch(module.func, start='outlist.append("other start")')
+    assert monki.cache_stats()['misses'] == 2
+    assert module.func([]) == ['other start', 'middle']
+
+
+def test_changed_source_invalidates_entry(cache_dir, make_module):
+    _patch(make_module('middle').func)
+
+    module = make_module('changed')
+    _patch(module.func)
+    assert monki.cache_stats() == {'hits': 0, 'misses': 2, 'errors': 0}
+    assert module.func([]) == ['start', 'changed']
+    assert len(os.listdir(cache_dir)) == 1  # the stale entry was overwritten
+
+    module = make_module('changed')
+    _patch(module.func)
+    assert monki.cache_stats()['hits'] == 1
+
+
+def test_corrupt_entry_is_a_miss(cache_dir, make_module):
+    _patch(make_module('middle').func)
+    cache_file = os.path.join(cache_dir, os.listdir(cache_dir)[0])
+    with open(cache_file, 'r+b') as f:
+        data = f.read()
+        f.seek(0)
+        f.write(data[:-10])
+        f.truncate()
+
+    module = make_module('middle')
+    _patch(module.func)
+    assert monki.cache_stats() == {'hits': 0, 'misses': 2, 'errors': 1}
+    assert module.func([]) == ['start', 'middle']
+
+
+def test_cached_closure(cache_dir):
+    def outer_function():
+        some_list = []
+
+        def my_closure():
+            some_list.append('middle')
+            return some_list
+
+        return my_closure
+
+    for _ in range(2):
+        closure = outer_function()
+        monki.patch(closure, start='some_list.append("start")')
+        assert closure() == ['start', 'middle']
+
+    assert monki.cache_stats() == {'hits': 1, 'misses': 1, 'errors': 0}
+
+
+def test_disabled_cache_writes_nothing(tmp_path, make_module):
+    _patch(make_module('middle').func)
+    assert not os.path.exists(str(tmp_path / '__pycache__')) or \
+        not any(name.endswith('.monki') for name in os.listdir(str(tmp_path / '__pycache__')))
@@ -1,3 +1,5 @@
+import asyncio
+
 import pytest
 import monki
 
@@ -89,6 +91,105 @@ class TestWrappingFunction:
         assert 'There\'s a problem with the indentation.' in str(exc)
 
 
+class TestExitCode:
+    """
+    Tests for 'on_exit' code, which runs on every way out of the function, including in generators and coroutines.
+    """
+
+    def test_on_exit_runs_on_every_return_and_on_exceptions(self):
+        def func(outlist, value):
+            if value == 1:
+                return 'one'
+            if value == 2:
+                raise KeyError()
+            outlist.append('body')
+
+        monki.patch(func, on_exit='outlist.append("exit")')
+        outlist = []
+        assert func(outlist, 1) == 'one'
+        with pytest.raises(KeyError):
+            func(outlist, 2)
+        func(outlist, 3)
+        assert outlist == ['exit', 'exit', 'body', 'exit']
+
+    def test_on_exit_in_generator(self):
+        def gen(outlist):
+            for i in range(3):
+                yield i
+
+        monki.patch(gen, start='outlist.append("start")', on_exit='outlist.append("exit")')
+        outlist = []
+        assert list(gen(outlist)) == [0, 1, 2]
+        assert outlist == ['start', 'exit']
+
+        generator = gen(outlist)
+        next(generator)
+        generator.close()
+        assert outlist == ['start', 'exit', 'start', 'exit']
+
+    def test_async_def_with_async_for_and_async_with(self):
+        class Context:
+            async def __aenter__(self):
+                return 'context'
+
+            async def __aexit__(self, *exc_info):
+                return False
+
+        async def agen(outlist):
+            for i in range(2):
+                await asyncio.sleep(0)
+                yield i
+
+        async def coro(outlist):
+            async with Context() as context:
+                outlist.append(context)
+            async for i in agen(outlist):
+                outlist.append(i)
+            return outlist
+
+        monki.patch(agen, insert_lines={1: '    outlist.append("agen")'}, on_exit='outlist.append("agen exit")')
+        monki.patch(coro, start='outlist.append("start")', on_exit='outlist.append("exit")')
+        assert asyncio.run(coro([])) == ['start', 'context', 'agen', 0, 'agen', 1, 'agen exit', 'exit']
+
+    def test_on_return_sees_the_returned_value(self):
+        def func(outlist, value):
+            if value: return value * 2  # noqa: E701
+            for i in range(2):
+                if i:
+                    return (i,
+                            'multi-line')
+
+        monki.patch(func, on_return='outlist.append(__return__)')
+        outlist = []
+        func(outlist, 1)
+        func(outlist, 0)
+        assert outlist == [2, (1, 'multi-line')]
+
+    def test_constants_are_compiled_into_the_code(self):
+        def func(outlist):
+            return outlist
+
+        marker = object()
+        monki.patch(func, start='outlist.append(MARKER)', constants={'MARKER': marker})
+        assert func([]) == [marker]
+        assert marker in func.__code__.co_consts
+        assert 'MARKER' not in func.__code__.co_names
+
+    def test_operations_on_constants_are_not_folded(self):
+        def func():
+            return 0
+
+        monki.patch(func, on_return='__return__ = ITEMS[0] * 2 + ITEMS[-1:][0]', constants={'ITEMS': [5, 1]})
+        assert func() == 11
+
+    def test_on_exit_is_rejected_in_bytecode_mode(self):
+        def func():
+            pass
+
+        with pytest.raises(ValueError, match='not supported in bytecode mode'):
+            monki.patch(func, on_exit='pass', mode='bytecode')
+
+
 class TestProcessingClosures:
     """
     Closure functions are treated a bit differently inside CPython, so they deserve
@@ -142,7 +243,7 @@ class TestProcessingClosures:
         assert a == 'inner_a'
         assert b == 'outer_b'
 
-    def test_extending_closure_with_setting_free_variable_raises_unsupported_exception(self):
+    def test_extending_closure_with_setting_free_variable(self):
         def outer_function():
             a = 'outer_a'
             b = 'outer_b'
@@ -150,13 +251,54 @@ class TestProcessingClosures:
             def my_closure():
                 return a, b
 
-            return my_closure
+            return my_closure, lambda: a
+
+        closure, get_a = outer_function()
+        monki.patch(closure, start='a = "inner_a"')
+        assert closure() == ('inner_a', 'outer_b')
+        assert get_a() == 'inner_a'
+
+    def test_closure_that_declares_nonlocal(self):
+        def outer_function():
+            count = 0
+
+            def increment():
+                nonlocal count
+                count += 1
+                return count
+
+            return increment
 
         closure = outer_function()
+        monki.patch(closure, start='count += 10')
+        assert closure() == 11
+        assert closure() == 22
 
-        with pytest.raises(ValueError) as exc:
-            monki.patch(closure, start='a = "inner_a"')
-        assert 'Setting variables from outer function in extension - currently not supported.' in str(exc)
+    def test_closures_nested_several_levels_deep(self):
+        def level_1():
+            a = 1
+
+            def level_2():
+                b = 2
+
+                def level_3():
+                    c = 3
+
+                    def level_4():
+                        return a + b + c
+
+                    return level_4
+
+                return level_3()
+
+            return level_2()
+
+        closure = level_1()
+        code = closure.__code__
+        monki.patch(closure, start='a, b, c = a * 10, b * 100, c * 1000')
+        assert closure.__code__.co_freevars == code.co_freevars
+        assert closure() == 3210
+        assert closure() == 3020100  # the outer variables were written
 
 
 class TestInjectingLines:
@@ -291,3 +433,107 @@ class TestIndentingLines:
         with pytest.raises(TypeError) as exc:
             monki.patch(f, insert_lines={2: "for i in range(3):"}, indent_lines=2)  # int is illegal input
         assert error_message in str(exc)
+
+
+class TestPatchingManyFunctions:
+    """
+    Tests for patching many functions in a single call, where each source file is parsed once.
+    """
+
+    def test_patch_many_with_dict(self):
+        def first(outlist):
+            outlist.append('first')
+
+        def second(outlist):
+            outlist.append('second')
+
+        monki.patch_many({first: {'start': 'outlist.append("start first")'},
+                          second: {'end': 'outlist.append("end second")'}})
+        outlist = []
+        first(outlist)
+        second(outlist)
+        assert outlist == ['start first', 'first', 'second', 'end second']
+
+    def test_patch_many_functions_with_the_same_name(self):
+        def make_func(text):
+            def func(outlist):
+                outlist.append(text)
+            return func
+
+        def func(outlist):
+            outlist.append('plain')
+
+        closure = make_func('closure')
+        monki.patch_many([(closure, {'start': 'outlist.append("start closure")'}),
+                          (func, {'start': 'for i in range(2):', 'indent_inner': True})])
+        outlist = []
+        closure(outlist)
+        func(outlist)
+        assert outlist == ['start closure', 'closure', 'plain', 'plain']
+
+    def test_patch_many_functions_with_lambdas_in_their_defaults(self):
+        def func(value, key=lambda value: value * 2):
+            return key(value)
+
+        def other(value, key=lambda value: value * 3):
+            return key(value)
+
+        monki.patch_many({func: {'start': 'value += 1'}, other: {'start': 'value += 2'}})
+        assert (func(1), other(1)) == (4, 9)
+        assert func.__code__.co_qualname.endswith('.func') and other.__code__.co_qualname.endswith('.other')
+
+    def test_patch_many_doesnt_modify_anything_on_error(self):
+        def outer_function():
+            a = 'outer_a'
+
+            def my_closure():
+                return a
+
+            return my_closure
+
+        def func():
+            return 'func'
+
+        closure = outer_function()
+        with pytest.raises(ValueError):
+            monki.patch_many([(func, {'start': 'return "patched"'}), (closure, {'start': 'for i in range(2):'})])
+        assert func() == 'func'
+        assert closure() == 'outer_a'
+
+    def test_patch_many_rejects_unknown_arguments(self):
+        def func():
+            pass
+
+        with pytest.raises(TypeError):
+            monki.patch_many({func: {'begin': 'pass'}})
+
+    def test_patch_many_rejects_duplicate_functions(self):
+        def func():
+            pass
+
+        with pytest.raises(ValueError) as exc:
+            monki.patch_many([(func, {'start': 'pass'}), (func, {'end': 'pass'})])
+        assert 'Each function can appear only once' in str(exc)
+
+    def test_patch_module(self, tmp_path, monkeypatch):
+        (tmp_path / 'module_to_patch.py').write_text(
+            'def func(outlist):\n'
+            '    outlist.append("func")\n'
+            '\n'
+            '\n'
+            'class Thing:\n'
+            '    @staticmethod\n'
+            '    def method(outlist):\n'
+            '        outlist.append("method")\n')
+        monkeypatch.syspath_prepend(str(tmp_path))
+        import module_to_patch
+
+        monki.patch_module(module_to_patch, {'func': {'start': 'outlist.append("start func")'},
+                                             'Thing.method': {'end': 'outlist.append("end method")'}})
+        outlist = []
+        module_to_patch.func(outlist)
+        module_to_patch.Thing.method(outlist)
+        assert outlist == ['start func', 'func', 'method', 'end method']
+
+        with pytest.raises(ValueError):
+            monki.patch_module(module_to_patch, {'Thing.missing': {'start': 'pass'}})
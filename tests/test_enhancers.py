@@ -1,6 +1,17 @@
+import array
+import asyncio
+import dis
+import math
+import threading
+import time
+import typing
+
 import pytest
 
-from monki.enhancers import typecheck, ignoreerror
+import monki
+from monki.enhancers import typecheck, ignoreerror, disable_typechecks, enable_typechecks, memoize, \
+    timed, latency_snapshot, latency_percentiles, reset_latencies, bind_globals, rebind, \
+    inline, specialize, specialization_stats, batched
 
 
 def test_typecheck_doesnt_raise_when_all_args_correct():
@@ -57,3 +68,538 @@ def test_ignoreerror_when_subclass_is_raised():
         raise MyError('The world is ending!')
 
     func()  # the MyError should be caught
+
+
+def test_enhancers_on_async_functions():
+    @typecheck
+    async def checked(a: int):
+        return a
+
+    @ignoreerror(RuntimeError)
+    async def ignoring():
+        await asyncio.sleep(0)
+        raise RuntimeError('The world is ending!')
+
+    assert asyncio.run(checked(1)) == 1
+    with pytest.raises(TypeError):
+        asyncio.run(checked('1'))
+    asyncio.run(ignoring())  # the RuntimeError should be caught
+
+
+def test_typecheck_with_typing_generics():
+    @typecheck
+    def func(a: typing.Optional[typing.List[int]], b: typing.Dict[str, int] = None, *args: str):
+        return 'ok'
+
+    assert func([1, 2], {'b': 2}, 'c') == 'ok'
+    assert func(None) == 'ok'
+    for args in [(['1'],), ([1], {'b': '2'}), (None, None, 3), ((1,),)]:
+        with pytest.raises(TypeError):
+            func(*args)
+
+
+def test_typecheck_depth():
+    @typecheck(depth=2)
+    def deep(a: typing.List[typing.List[int]]):
+        pass
+
+    @typecheck
+    def shallow(a: typing.List[typing.List[int]]):
+        pass
+
+    shallow([['not an int']])
+    with pytest.raises(TypeError):
+        shallow(['not a list'])
+    with pytest.raises(TypeError):
+        deep([['not an int']])
+
+
+def test_typecheck_checks_return_value_on_every_return():
+    @typecheck
+    def func(a) -> int:
+        if a == 1: return 'one'  # noqa: E701
+        if a == 2:
+            return 2
+
+    assert func(2) == 2
+    with pytest.raises(TypeError) as exc:
+        func(1)
+    assert 'return value must be of type int' in str(exc)
+    with pytest.raises(TypeError):
+        func(3)  # falls off the end and returns None
+
+
+def test_typecheck_compiles_types_as_constants():
+    @typecheck
+    def func(a: typing.List[int]):
+        pass
+
+    assert list in func.__code__.co_consts
+    assert 'isinstance' not in func.__code__.co_names
+
+
+def test_typecheck_sampling():
+    @typecheck(sample=3)
+    def func(a: int):
+        pass
+
+    raised = 0
+    for _ in range(6):
+        try:
+            func('1')
+        except TypeError:
+            raised += 1
+    assert raised == 2
+
+
+def test_typecheck_kill_switch():
+    @typecheck
+    def func(a: int):
+        pass
+
+    disable_typechecks()
+    try:
+        func('1')
+
+        @typecheck
+        def decorated_while_disabled(a: int):
+            pass
+
+        decorated_while_disabled('1')
+    finally:
+        enable_typechecks()
+
+    with pytest.raises(TypeError):
+        func('1')
+    with pytest.raises(TypeError):
+        decorated_while_disabled('1')
+
+
+def test_typecheck_kill_switch_with_other_patches_on_top():
+    @timed
+    @typecheck
+    def func(a: int):
+        return a
+
+    @typecheck
+    def other(a: int):
+        return a
+
+    try:
+        disable_typechecks()
+        assert func('1') == '1' and other('1') == '1'
+    finally:
+        enable_typechecks()
+        reset_latencies()
+    with pytest.raises(TypeError):
+        func('1')
+    with pytest.raises(TypeError):
+        other('1')
+
+
+def test_memoize_caches_by_bound_arguments():
+    calls = []
+
+    @memoize
+    def func(a, b=2, *args, c=3, **kwargs):
+        calls.append(a)
+        return a + b + c
+
+    code = func.__code__
+    assert func(1) == func(1, 2) == func(a=1, c=3) == 6
+    assert func(1, d=4) == 6
+    assert calls == [1, 1]
+    assert func.cache_info() == (2, 2, 0, 2, 128, None)
+    assert func.__code__ is code
+
+
+def test_memoize_evicts_least_recently_used():
+    calls = []
+
+    @memoize(maxsize=2)
+    def func(a):
+        calls.append(a)
+        return a
+
+    func(1), func(2), func(1), func(3), func(1), func(2)
+    assert calls == [1, 2, 3, 2]
+    assert func.cache_info().evictions == 2
+
+
+def test_memoize_ttl_and_invalidation():
+    calls = []
+
+    @memoize(ttl=0.05, key=lambda a, b=None: a)
+    def func(a, b=None):
+        calls.append(a)
+        return a
+
+    func(1), func(1, 'ignored by the key')
+    assert calls == [1]
+    time.sleep(0.06)
+    func(1)
+    assert calls == [1, 1]
+
+    assert func.cache_invalidate(1) is True
+    assert func.cache_invalidate(1) is False
+    func(1)
+    assert calls == [1, 1, 1]
+    func.cache_clear()
+    assert func.cache_info() == (0, 0, 0, 0, 128, 0.05)
+
+
+def test_memoize_recursive_threaded_and_async():
+    @memoize(maxsize=None, thread_safe=True)
+    def fib(n):
+        return n if n < 2 else fib(n - 1) + fib(n - 2)
+
+    threads = [threading.Thread(target=fib, args=(200,)) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert fib(200) == 280571172992510140037611932413038677189525
+
+    @memoize
+    async def coro(a):
+        await asyncio.sleep(0)
+        return [a]
+
+    assert asyncio.run(coro(1)) is asyncio.run(coro(1))
+
+
+def test_memoize_rejects_generators_and_bad_arguments():
+    def gen():
+        yield
+
+    with pytest.raises(TypeError):
+        memoize(gen)
+    with pytest.raises(ValueError):
+        memoize(maxsize=0)(lambda: None)
+
+
+def test_timed_records_returns_and_exceptions():
+    @timed(histogram=[10 ** 9])
+    def func(fail):
+        if fail:
+            raise KeyError()
+        return 1
+
+    func(False)
+    with pytest.raises(KeyError):
+        func(True)
+    assert latency_snapshot()[func] == ((10 ** 9,), (2, 0), 1)
+    assert latency_percentiles()[func] == (10 ** 9, 10 ** 9, 10 ** 9, 2)
+
+    reset_latencies()
+    assert latency_percentiles()[func] == (None, None, None, 0)
+
+
+def test_timed_samples_and_counts_overflow():
+    @timed(histogram=[1], sample=3)
+    def func():
+        time.sleep(0.001)
+
+    for _ in range(7):
+        func()
+    assert latency_snapshot()[func].counts == (0, 2)
+    assert latency_percentiles()[func].p50 == math.inf
+
+
+def test_timed_rejects_bad_histograms():
+    with pytest.raises(ValueError):
+        timed(histogram=[10, 5])(lambda: None)
+    with pytest.raises(ValueError):
+        timed(sample=0)(lambda: None)
+
+
+SCALE = 2
+
+
+def test_bind_globals_binds_globals_and_builtins():
+    global SCALE
+
+    @bind_globals
+    def func(items):
+        return [len(str(item)) * SCALE for item in items]
+
+    assert func([1, 10]) == [2, 4]
+    assert not [instruction for instruction in dis.get_instructions(func) if instruction.opname == 'LOAD_GLOBAL']
+    SCALE = 3
+    try:
+        assert func([1]) == [2]
+        rebind(func)
+        assert func([1]) == [3]
+    finally:
+        SCALE = 2
+
+
+def test_bind_globals_without_freezing_binds_only_builtins():
+    global SCALE
+
+    @bind_globals(freeze=False)
+    def func(item):
+        return len(item) * SCALE
+
+    SCALE = 3
+    try:
+        assert func('ab') == 6
+    finally:
+        SCALE = 2
+
+
+def test_bind_globals_leaves_locals_and_assigned_globals():
+    def func(items):
+        global SCALE
+        SCALE = 2
+        len = sum  # noqa: F841
+        return [max(item) for item in items]
+
+    bind_globals(func)
+    assert func([[1, 3]]) == [3]
+    with pytest.raises(ValueError, match="SCALE can't be bound"):
+        bind_globals(func, names=['SCALE'])
+    with pytest.raises(ValueError, match='no bound globals'):
+        rebind(lambda: None)
+
+
+def test_bind_globals_binds_globals_which_are_declared_but_only_read():
+    def func(item):
+        global SCALE; return item * SCALE  # noqa: E702
+
+    def nested(item):
+        def inner():
+            global SCALE
+            return item * SCALE
+        return inner()
+
+    bind_globals(func)
+    bind_globals(nested)
+    assert func(2) == nested(2) == 4
+    assert not [instruction for instruction in dis.get_instructions(func) if instruction.opname == 'LOAD_GLOBAL']
+
+
+def clamp(value, low=0, high=SCALE * 50):
+    """ The default of high is evaluated once, when clamp is defined. """
+    return low if value < low else high if value > high else value
+
+
+def key_of(item):
+    return item[0]
+
+
+is_positive = lambda value: value > 0  # noqa: E731
+
+
+def recursive(n):
+    return n and recursive(n - 1)
+
+
+def variadic(*args):
+    return args
+
+
+def test_inline_replaces_calls_with_expressions():
+    @inline(clamp, key_of, is_positive)
+    def func(items):
+        clamped = [clamp(item) for item in items if is_positive(item)]
+        return clamped, clamp(-5, high=1), key_of(items)
+
+    assert func([-1, 50, 500]) == ([50, 100], 0, -1)
+    assert not [instruction for instruction in dis.get_instructions(func) if instruction.opname == 'LOAD_GLOBAL']
+
+
+def test_inline_evaluates_complex_arguments_once_in_order():
+    calls = []
+
+    def record(value):
+        calls.append(value)
+        return value
+
+    @inline(clamp)
+    def func():
+        return clamp(record(500),
+                     record(1), record(10)), [clamp(record(i)) for i in (1, 2)]
+
+    assert func() == (10, [1, 2])
+    assert calls == [500, 1, 10, 1, 2]  # the calls in the comprehension aren't inlined, but still work
+
+
+def test_inline_keeps_line_numbers_for_later_patches():
+    @inline(clamp)
+    def func(value):
+        value = clamp(value,
+                      high=10)
+        return value
+
+    monki.patch(func, insert_lines={2: 'value *= 2'})
+    assert func(7) == 14
+
+
+def test_inline_refuses_unsafe_helpers():
+    def closure():
+        return calls
+
+    calls = []
+
+    def func(a):
+        return recursive(a), closure(), variadic(a), len(a)
+
+    for helper, message in [(recursive, 'recursive'), (closure, 'closure'), (variadic, r'\*args'),
+                            (len, 'Only functions')]:
+        with pytest.raises((ValueError, TypeError), match=message):
+            inline(helper)(func)
+    with pytest.raises(ValueError, match="doesn't call"):
+        inline(clamp)(func)
+
+
+def _describe_value(value, scale=1):
+    if isinstance(value, str):
+        value = len(value)
+    elif type(value) is list:
+        return [item * scale for item in value]
+    assert isinstance(scale, int)
+    return value * scale if isinstance(value, (int, float)) else None
+
+
+def test_specialize_folds_type_checks_of_common_types():
+    func = specialize(_copy_function(_describe_value), warmup=4, max_variants=1)
+    assert [func(value) for value in (1, 2, 3, 4)] == [1, 2, 3, 4]
+    assert specialization_stats(func).variants == [(int, int)]
+
+    # the copy for ints has no type checks left
+    names = [instruction.argval for instruction in dis.get_instructions(func)]
+    assert names.count('isinstance') == 3 and 'type' not in names[:names.index('len')]
+    assert [func(5), func('abc', 2), func([1], 3), func(None)] == [5, 6, [3], None]
+    stats = specialization_stats(func)
+    assert stats.guard_hits == [1] and stats.fallbacks == 3 and stats.hit_rate == 0.25
+
+
+def test_specialize_deoptimizes_when_types_change():
+    func = specialize(_copy_function(_describe_value), warmup=2, max_variants=1, max_deopts=1)
+    func(1), func(2)
+    for _ in range(2):  # the fallbacks are the majority, so the function counts types again
+        assert func('ab') == 2
+    assert specialization_stats(func) == ([], [], 0, None, 1)
+    func('abc'), func('abcd')
+    assert specialization_stats(func).variants == [(str, int)]
+    for _ in range(4):  # only one deoptimization is allowed
+        func(1.5)
+    assert specialization_stats(func).deopts == 1 and specialization_stats(func).fallbacks == 4
+
+
+def test_specialize_doesnt_fold_reassigned_parameters():
+    def func(value):
+        value = str(value)
+        return isinstance(value, str)
+
+    specialize(func, warmup=1)
+    func(1)
+    assert specialization_stats(func).variants == []  # nothing to fold, so it's left as it was
+    assert not monki.registry.is_patched(func)
+
+
+def test_specialize_refuses_bad_functions():
+    def global_statement(value):
+        global SCALE
+        return value
+
+    def no_parameters():
+        pass
+
+    with pytest.raises(ValueError, match='global or nonlocal'):
+        specialize(global_statement)
+    with pytest.raises(ValueError, match='no parameters'):
+        specialize(no_parameters)
+    with pytest.raises(ValueError, match='warmup'):
+        specialize(warmup=0)(lambda value: value)
+
+
+def _copy_function(func):
+    return type(func)(func.__code__, func.__globals__, func.__name__, func.__defaults__, func.__closure__)
+
+
+def test_enhancers_apply_pending_lazy_patches_first():
+    def checked(a: int):
+        return a
+
+    def cached(a):
+        cached.calls += 1
+        return a
+
+    def rows(a, b):
+        return a + b
+
+    cached.calls = 0
+    for func in (checked, cached, rows):
+        monki.patch(func, start='a += 1', lazy=True)
+    typecheck(checked)
+    memoize(cached)
+    batched(rows)
+
+    assert checked(1) == 2
+    with pytest.raises(TypeError):
+        checked('a')
+    assert cached(1) == cached(1) == 2
+    assert cached.calls == 1
+    assert rows.batch([1, 2], [10, 20]) == [12, 23]
+
+
+def test_batched_calls_the_body_for_every_item():
+    scale = 10
+
+    @batched
+    def func(value):
+        """ The docstring runs for every item too. """
+        if value is None: return 'missing'
+        try:
+            if value < 0:
+                return
+        finally:
+            value *= scale
+        return value
+
+    assert func.batch([1, None, -1, 2]) == [10, 'missing', None, 20]
+    assert func(3) == 30  # the function itself isn't changed
+    assert func.batch([]) == []
+    assert func.batch.__qualname__.endswith('func.batch')
+
+
+def test_batched_zips_numeric_columns_into_an_array():
+    @batched(typecode='d')
+    def func(a, b):
+        if a > b:
+            return a - b
+        return 0
+
+    result = func.batch(array.array('i', [5, 1, 7]), memoryview(array.array('d', [2.0, 3.0, 1.5, 9.0])))
+    assert result == array.array('d', [3.0, 0.0, 5.5])
+
+
+def test_batched_columns_are_named_after_the_parameters():
+    @batched
+    def func(price, quantity):
+        return price * quantity
+
+    assert func.batch(quantity=[2, 3], price=[5, 7]) == [10, 21]
+    with pytest.raises(TypeError, match="'price' and 'quantity'"):
+        func.batch()
+
+
+def test_batched_refuses_unsupported_functions():
+    def returns_in_loop(items):
+        for item in items:
+            return item
+
+    def generator(item):
+        yield item
+
+    def variadic(*items):
+        return items
+
+    with pytest.raises(ValueError, match='inside a loop'):
+        batched(returns_in_loop)
+    with pytest.raises(TypeError, match='Generator'):
+        batched(generator)
+    with pytest.raises(ValueError, match='positional'):
+        batched(variadic)
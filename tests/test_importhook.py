@@ -0,0 +1,97 @@
+import glob
+import importlib
+import os
+import sys
+
+import pytest
+import monki
+from monki import importhook
+
+
+_MODULE_SOURCE = '''
+import functools
+
+
+def func(outlist):
+    outlist.append("middle")
+    return outlist
+
+
+class SomeClass:
+    @functools.lru_cache()
+    def method(self):
+        return ["method"]
+
+
+def outer():
+    def inner(outlist):
+        return outlist
+    return inner
+
+
+def after():
+    raise RuntimeError()
+'''
+
+
+@pytest.fixture
+def module_path(tmp_path, monkeypatch):
+    monkeypatch.syspath_prepend(str(tmp_path))
+    path = str(tmp_path / 'hooked_module.py')
+    with open(path, 'w') as f:
+        f.write(_MODULE_SOURCE)
+    importlib.invalidate_caches()
+    yield path
+    monki.uninstall_import_hook()
+    sys.modules.pop('hooked_module', None)
+
+
+def _import():
+    sys.modules.pop('hooked_module', None)
+    return importlib.import_module('hooked_module')
+
+
+_SPECS = {'hooked_module': {
+    'func': {'start': 'outlist.append("start")', 'insert_lines': {1: 'outlist.append("end")'}},
+    'SomeClass.method': {'start': 'return ["patched"]'},
+    'outer.<locals>.inner': {'start': 'outlist.append("inner")'},
+}}
+
+
+def test_functions_are_patched_on_import(module_path):
+    monki.install_import_hook(_SPECS)
+    module = _import()
+
+    assert module.func([]) == ['start', 'middle', 'end']
+    assert module.SomeClass().method() == ['patched']
+    assert module.outer()([]) == ['inner']
+    with pytest.raises(RuntimeError) as e:
+        module.after()
+    assert e.traceback[-1].lineno + 1 == _MODULE_SOURCE.splitlines().index('    raise RuntimeError()') + 1
+
+
+def test_patched_module_is_cached(module_path, monkeypatch):
+    monkeypatch.setattr(sys, 'dont_write_bytecode', False)
+    monki.install_import_hook(_SPECS)
+    _import()
+    cached_files = glob.glob(os.path.join(os.path.dirname(module_path), '__pycache__', '*.opt-monki*.pyc'))
+    assert len(cached_files) == 1
+
+
+    def fail(*args, **kwargs):
+        raise AssertionError('The module should be loaded from the cache.')
+
+    monkeypatch.setattr(importhook._PatchingLoader, 'source_to_code', fail)
+    assert _import().func([]) == ['start', 'middle', 'end']
+
+
+def test_imported_module_raises_error(module_path):
+    _import()
+    with pytest.raises(ValueError, match='already imported'):
+        monki.install_import_hook(_SPECS)
+
+
+def test_missing_function_raises_error(module_path):
+    monki.install_import_hook({'hooked_module': {'missing': {'start': 'pass'}}})
+    with pytest.raises(ValueError, match='Can\'t find missing'):
+        _import()
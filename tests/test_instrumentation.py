@@ -0,0 +1,74 @@
+import pytest
+
+import monki
+
+
+@pytest.fixture(autouse=True)
+def collecting_stats():
+    monki.reset_stats()
+    monki.enable_stats()
+    yield
+    monki.disable_stats()
+    monki.reset_stats()
+
+
+def first(a):
+    return a
+
+
+def second(a):
+    return a + 1
+
+
+class TestPatchStats:
+    """
+    Tests for timing the phases of patching with monki.stats().
+    """
+
+    def test_phases_of_a_patch(self):
+        def func(a):
+            return a
+
+        monki.patch(func, start='a += 1')
+        stats = monki.stats()
+        assert stats.patches == 1 and stats.compiled_modules == 1
+        assert stats.code_size == len(func.__code__.co_code)
+        assert stats.source_size > 0
+        assert all(stats.phase_ns[phase] > 0 for phase in ('source', 'parse', 'modify', 'compile', 'swap'))
+
+        function_stats, = stats.functions.values()
+        assert function_stats.patches == 1 and function_stats.code_size == stats.code_size
+        assert sum(function_stats.phase_ns.values()) <= sum(stats.phase_ns.values())
+        assert list(stats.functions)[0].endswith('test_phases_of_a_patch.<locals>.func')
+
+    def test_functions_of_a_file_are_compiled_in_one_module(self):
+        monki.patch_many({first: {'start': 'a *= 2'}, second: {'start': 'a *= 3'}})
+        try:
+            stats = monki.stats()
+            assert stats.patches == 2 and stats.compiled_modules == 1
+            assert {name.rsplit('.', 1)[1] for name in stats.functions} == {'first', 'second'}
+            assert all(function_stats.phase_ns['compile'] > 0 for function_stats in stats.functions.values())
+        finally:
+            monki.unpatch(first)
+            monki.unpatch(second)
+
+    def test_nothing_is_collected_when_disabled(self):
+        def func(a):
+            return a
+
+        monki.disable_stats()
+        monki.patch(func, start='a += 1')
+        stats = monki.stats()
+        assert stats.patches == 0 and stats.compiled_modules == 0 and stats.functions == {}
+        assert not any(stats.phase_ns.values())
+
+    def test_trace_writes_a_line_per_patch(self, capsys):
+        def func(a):
+            return a
+
+        monki.enable_stats(trace=True)
+        monki.patch(func, start='a += 1')
+        monki.patch(func, end='a += 1')
+        lines = capsys.readouterr().err.splitlines()
+        assert len(lines) == 2
+        assert lines[0].startswith('monki: patched ') and 'compile' in lines[0] and 'bytes of bytecode' in lines[0]
@@ -0,0 +1,95 @@
+import inspect
+
+import pytest
+
+import monki
+
+
+@pytest.fixture(autouse=True)
+def no_pending_patches():
+    yield
+    monki.force_lazy_patches()
+
+
+class TestLazyPatching:
+    """
+    Tests for patching with lazy=True.
+    """
+
+    def test_function_is_patched_on_first_call(self):
+        def func(a):
+            return a
+
+        monki.patch(func, start='a += 1', lazy=True)
+        assert monki.pending_lazy_patches() == 1
+        assert func(1) == 2
+        assert monki.pending_lazy_patches() == 0
+        assert func(1) == 2
+
+    def test_arguments_are_validated_immediately(self):
+        def func():
+            pass
+
+        with pytest.raises(TypeError):
+            monki.patch(func, start='pass', indent_inner=-1, lazy=True)
+        assert monki.pending_lazy_patches() == 0
+
+    def test_forcing_pending_patches(self):
+        def func(a, b=2):
+            return a + b
+
+        monki.patch(func, end='b = 0', insert_lines={0: 'a *= 10'}, lazy=True)
+        monki.force_lazy_patches()
+        assert monki.pending_lazy_patches() == 0
+        assert func(1) == 12
+        assert func.__code__.co_varnames == ('a', 'b')
+
+    def test_lazy_closure_generator(self):
+        step = 2
+
+        def func(n):
+            for i in range(n):
+                yield i * step
+
+        monki.patch(func, insert_lines={1: '    i += 1'}, lazy=True)
+        assert inspect.getsource(func).startswith('        def func(n):')
+        assert list(func(2)) == [2, 4]
+
+    def test_patching_again_layers_on_pending_patches(self):
+        def func(a):
+            return a
+
+        monki.patch(func, start='a += 1', lazy=True)
+        monki.patch(func, start='a *= 10', lazy=True)
+        assert monki.pending_lazy_patches() == 1
+        assert func(1) == 11
+
+        def other(a):
+            return a
+
+        monki.patch(other, start='a += 1', lazy=True)
+        monki.patch(other, start='a *= 10')
+        assert monki.pending_lazy_patches() == 0
+        assert other(1) == 11
+
+    def test_unpatching_drops_pending_patches(self):
+        def func(a):
+            return a
+
+        code = func.__code__
+        monki.patch(func, start='a += 1', lazy=True)
+        monki.unpatch(func)
+        assert monki.pending_lazy_patches() == 0
+        assert func.__code__ is code
+
+    def test_failed_pending_patch_restores_the_original_code(self):
+        def func(a):
+            return a
+
+        code = func.__code__
+        monki.patch(func, start='a +=', lazy=True)  # not valid code, which only fails when compiled
+        with pytest.raises(SyntaxError):
+            func(1)
+        assert func.__code__ is code
+        assert monki.pending_lazy_patches() == 0
+        assert not monki.core.registry.is_patched(func)
@@ -0,0 +1,89 @@
+import asyncio
+import functools
+
+import pytest
+
+import monki
+
+
+class TestLineProfiler:
+    """
+    Tests for profile_lines and line_stats.
+    """
+
+    def test_hits_and_times_of_top_level_statements(self):
+        def func(n):
+            """ The docstring isn't profiled. """
+            total = 0
+            for i in range(n):
+                total += i
+            if total > 5:
+                return total
+            a = 1; return a
+
+        monki.profile_lines(func)
+        assert func(3) == 1
+        assert func(10) == 45
+        stats = monki.line_stats(func)
+        assert [(line, hits, code) for line, hits, _, code in stats] == [
+            (1, 2, 'total = 0'), (2, 2, 'for i in range(n):'), (4, 2, 'if total > 5:'), (6, 1, 'a = 1; return a')]
+        assert all(stats_line.time_ns > 0 for stats_line in stats)
+
+    def test_decorated_nested_definitions(self):
+        def func(n):
+            @functools.lru_cache()
+            def square(i):
+                return i * i
+
+            @staticmethod
+            @functools.lru_cache()
+            def unused():
+                pass
+            return sum(square(i) for i in range(n))
+
+        monki.profile_lines(func)
+        assert func(3) == 5
+        assert [(line, hits, code) for line, hits, _, code in monki.line_stats(func)] == [
+            (0, 1, '@functools.lru_cache()'), (4, 1, '@staticmethod'), (8, 1, 'return sum(square(i) for i in range(n))')]
+
+    def test_time_of_last_statement_is_added_on_exceptions(self):
+        def func():
+            value = 1
+            raise RuntimeError(value)
+
+        monki.profile_lines(func)
+        with pytest.raises(RuntimeError):
+            func()
+        assert monki.line_stats(func)[1].hits == 1
+        assert monki.line_stats(func)[1].time_ns > 0
+
+    def test_coroutine_and_patched_function(self):
+        async def coro(a):
+            await asyncio.sleep(0)
+            return a
+
+        monki.patch(coro, start='a += 1')
+        monki.profile_lines(coro)
+        assert asyncio.run(coro(1)) == 2
+        assert [stats.code for stats in monki.line_stats(coro)] == ['a += 1', 'await asyncio.sleep(0)', 'return a']
+
+    def test_unpatching_stops_profiling(self):
+        def func():
+            return 1
+
+        code = func.__code__
+        monki.profile_lines(func)
+        with pytest.raises(ValueError, match='already profiled'):
+            monki.profile_lines(func)
+        func()
+        monki.unpatch(func)
+        func()
+        assert func.__code__ is code
+        assert monki.line_stats(func)[0].hits == 1
+
+    def test_function_which_was_never_profiled(self):
+        def func():
+            pass
+
+        with pytest.raises(ValueError, match='never profiled'):
+            monki.line_stats(func)
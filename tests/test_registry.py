@@ -0,0 +1,313 @@
+import gc
+import linecache
+import sys
+import threading
+import tracemalloc
+
+import pytest
+
+import monki
+from monki import bytecode
+from monki import registry
+
+
+class TestStackingPatches:
+    """
+    Tests for patching the same function more than once, and for undoing patches.
+    """
+
+    def test_patches_are_layered(self):
+        def func(a):
+            b = a
+            return b
+
+        monki.patch(func, start='a += 1')
+        monki.patch(func, start='a *= 10')
+        assert func(1) == 11
+
+    def test_line_numbers_refer_to_the_patched_body(self):
+        def func(a):
+            b = a
+            return b
+
+        monki.patch(func, insert_lines={1: 'b += 1'})
+        monki.patch(func, insert_lines={2: 'b *= 10'})  # after the line inserted by the first patch
+        assert func(1) == 20
+
+    def test_layering_on_a_closure(self):
+        offset = 5
+
+        def func(a):
+            return a + offset
+
+        monki.patch(func, start='a += 1')
+        monki.patch(func, indent_inner=True, start='for _ in range(1):')
+        assert func(1) == 7
+
+    def test_unpatch_restores_original_code(self):
+        def func(a):
+            return a
+
+        code = func.__code__
+        monki.patch(func, start='a += 1')
+        monki.patch(func, start='a += 1')
+        monki.unpatch(func)
+        assert func.__code__ is code
+        assert func(1) == 1
+
+        monki.patch(func, start='a += 2')  # patching again starts from the original source
+        assert func(1) == 3
+
+    def test_unpatch_all(self):
+        def first():
+            return 1
+
+        def second():
+            return 2
+
+        monki.patch_many({first: {'end': 'pass'}, second: {'start': 'return 3'}})
+        monki.unpatch_all()
+        assert second() == 2
+
+    @pytest.mark.skipif(not bytecode.is_supported(), reason='bytecode mode requires CPython 3.11')
+    def test_source_patch_over_bytecode_patch_raises_error(self):
+        def func(a):
+            return a
+
+        monki.patch(func, start='a += 1', mode='bytecode')
+        monki.patch(func, start='a += 1', mode='bytecode')
+        assert func(1) == 3
+        with pytest.raises(ValueError, match='bytecode mode'):
+            monki.patch(func, start='a += 1')
+
+
+class TestToggles:
+    """
+    Tests for switching groups of patches on and off.
+    """
+
+    def test_enable_and_disable(self):
+        def first(a):
+            return a
+
+        def second(a):
+            return a
+
+        original_code = first.__code__
+        monki.patch(first, start='a += 1', toggle='test_enable_and_disable')
+        monki.patch_many({second: {'start': 'a += 2'}}, toggle='test_enable_and_disable')
+        assert (first(1), second(1)) == (2, 3)
+
+        monki.disable('test_enable_and_disable')
+        assert first.__code__ is original_code
+        assert (first(1), second(1)) == (1, 1)
+
+        monki.enable('test_enable_and_disable')
+        assert (first(1), second(1)) == (2, 3)
+
+    def test_unknown_toggle_raises_error(self):
+        with pytest.raises(ValueError, match='no patches with the toggle'):
+            monki.enable('test_unknown_toggle')
+
+    def test_patching_again_takes_function_out_of_toggle(self):
+        def first(a):
+            return a
+
+        def second(a):
+            return a
+
+        monki.patch_many({first: {'start': 'a += 1'}, second: {'start': 'a += 1'}}, toggle='test_patched_again')
+        monki.patch(first, start='a *= 10')
+        assert first(1) == 11
+        monki.disable('test_patched_again')
+        assert (first(1), second(1)) == (11, 1)
+        monki.enable('test_patched_again')
+        assert (first(1), second(1)) == (11, 2)
+
+    def test_disabled_toggle_cant_be_patched_again(self):
+        def first(a):
+            return a
+
+        def second(a):
+            return a
+
+        monki.patch_many({first: {'start': 'a += 100'}, second: {'start': 'a += 100'}}, toggle='test_disabled_again')
+        monki.disable('test_disabled_again')
+        with pytest.raises(ValueError, match='disabled toggle'):
+            monki.patch(first, start='a *= 2')
+        with pytest.raises(ValueError, match='disabled toggle'):
+            monki.patch(first, start='a *= 2', lazy=True)
+        assert (first(1), second(1)) == (1, 1)
+
+        monki.enable('test_disabled_again')
+        assert (first(1), second(1)) == (101, 101)
+        monki.disable('test_disabled_again')
+        assert (first(1), second(1)) == (1, 1)
+
+    def test_replaced_code_is_dropped_from_toggle(self):
+        def first(a):
+            return a
+
+        def second(a):
+            return a
+
+        monki.patch_many({first: {'start': 'a += 1'}, second: {'start': 'a += 1'}}, toggle='test_replaced_code')
+        first.__code__ = first.__code__.replace()
+        monki.disable('test_replaced_code')
+        assert (first(1), second(1)) == (2, 1)
+        monki.enable('test_replaced_code')
+        assert (first(1), second(1)) == (2, 2)
+
+    def test_unpatch_removes_function_from_toggle(self):
+        def func(a):
+            return a
+
+        monki.patch(func, start='a += 1', toggle='test_unpatch_toggle')
+        monki.unpatch(func)
+        with pytest.raises(ValueError, match='no patches with the toggle'):
+            monki.enable('test_unpatch_toggle')
+
+    def test_lazy_toggle_raises_error(self):
+        def func():
+            pass
+
+        with pytest.raises(ValueError, match='lazy'):
+            monki.patch(func, start='pass', lazy=True, toggle='test_lazy_toggle')
+
+
+@pytest.fixture
+def frequent_thread_switches():
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    yield
+    sys.setswitchinterval(interval)
+
+
+def _run_threads(*targets):
+    threads = [threading.Thread(target=target) for target in targets]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+class TestConcurrentPatching:
+    """
+    Tests for patching, unpatching and calling the same functions from many threads at once.
+    """
+
+    def test_concurrent_patches_are_all_applied(self, frequent_thread_switches):
+        def func(a):
+            return a
+
+        stop = threading.Event()
+        seen = [[] for _ in range(4)]
+
+        def call(results):
+            while not stop.is_set():
+                results.append(func(0))
+
+        def patch():
+            for _ in range(10):
+                monki.patch(func, start='a += 1')
+
+        callers = [threading.Thread(target=call, args=(results,)) for results in seen]
+        for caller in callers:
+            caller.start()
+        try:
+            _run_threads(*[patch] * 8)
+        finally:
+            stop.set()
+            for caller in callers:
+                caller.join()
+
+        assert func(0) == 80
+        assert len(registry.get(func).specs) == 80
+        # every call ran a fully patched version, and a newer one than the calls before it in the same thread
+        for results in seen:
+            assert all(0 <= result <= 80 for result in results)
+            assert results == sorted(results)
+
+    def test_patching_and_unpatching_concurrently(self, frequent_thread_switches):
+        def func(a):
+            return a
+
+        def patch_and_unpatch():
+            for _ in range(20):
+                monki.patch(func, start='a += 1')
+                monki.patch(func, end='a += 1')
+                monki.unpatch(func)
+
+        _run_threads(*[patch_and_unpatch] * 6)
+        assert func(0) == 0 and not registry.is_patched(func)
+
+    def test_lazy_patch_is_applied_once(self, frequent_thread_switches):
+        def func(a):
+            return a
+
+        monki.patch(func, start='a += 1', lazy=True)
+        results = []
+        _run_threads(*[lambda: results.append(func(0))] * 8)
+        assert results == [1] * 8
+        assert len(registry.get(func).specs) == 1
+
+    def test_running_calls_finish_on_the_old_code(self):
+        def gen():
+            yield 1
+            yield 2
+
+        running = gen()
+        assert next(running) == 1
+        monki.patch(gen, start='yield 0')
+        assert list(running) == [2]
+        assert list(gen()) == [0, 1, 2]
+
+
+_FUNCTION_TEMPLATE = '''
+def func_{index}(values, scale=1):
+    """ Sums the scaled values which are above a threshold. """
+    total = 0
+    threshold = {index} % 7
+    for value in values:
+        if value > threshold:
+            total += value * scale
+        else:
+            total -= 1
+    return total
+'''
+
+
+class TestMemoryPerPatch:
+    """
+    Tests for the memory which stays allocated for every patched function.
+    """
+
+    # bytes per function, including its new code object (about 700 bytes for these functions), its record and lock
+    BUDGET = 1600
+
+    def test_retained_bytes_per_patched_function(self, tmp_path, monkeypatch):
+        function_count = 500
+        path = tmp_path / 'many_functions.py'
+        path.write_text(''.join(_FUNCTION_TEMPLATE.format(index=index) for index in range(function_count)))
+        monkeypatch.syspath_prepend(str(tmp_path))
+        import many_functions
+        funcs = [getattr(many_functions, 'func_{}'.format(index)) for index in range(function_count)]
+        linecache.getlines(str(path))  # the lines of the file are kept by linecache, whether patched or not
+        gc.collect()
+
+        tracemalloc.start()
+        try:
+            before = tracemalloc.get_traced_memory()[0]
+            monki.patch_many({func: {'start': 'values = list(values)', 'insert_lines': {2: 'scale *= 2'}}
+                              for func in funcs})
+            gc.collect()
+            retained = tracemalloc.get_traced_memory()[0] - before
+            assert funcs[3]([1, 5]) == 9
+        finally:
+            tracemalloc.stop()
+            for func in funcs:
+                monki.unpatch(func)
+            sys.modules.pop('many_functions', None)
+
+        print(retained / function_count)
+        assert retained / function_count < self.BUDGET
@@ -0,0 +1,122 @@
+import sys
+import threading
+import time
+
+import pytest
+
+import monki
+from monki import enhancers
+
+
+_MODULE_SOURCE = '''
+import time
+
+
+def hot(n):
+    total = 0
+    for i in range(n):
+        total += i * i
+    return total
+
+
+def warm(n):
+    return sum(range(n))
+
+
+def cold():
+    return 0
+
+
+exec(compile("def generated(n):\\n    return sum(i * i for i in range(n))\\n", "<generated>", "exec"))
+
+
+def work(deadline, use_generated=False):
+    while time.perf_counter() < deadline:
+        (generated if use_generated else hot)(100000)
+        warm(100000)
+'''
+
+
+@pytest.fixture
+def hot_module(tmp_path, monkeypatch):
+    (tmp_path / 'sampled_module.py').write_text(_MODULE_SOURCE)
+    monkeypatch.syspath_prepend(str(tmp_path))
+    import sampled_module
+    yield sampled_module
+    monki.remove_autoinstrumentation()
+    enhancers.reset_latencies()
+    sys.modules.pop('sampled_module', None)
+
+
+def _work_in_thread(module, seconds, **kwargs):
+    thread = threading.Thread(target=module.work, args=(time.perf_counter() + seconds,), kwargs=kwargs)
+    thread.start()
+    return thread
+
+
+class TestAutoinstrument:
+    """
+    Tests for finding the hot functions of a package by sampling, and timing them.
+    """
+
+    def test_hottest_function_is_timed(self, hot_module):
+        original_code = hot_module.hot.__code__
+        thread = _work_in_thread(hot_module, 0.5)
+        try:
+            report = monki.autoinstrument('sampled_module', duration=0.3, top=1)
+        finally:
+            thread.join()
+
+        assert not report.sampling and report.samples > 0
+        assert report.hot[0].name == 'sampled_module.hot'
+        assert 0 < report.hot[0].share <= 1
+        assert list(report.probed) == ['sampled_module.hot'] and not report.skipped
+        assert hot_module.hot.__code__ is not original_code
+        assert hot_module.cold.__code__.co_name == 'cold' and not monki.autoinstrument_report().probed.get(
+            'sampled_module.cold')
+
+        hot_module.hot(10)
+        assert monki.autoinstrument_report().probed['sampled_module.hot'].count >= 1
+        monki.remove_autoinstrumentation()
+        assert hot_module.hot.__code__ is original_code
+        assert monki.autoinstrument_report().probed['sampled_module.hot'].count >= 1  # kept after removing
+
+    def test_functions_which_cant_be_patched_are_skipped(self, hot_module):
+        thread = _work_in_thread(hot_module, 0.5, use_generated=True)
+        try:
+            report = monki.autoinstrument(hot_module, duration=0.3, top=1)
+        finally:
+            thread.join()
+
+        assert 'sampled_module.generated' in report.skipped
+        assert len(report.probed) == 1 and 'sampled_module.generated' not in report.probed
+
+    def test_sampling_the_calling_thread_in_the_background(self, hot_module):
+        assert monki.autoinstrument('sampled_module', duration=0.2, top=1, wait=False) is None
+        deadline = time.perf_counter() + 5
+        while monki.autoinstrument_report().sampling and time.perf_counter() < deadline:
+            hot_module.hot(20000)
+
+        report = monki.autoinstrument_report()
+        assert not report.sampling
+        assert list(report.probed) == ['sampled_module.hot']
+
+    def test_removing_stops_the_sampling(self, hot_module):
+        monki.autoinstrument('sampled_module', duration=60, wait=False)
+        monki.remove_autoinstrumentation()
+        report = monki.autoinstrument_report()
+        assert not report.sampling and not report.probed
+        monki.autoinstrument('sampled_module', duration=0.01)  # can run again
+
+    def test_only_one_at_a_time(self, hot_module):
+        monki.autoinstrument('sampled_module', duration=60, wait=False)
+        with pytest.raises(ValueError):
+            monki.autoinstrument('sampled_module')
+
+    def test_invalid_arguments(self):
+        with pytest.raises(ValueError):
+            monki.autoinstrument('sampled_module', top=0)
+        with pytest.raises(ValueError):
+            monki.autoinstrument('sampled_module', duration=0)
+        with pytest.raises(TypeError):
+            monki.autoinstrument(42)
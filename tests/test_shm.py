@@ -0,0 +1,109 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+import monki
+from monki import shm
+from monki.__main__ import main
+
+
+@pytest.fixture
+def counters_path(tmp_path, monkeypatch):
+    monkeypatch.setattr(shm, '_segment', None)
+    return monki.create_shared_counters(str(tmp_path / 'counters'), max_probes=4, max_workers=3)
+
+
+class TestSharedCounters:
+    """
+    Tests for probes which count in shared memory.
+    """
+
+    def test_probes_count_calls_and_lines(self, counters_path):
+        def func(a):
+            if not a:
+                return 0
+            return a
+
+        monki.probe(func, name='truthy', line=2)
+        monki.probe(func)
+        for a in (0, 1, 2):
+            func(a)
+        prefix = '{}.{}:'.format(func.__module__, func.__qualname__)
+        assert monki.shared_counts() == {prefix + 'calls': 3, prefix + 'truthy': 2}
+        assert shm.read_shared_counters(counters_path) == monki.shared_counts()
+
+    @pytest.mark.skipif(not hasattr(os, 'fork'), reason='requires os.fork')
+    def test_forked_processes_count_in_their_own_stripes(self, counters_path):
+        def func():
+            pass
+
+        monki.probe(func)
+        pids = []
+        for _ in range(2):
+            pid = os.fork()
+            if pid == 0:
+                for _ in range(100):
+                    func()
+                os._exit(0)
+            pids.append(pid)
+        for pid in pids:
+            os.waitpid(pid, 0)
+        func()
+
+        assert list(monki.shared_counts().values()) == [201]
+        owners = shm._read_owners(shm._segment.mapped, 3)
+        assert owners[0] == os.getpid() and set(owners[1:]) == set(pids)
+
+    def test_stats_command(self, counters_path, capsys):
+        def func():
+            pass
+
+        monki.probe(func)
+        func()
+        assert main(['stats', counters_path]) == 0
+        assert capsys.readouterr().out.split() == ['1', '{}.{}:calls'.format(func.__module__, func.__qualname__)]
+        assert main(['stats', counters_path + '.missing']) == 1
+
+    def test_running_out_of_slots(self, counters_path):
+        funcs = []
+        for index in range(5):
+            def func():
+                pass
+            func.__qualname__ += str(index)
+            funcs.append(func)
+
+        for func in funcs[:4]:
+            monki.probe(func)
+        with pytest.raises(ValueError, match='slots'):
+            monki.probe(funcs[4])
+
+    def test_remove_shared_counters(self, counters_path):
+        def func():
+            pass
+
+        monki.probe(func)
+        monki.remove_shared_counters()
+        monki.remove_shared_counters()
+        assert not os.path.exists(counters_path)
+        func()
+        assert list(monki.shared_counts().values()) == [1]
+
+    @pytest.mark.skipif(not hasattr(os, 'fork'), reason='requires os.fork')
+    def test_default_file_is_removed_when_its_creator_exits(self):
+        script = '\n'.join([
+            'import os, sys, monki',
+            'path = monki.create_shared_counters()',
+            'pid = os.fork()',
+            'if pid == 0:',
+            '    sys.exit(0)',  # runs the exit hooks in the forked process
+            'os.waitpid(pid, 0)',
+            'print(path, os.path.exists(path))',
+        ])
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        output = subprocess.run([sys.executable, '-c', script], cwd=root, check=True, stdout=subprocess.PIPE,
+                                universal_newlines=True).stdout
+        path, exists_after_fork = output.split()
+        assert exists_after_fork == 'True'
+        assert not os.path.exists(path)
@@ -0,0 +1,114 @@
+import asyncio
+
+import pytest
+
+import monki
+from monki.source import parse_function_source
+
+
+class TestAstEngine:
+    """
+    Tests for splitting function sources into signature and body with the ast engine.
+    """
+
+    def test_decorators_and_indentation_are_removed(self):
+        parsed = parse_function_source('    @decorator(1)\n'
+                                       '    def func(a, b):\n'
+                                       '        return a + b\n')
+        assert parsed.signature == 'def func(a, b):\n'
+        assert parsed.body_lines == ['    return a + b']
+        assert parsed.name == 'func'
+
+    def test_async_def_with_return_annotation(self):
+        parsed = parse_function_source('async def func(a: int = (1, 2), b=lambda: 3) -> Dict[str, int]:\n'
+                                       '    return a\n')
+        assert parsed.signature == 'async def func(a: int = (1, 2), b=lambda: 3) -> Dict[str, int]:\n'
+        assert parsed.is_async
+
+    def test_multi_line_signature(self):
+        parsed = parse_function_source('    def func(a,\n'
+                                       '             b=":"):  # comment\n'
+                                       '\n'
+                                       '        return a\n')
+        assert parsed.signature == 'def func(a,\n         b=":"):\n'
+        assert parsed.body_lines == ['    return a']
+
+    def test_tab_indentation_is_normalized(self):
+        parsed = parse_function_source('\tdef func(a):\n'
+                                       '\t\tif a:\n'
+                                       '\t\t\treturn a\n')
+        assert parsed.body_lines == ['    if a:', '            return a']
+
+    def test_multi_line_strings_are_kept_as_is(self):
+        parsed = parse_function_source('    def func():\n'
+                                       '        return """first\n'
+                                       '        second"""\n')
+        assert parsed.body_lines == ['    return """first', '        second"""']
+
+    def test_one_liner(self):
+        parsed = parse_function_source('def func(a): return a\n')
+        assert parsed.signature == 'def func(a):\n'
+        assert parsed.body_lines == ['    return a']
+
+    def test_not_a_function_raises_error(self):
+        with pytest.raises(ValueError):
+            parse_function_source('x = lambda: 1\n')
+
+
+class TestPatchingWithEngines:
+    """
+    Tests for patching functions that only the ast engine supports,
+    and for selecting the original regex engine.
+    """
+
+    def test_patching_function_with_annotations_and_defaults(self):
+        def func(outlist: list, text: str = 'a:b', check=lambda x: x) -> list:
+            outlist.append(check(text))
+            return outlist
+
+        monki.patch(func, start='outlist.append("start")')
+        assert func([]) == ['start', 'a:b']
+
+    def test_patching_tab_indented_method(self, tmp_path, monkeypatch):
+        (tmp_path / 'tabbed_module.py').write_text('class Thing:\n'
+                                                   '\tdef method(self, outlist):\n'
+                                                   '\t\tfor i in range(2):\n'
+                                                   '\t\t\toutlist.append(i)\n'
+                                                   '\t\treturn outlist\n')
+        monkeypatch.syspath_prepend(str(tmp_path))
+        from tabbed_module import Thing
+
+        monki.patch(Thing.method, start='outlist.append("start")', insert_lines={2: 'outlist.append("end")'})
+        assert Thing().method([]) == ['start', 0, 1, 'end']
+
+    def test_patching_async_function(self):
+        async def func(outlist):
+            outlist.append('middle')
+            return outlist
+
+        monki.patch(func, start='outlist.append("start")')
+        assert asyncio.run(func([])) == ['start', 'middle']
+
+    def test_regex_engine_is_selectable(self):
+        def func(outlist):
+            outlist.append('middle')
+
+        monki.patch(func, start='outlist.append("start")', engine='regex')
+        outlist = []
+        func(outlist)
+        assert outlist == ['start', 'middle']
+
+    def test_regex_engine_with_async_function(self):
+        async def func(outlist):
+            outlist.append('middle')
+            return outlist
+
+        monki.patch(func, start='outlist.append("start")', engine='regex')
+        assert asyncio.run(func([])) == ['start', 'middle']
+
+    def test_unknown_engine_raises_error(self):
+        def func():
+            pass
+
+        with pytest.raises(ValueError):
+            monki.patch(func, start='pass', engine='other')